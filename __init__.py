@@ -6,15 +6,24 @@ import cv2
 from tqdm import tqdm
 import re
 import torch
+from datetime import datetime
 from .nodes import PoseGenVideo, RefImagePath, Audio2Video, AudioPath #,GenerateRefPose
 
-from .src.utils.util import get_fps, read_frames, save_videos_from_pil, calculate_file_hash, get_sorted_dir_files_from_directory, get_audio, lazy_eval, hash_path, validate_path
+from .src.utils.util import get_fps, read_frames, read_video_frames, VideoWriter, save_videos_from_pil, calculate_file_hash, get_sorted_dir_files_from_directory, get_audio, lazy_eval, hash_path, validate_path
 import numpy as np
 from .src.utils.draw_util import FaceMeshVisualizer
-from .src.utils.mp_utils  import LMKExtractor
+from .src.utils.mp_utils  import LMKExtractor, LMKExtractorPool, SparseLMKExtractor, LandmarkCache
+from .src.utils.landmark_sequence import LandmarkSequence
 
 video_extensions = ['webm', 'mp4', 'mkv', 'gif']
 
+def output_linked(prompt, unique_id, index):
+    # whether an input of any node in the queued prompt takes output `index` of node `unique_id`, True without a prompt
+    if prompt is None or unique_id is None:
+        return True
+    return any(isinstance(value, list) and len(value) == 2 and str(value[0]) == str(unique_id) and value[1] == index
+               for node in prompt.values() for value in node.get("inputs", {}).values())
+
 class VideoGenPose:
     @classmethod
     def INPUT_TYPES(s):
@@ -25,37 +34,52 @@ class VideoGenPose:
                 "height": ("INT", {"default": 512, "min": 0, "max": 1024, "step": 1}),
                 "width": ("INT", {"default": 512, "min": 0, "max": 1024, "step": 1}),
             },
+            "optional": {
+                "lmk_workers": ("INT", {"default": 0, "min": 0, "max": 64, "step": 1}),
+                "lmk_mode": (["image", "video"],),
+                "frame_rate": ("FLOAT", {"default": 30, "min": 1, "step": 1}),
+                "lmk_cache": ("BOOLEAN", {"default": True}),
+                "lmk_mmap": ("BOOLEAN", {"default": False}),
+                "lmk_every": ("INT", {"default": 1, "min": 1, "max": 64, "step": 1}),
+                "lmk_motion_threshold": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 1.0, "step": 0.001}),
+            },
+            "hidden": {"prompt": "PROMPT", "unique_id": "UNIQUE_ID"},
         }
 
-    RETURN_TYPES = ("IMAGE",)
-    RETURN_NAMES = ("pose_images",)
+    RETURN_TYPES = ("IMAGE", "LANDMARK_SEQUENCE",)
+    RETURN_NAMES = ("pose_images", "landmarks",)
     OUTPUT_NODE = True
     CATEGORY = "AniPortrait 🎥Video"
     FUNCTION = "generate_pose_video"
 
-    def generate_pose_video(self, image, filename_prefix, height, width):
+    def generate_pose_video(self, image, filename_prefix, height, width, lmk_workers=0, lmk_mode="image", frame_rate=30, lmk_cache=True, lmk_mmap=False, lmk_every=1, lmk_motion_threshold=0.0, prompt=None, unique_id=None):
         
         frames = (image.numpy() * 255).astype(np.uint8)
-        lmk_extractor = LMKExtractor()
         vis = FaceMeshVisualizer(forehead_edge=False)
 
-        kps_results = []
-        for i, frame_pil in enumerate(tqdm(frames)):
-            image_np = cv2.cvtColor(np.array(frame_pil), cv2.COLOR_RGB2BGR)
-            image_np = cv2.resize(image_np, (height, width))
-            face_result = lmk_extractor(image_np)
-            try:
-                lmks = face_result['lmks'].astype(np.float32)
-                pose_img = vis.draw_landmarks((image_np.shape[1], image_np.shape[0]), lmks, normed=True)
-                pose_img = Image.fromarray(cv2.cvtColor(pose_img, cv2.COLOR_BGR2RGB))
-            except:
-                pose_img = kps_results[-1]
-            
-            kps_results.append(pose_img)
-            
-        iterable = (x for x in kps_results)
-        images = torch.from_numpy(np.fromiter(iterable, np.dtype((np.float32, (height, width, 3)))))
-        return (images,)
+        images_np = np.stack([cv2.resize(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR), (height, width)) for frame in frames])
+        # lmk_workers 0 picks the number of processes from the cpu count
+        # lmk_every > 1 runs the landmarker on every lmk_every-th frame only and interpolates the rest
+        with LMKExtractorPool(num_workers=lmk_workers, FPS=frame_rate / lmk_every, mode=lmk_mode) as lmk_pool:
+            lmk_extractor = SparseLMKExtractor(lmk_pool, every=lmk_every, motion_threshold=lmk_motion_threshold)
+            if lmk_cache:
+                extra = f"{lmk_mode}/{frame_rate}/{lmk_every}/{lmk_motion_threshold}"
+                face_results = LandmarkCache(os.path.join(folder_paths.get_temp_directory(), "aniportrait_landmarks")).extract(images_np, lmk_extractor, extra=extra)
+            else:
+                face_results = lmk_extractor(images_np)
+
+        # frames without a face repeat the last pose, all frames are drawn in parallel
+        landmarks = LandmarkSequence.from_results(face_results, fps=frame_rate, frame_size=(images_np.shape[2], images_np.shape[1]))
+        if output_linked(prompt, unique_id, 0):
+            images = torch.from_numpy(landmarks.render_images(vis, (images_np.shape[2], images_np.shape[1])))
+        else:
+            # pose_images goes nowhere, the float32 renders of every frame are skipped
+            images = torch.zeros((1, images_np.shape[1], images_np.shape[2], 3))
+
+        if lmk_mmap:
+            time_str = datetime.now().strftime("%Y%m%d%H%M%S%f")
+            landmarks = landmarks.memory_mapped(os.path.join(folder_paths.get_temp_directory(), f"{filename_prefix}_{time_str}_landmarks"))
+        return (images, landmarks,)
 
 
 class LoadVideoPath:
@@ -65,6 +89,13 @@ class LoadVideoPath:
             "required": {
                 "video": ("STRING", {"default": "X://insert/path/here.mp4", "aniportrait_path_extensions": video_extensions}),
             },
+            "optional": {
+                "start_frame": ("INT", {"default": 0, "min": 0, "max": 0xffffffffffffffff, "step": 1}),
+                "end_frame": ("INT", {"default": 0, "min": 0, "max": 0xffffffffffffffff, "step": 1}),
+                "select_every_nth": ("INT", {"default": 1, "min": 1, "max": 0xffffffffffffffff, "step": 1}),
+                "width": ("INT", {"default": 0, "min": 0, "max": 4096, "step": 1}),
+                "height": ("INT", {"default": 0, "min": 0, "max": 4096, "step": 1}),
+            },
         }
 
     CATEGORY = "AniPortrait 🎥Video"
@@ -87,9 +118,48 @@ class LoadVideoPath:
         return validate_path(video, allow_none=True)
         
 
-def load_video_av(video: str):
-    fps = get_fps(video)
-    frames = read_frames(video)
+class SaveVideo:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {
+            "required": {
+                "images": ("IMAGE",),
+                "frame_rate": ("FLOAT", {"default": 30, "min": 1, "step": 1}),
+                "filename_prefix": ("STRING", {"default": "AniPortrait"}),
+                "crf": ("INT", {"default": 19, "min": 0, "max": 51, "step": 1}),
+            },
+            "optional": {
+                "audio_path": ("Audio_Path",),
+                "video": ("AniPortrait_Video",),
+            },
+        }
+
+    RETURN_TYPES = ("STRING",)
+    RETURN_NAMES = ("video_path",)
+    OUTPUT_NODE = True
+    CATEGORY = "AniPortrait 🎥Video"
+    FUNCTION = "save_video"
+
+    def save_video(self, images, frame_rate, filename_prefix, crf, audio_path=None, video=None, batch_size=16):
+        # the driving audio wins over the audio track of the source video
+        audio_source = audio_path or video
+        time_str = datetime.now().strftime("%Y%m%d%H%M%S")
+        save_path = os.path.join(folder_paths.get_output_directory(), f"{filename_prefix}_{time_str}.mp4")
+        with VideoWriter(save_path, frame_rate, audio_path=audio_source, crf=crf) as writer:
+            # quantise one batch at a time, the uint8 video is never built in full
+            for start in range(0, len(images), batch_size):
+                batch = images[start:start + batch_size]
+                writer.write(batch.clamp(0, 1).mul(255).round_().to(torch.uint8))
+        return (save_path,)
+
+
+def load_video_av(video: str, start_frame=0, end_frame=0, select_every_nth=1, width=0, height=0):
+    # end_frame 0 reads to the end, width/height 0 keep the source size
+    fps = get_fps(video) / select_every_nth
+    size = (width, height) if width > 0 and height > 0 else None
+    # IMAGE batches are float32, the selected clip is decoded straight into one float32 buffer of that size
+    frames = read_video_frames(video, start=start_frame, end=end_frame or None, stride=select_every_nth, size=size, dtype=np.float32)
+    frames = torch.from_numpy(frames)
     input_dir = folder_paths.get_output_directory()
     audio_output = os.path.join(input_dir, 'audio_from_video.aac')
 
@@ -103,6 +173,7 @@ NODE_CLASS_MAPPINGS = {
 #    "AniPortrait_Generate_Ref_Pose": GenerateRefPose,
     "AniPortrait_Audio2Video": Audio2Video,
     "AniPortrait_Audio_Path": AudioPath,    
+    "AniPortrait_Save_Video": SaveVideo,
 }
 
 NODE_DISPLAY_NAME_MAPPINGS = {
@@ -113,4 +184,5 @@ NODE_DISPLAY_NAME_MAPPINGS = {
 #    "AniPortrait_Generate_Ref_Pose": "Generate Ref Pose 🎥AniPortrait",
     "AniPortrait_Audio2Video": "Audio Gen Video 🎥AniPortrait",   
     "AniPortrait_Audio_Path": "Audio Path 🎥AniPortrait",   
+    "AniPortrait_Save_Video": "Save Video 🎥AniPortrait",
 }
@@ -27,13 +27,14 @@ from .src.models.pose_guider import PoseGuider
 from .src.models.unet_2d_condition import UNet2DConditionModel
 from .src.models.unet_3d import UNet3DConditionModel
 from .src.pipelines.pipeline_pose2vid_long import Pose2VideoPipeline
-from .src.utils.util import get_fps, read_frames, save_videos_grid, calculate_file_hash, get_sorted_dir_files_from_directory, get_audio, lazy_eval, hash_path, validate_path
-from .src.utils.frame_interpolation import init_frame_interpolation_model, batch_images_interpolation_tool
+from .src.utils.util import get_fps, read_frames, save_videos_grid, videos_to_images, pose_frames_from_images, calculate_file_hash, get_sorted_dir_files_from_directory, get_audio, lazy_eval, hash_path, validate_path
+from .src.utils.frame_interpolation import init_frame_interpolation_model, batch_images_interpolation_tool, landmark_motion, pose_image_motion, select_keyframes
 from .src.audio_models.model import Audio2MeshModel
 from .src.audio_models.pose_model import Audio2PoseModel
-from .src.utils.audio_util import prepare_audio_feature
-from .src.utils.mp_utils  import LMKExtractor
+from .src.utils.audio_util import prepare_audio_feature, audio_wav_bytes
+from .src.utils.mp_utils  import LMKExtractor, LMKExtractorPool, SparseLMKExtractor, LandmarkCache
 from .src.utils.draw_util import FaceMeshVisualizer
+from .src.utils.pose_raster import FaceMeshRasterizer
 from .src.utils.pose_util import project_points, project_points_with_trans, matrix_to_euler_and_translation, euler_and_translation_to_matrix, smooth_pose_seq
 
 from scipy.spatial.transform import Rotation as R
@@ -117,7 +118,6 @@ class PoseGenVideo:
         return {
             "required": {
                 "ref_image": ("IMAGE",),
-                "pose_images": ("IMAGE", ),
                 "frame_count": ("INT", {"default": 0, "min": 0, "max": 0xffffffffffffffff, "forceInput": True}),
                 "height": ("INT", {"default": 512, "min": 0, "max": 1024, "step": 1}),
                 "width": ("INT", {"default": 512, "min": 0, "max": 1024, "step": 1}),
@@ -135,6 +135,15 @@ class PoseGenVideo:
                 "reference_unet_path": ([animation_config.reference_unet_path],),
                 "pose_guider_path": ([animation_config.pose_guider_path],),             
             },
+            "optional": {
+                "pose_images": ("IMAGE", ),
+                "landmarks": ("LANDMARK_SEQUENCE", ),
+                "fi_mode": (["fixed", "adaptive"],),
+                "fi_max_step": ("INT", {"default": 6, "min": 1}),
+                "motion_threshold": ("FLOAT", {"default": 0.01, "min": 0.0, "max": 1.0, "step": 0.001}),
+                "pose_motion_threshold": ("FLOAT", {"default": 0.005, "min": 0.0, "max": 1.0, "step": 0.0005}),
+                "fi_blend_threshold": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 1.0, "step": 0.001}),
+            },
         }
 
     RETURN_TYPES = ("IMAGE",)
@@ -143,7 +152,7 @@ class PoseGenVideo:
     CATEGORY = "AniPortrait 🎥Video"
     FUNCTION = "pose_generate_video"
 
-    def pose_generate_video(self, ref_image, pose_images, frame_count, height, width, seed, cfg, steps, vae_path, model, weight_dtype, accelerate, fi_step, motion_module_path, image_encoder_path, denoising_unet_path, reference_unet_path, pose_guider_path):
+    def pose_generate_video(self, ref_image, frame_count, height, width, seed, cfg, steps, vae_path, model, weight_dtype, accelerate, fi_step, motion_module_path, image_encoder_path, denoising_unet_path, reference_unet_path, pose_guider_path, pose_images=None, landmarks=None, fi_mode="fixed", fi_max_step=6, motion_threshold=0.01, pose_motion_threshold=0.005, fi_blend_threshold=0.0):
         
         if weight_dtype == "fp16":
             weight_dtype = torch.float16
@@ -193,7 +202,7 @@ class PoseGenVideo:
         vis = FaceMeshVisualizer(forehead_edge=False)   
         
         if accelerate:
-            frame_inter_model = init_frame_interpolation_model()
+            frame_inter_model = init_frame_interpolation_model(device)
         
         
         ref_image = torch.squeeze(ref_image, 0)
@@ -207,35 +216,40 @@ class PoseGenVideo:
         lmks = face_result['lmks'].astype(np.float32)
         ref_pose = vis.draw_landmarks((ref_image_np.shape[1], ref_image_np.shape[0]), lmks, normed=True)        
         
-        pose_list = []
-        pose_tensor_list = []
+        if landmarks is None and pose_images is None:
+            raise ValueError("PoseGenVideo needs pose_images or landmarks")
+        if landmarks is not None:
+            frame_count = min(frame_count, len(landmarks)) if frame_count > 0 else len(landmarks)
         print(f"pose video has {frame_count} frames")
-        pose_transform = transforms.Compose(
-            [transforms.Resize((height, width)), transforms.ToTensor()]
-        )
         
-        for pose_image_pil in pose_images[: frame_count]:
-            pose_image_pil = (pose_image_pil.numpy() * 255).astype(np.uint8)
-            pose_tensor_list.append(pose_transform(Image.fromarray(pose_image_pil)))
         sub_step = fi_step if accelerate else 1
-        for pose_image_pil in pose_images[: frame_count: sub_step]:
-            pose_image = (pose_image_pil.numpy() * 255).astype(np.uint8)
-            pose_image_np = cv2.cvtColor(np.array(pose_image), cv2.COLOR_RGB2BGR)
-            pose_image_np = cv2.resize(pose_image_np,  (width, height))
-            pose_list.append(pose_image_np)       
-         
-        pose_list = np.array(pose_list)
+        adaptive = accelerate and fi_mode == "adaptive"
+        frame_length = frame_count if landmarks is not None else len(pose_images[: frame_count])
+        if adaptive and landmarks is not None:
+            # generate more frames where the landmarks move fast, interpolate the rest. Frames without a face hold the
+            # last face, as they are drawn, instead of jumping to the zero landmarks
+            keyframes = select_keyframes(landmark_motion(landmarks.lmks[landmarks.filled_indices()[: frame_length]]), fi_max_step, motion_threshold)
+            print(f"adaptive keyframes: {len(keyframes)} of {frame_length} frames")
+        elif adaptive:
+            # generate more frames where the pose renders change fast, interpolate the rest. The render difference is on
+            # another scale than the landmark displacement, hence its own threshold
+            keyframes = select_keyframes(pose_image_motion(pose_images[: frame_count].numpy()), fi_max_step, pose_motion_threshold)
+            print(f"adaptive keyframes: {len(keyframes)} of {frame_length} frames")
+        else:
+            keyframes = list(range(0, frame_length, sub_step))
+        if landmarks is not None:
+            # only the frames that go to diffusion are drawn, straight at the target size
+            pose_list = landmarks.render(vis, (width, height), keyframes)
+        else:
+            pose_list = pose_frames_from_images(pose_images[keyframes], height, width, device)
             
         video_length = len(pose_list)
         
-        pose_tensor = torch.stack(pose_tensor_list, dim=0)  # (f, c, h, w)
-        pose_tensor = pose_tensor.transpose(0, 1)
-        pose_tensor = pose_tensor.unsqueeze(0) 
-        
         video = pipe(Image.fromarray(ref_image_pil), pose_list, ref_pose, width, height, video_length, steps, cfg, generator=generator,).videos        
         
         if accelerate:
-            video = batch_images_interpolation_tool(video, frame_inter_model, inter_frames=fi_step-1)
+            inter_frames = list(np.diff(keyframes) - 1) if adaptive else fi_step-1
+            video = batch_images_interpolation_tool(video, frame_inter_model, inter_frames=inter_frames, blend_threshold=fi_blend_threshold)
            
         '''
         ref_image_tensor = pose_transform(Image.fromarray(ref_image_pil))  # (c, h, w)
@@ -248,17 +262,7 @@ class PoseGenVideo:
               
         video = torch.cat([ref_image_tensor, pose_tensor[:,:,:video.shape[2]], video], dim=0)
         '''
-        outputs = []
-        video = rearrange(video, "b c t h w -> t b c h w")
-        for x in video:
-            x = torchvision.utils.make_grid(x, nrow=1)  # (c h w)
-            x = x.transpose(0, 1).transpose(1, 2).squeeze(-1)  # (h w c)
-            x = (x * 255).numpy().astype(np.uint8)
-            x = Image.fromarray(x)
-            outputs.append(x)     
-            
-        iterable = (x for x in outputs)
-        images = torch.from_numpy(np.fromiter(iterable, np.dtype((np.float32, (height, width, 3))))) / 255.0      
+        images = videos_to_images(video)
         return (images,)
 
         
@@ -326,8 +330,10 @@ class AudioPath:
     def load_audio(self, **kwargs):
         if kwargs['audio_path'] is None or validate_path(kwargs['audio_path']) != True:
             raise Exception("reference audio path is not a valid path: " + kwargs['audio_path'])
-        audio = get_audio(kwargs['audio_path'], start_time=kwargs["seek_seconds"])
-        return (load_reference_audio(kwargs['audio_path']), lambda : audio)
+        # nothing is decoded until a consumer asks, the wav bytes are then kept for later calls. The decode is shared
+        # with the wav2vec input Audio2Video loads from the same file
+        audio = lazy_eval(lambda : audio_wav_bytes(kwargs['audio_path'], start_time=kwargs["seek_seconds"]))
+        return (load_reference_audio(kwargs['audio_path']), audio)
 
     @classmethod
     def IS_CHANGED(s, audio_path, **kwargs):
@@ -451,6 +457,17 @@ class Audio2Video:
                 "audio_path": ("Audio_Path",),
                 #"ref_pose_path": ("FILENAMES", ),
                 "fps": ("INT", {"default": 0, "min": 0, "max": 0xffffffffffffffff, "forceInput": True}),
+                "fi_mode": (["fixed", "adaptive"],),
+                "fi_max_step": ("INT", {"default": 6, "min": 1}),
+                "motion_threshold": ("FLOAT", {"default": 0.01, "min": 0.0, "max": 1.0, "step": 0.001}),
+                "fi_blend_threshold": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 1.0, "step": 0.001}),
+                "lmk_workers": ("INT", {"default": 0, "min": 0, "max": 64, "step": 1}),
+                "lmk_mode": (["image", "video"],),
+                "lmk_cache": ("BOOLEAN", {"default": True}),
+                "lmk_every": ("INT", {"default": 1, "min": 1, "max": 64, "step": 1}),
+                "lmk_motion_threshold": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 1.0, "step": 0.001}),
+                "pose_renderer": (["opencv", "torch"],),
+                "landmarks": ("LANDMARK_SEQUENCE", ),
             },
         }
 
@@ -460,7 +477,7 @@ class Audio2Video:
     CATEGORY = "AniPortrait 🎥Video"
     FUNCTION = "audio_2_video"
 
-    def audio_2_video(self, ref_image, height, width, seed, cfg, steps, vae_path, model, weight_dtype, accelerate, length, fi_step, motion_module_path, image_encoder_path, denoising_unet_path, reference_unet_path, pose_guider_path, fps=0, images=None, audio_path=None):
+    def audio_2_video(self, ref_image, height, width, seed, cfg, steps, vae_path, model, weight_dtype, accelerate, length, fi_step, motion_module_path, image_encoder_path, denoising_unet_path, reference_unet_path, pose_guider_path, fps=0, images=None, audio_path=None, fi_mode="fixed", fi_max_step=6, motion_threshold=0.01, fi_blend_threshold=0.0, lmk_workers=0, lmk_mode="image", lmk_cache=True, lmk_every=1, lmk_motion_threshold=0.0, pose_renderer="opencv", landmarks=None):
         if audio_path:
             if weight_dtype == "fp16":
                 weight_dtype = torch.float16
@@ -523,7 +540,7 @@ class Audio2Video:
             vis = FaceMeshVisualizer(forehead_edge=False)
                     
             if accelerate:
-                frame_inter_model = init_frame_interpolation_model()
+                frame_inter_model = init_frame_interpolation_model(device)
         
             ref_image = torch.squeeze(ref_image, 0)
             ref_image_pil = (ref_image.numpy() * 255).astype(np.uint8)
@@ -580,13 +597,7 @@ class Audio2Video:
             # project 3D mesh to 2D landmark
             #projected_vertices = project_points(pred, face_result['trans_mat'], cycled_pose_seq, [height, width])
             projected_vertices = project_points(pred, face_result['trans_mat'], pose_seq, [height, width])
-            
-            pose_images = []
-            for i, verts in enumerate(projected_vertices):
-                lmk_img = vis.draw_landmarks((width, height), verts, normed=False)
-                pose_images.append(lmk_img)
 
-            pose_list = []
             '''
             pose_tensor_list = []
             print(f"pose video has {len(pose_images)} frames")
@@ -600,15 +611,24 @@ class Audio2Video:
                 pose_image_np = cv2.resize(pose_image_np,  (width, height))
                 pose_list.append(pose_image_np)
             '''
-            frame_length = len(pose_images) if length==0 or length > len(pose_images) else length
+            frame_length = len(projected_vertices) if length==0 or length > len(projected_vertices) else length
             sub_step = fi_step if accelerate else 1
-            for pose_image_np in pose_images[: frame_length: sub_step]:
-                pose_image_np = cv2.resize(pose_image_np,  (width, height))
-                pose_list.append(pose_image_np)         
-            
-            pose_list = np.array(pose_list)
-            
-            video_length = len(pose_list)
+            adaptive = accelerate and fi_mode == "adaptive"
+            if adaptive:
+                # generate more frames where the landmarks move fast, interpolate the rest
+                motion = landmark_motion(projected_vertices[: frame_length], size=max(height, width))
+                keyframes = select_keyframes(motion, fi_max_step, motion_threshold)
+                print(f"adaptive keyframes: {len(keyframes)} of {frame_length} frames")
+            else:
+                keyframes = list(range(0, frame_length, sub_step))
+            # only the keyframes go to diffusion, they are drawn in parallel
+            if pose_renderer == "torch":
+                # drawn on the device as the finished (1, c, t, h, w) condition
+                pose_list = FaceMeshRasterizer(vis, device=device)(projected_vertices[keyframes], (width, height), dtype=weight_dtype)
+                video_length = pose_list.shape[2]
+            else:
+                pose_list = vis.draw_landmarks_batch(projected_vertices[keyframes], (width, height))
+                video_length = len(pose_list)
             '''
             pose_tensor = torch.stack(pose_tensor_list, dim=0)  # (f, c, h, w)
             pose_tensor = pose_tensor.transpose(0, 1)
@@ -627,7 +647,8 @@ class Audio2Video:
             ).videos    
             
             if accelerate:
-                video = batch_images_interpolation_tool(video, frame_inter_model, inter_frames=fi_step-1)
+                inter_frames = list(np.diff(keyframes) - 1) if adaptive else fi_step-1
+                video = batch_images_interpolation_tool(video, frame_inter_model, inter_frames=inter_frames, blend_threshold=fi_blend_threshold)
             '''
             ref_image_tensor = pose_transform(Image.fromarray(ref_image_pil))  # (c, h, w)
             ref_image_tensor = ref_image_tensor.unsqueeze(1).unsqueeze(
@@ -639,17 +660,7 @@ class Audio2Video:
 
             video = torch.cat([ref_image_tensor, pose_tensor[:,:,:video.shape[2]], video], dim=0)
             '''
-            outputs = []
-            video = rearrange(video, "b c t h w -> t b c h w")
-            for x in video:
-                x = torchvision.utils.make_grid(x, nrow=1)  # (c h w)
-                x = x.transpose(0, 1).transpose(1, 2).squeeze(-1)  # (h w c)
-                x = (x * 255).numpy().astype(np.uint8)
-                x = Image.fromarray(x)
-                outputs.append(x)     
-            
-            iterable = (x for x in outputs)
-            gen_images = torch.from_numpy(np.fromiter(iterable, np.dtype((np.float32, (height, width, 3))))) / 255.0      
+            gen_images = videos_to_images(video)
             return (gen_images,)        
 
         else:
@@ -701,7 +712,7 @@ class Audio2Video:
             vis = FaceMeshVisualizer(forehead_edge=False)        
             
             if accelerate:
-                frame_inter_model = init_frame_interpolation_model()
+                frame_inter_model = init_frame_interpolation_model(device)
             
             #ref_name = Path(ref_image_path).stem
             #pose_name = Path(video).stem
@@ -719,7 +730,10 @@ class Audio2Video:
                 
             #source_images = read_frames(video)
             #src_fps = get_fps(video)
-            print(f"source video has {len(images)} frames, with {fps} fps")
+            if landmarks is not None and not fps:
+                fps = int(round(landmarks.fps))
+            source_length = len(landmarks) if landmarks is not None else len(images)
+            print(f"source video has {source_length} frames, with {fps} fps")
             pose_transform = transforms.Compose(
                 [transforms.Resize((height, width)), transforms.ToTensor()]
             )      
@@ -739,23 +753,46 @@ class Audio2Video:
                 src_image_pil = (src_image_pil.numpy() * 255).astype(np.uint8)
                 src_tensor_list.append(pose_transform(Image.fromarray(src_image_pil)))
             '''
-            frame_length = len(images) if length==0 or length*step > len(images) else length*step
+            frame_length = source_length if length==0 or length*step > source_length else length*step
             sub_step = fi_step if accelerate else step
-            for src_image_pil in images[: frame_length: step*sub_step]:
-                src_image_pil = (src_image_pil.numpy() * 255).astype(np.uint8)
-                src_img_np = cv2.cvtColor(np.array(src_image_pil), cv2.COLOR_RGB2BGR)
-                frame_height, frame_width, _ = src_img_np.shape
-                src_img_result = lmk_extractor(src_img_np)
-                if src_img_result is None:
-                    break
-                pose_trans_list.append(src_img_result['trans_mat'])
-                verts_list.append(src_img_result['lmks3d'])
-                bs_list.append(src_img_result['bs'])
+            adaptive = accelerate and fi_mode == "adaptive"
+            # the adaptive mode tracks every frame and picks the keyframes from the landmark motion
+            extract_step = step if adaptive else step*sub_step
+            if landmarks is not None:
+                # the face VideoGenPose tracked, no landmarker pass. Frames without a face repeat the last face
+                source = landmarks.filled_indices()[: frame_length: extract_step]
+                trans_mat_arr = landmarks.trans_mat[source].astype(np.float64)
+                verts_arr = landmarks.lmks3d[source].astype(np.float64)
+                bs_arr = landmarks.bs[source].astype(np.float64)
+                # the 3D pose was solved for the frames the landmarker saw, projected at any other aspect it stretches
+                if landmarks.frame_size is not None:
+                    frame_width, frame_height = landmarks.frame_size
+                else:
+                    frame_height, frame_width = images.shape[1:3] if images is not None else (height, width)
+            else:
+                src_frames = (images[: frame_length: extract_step].numpy() * 255).astype(np.uint8)[..., ::-1]  # RGB -> BGR
+                frame_height, frame_width = src_frames.shape[1:3]
+                # rate of the frames actually tracked, the source rate is unknown without the fps input
+                lmk_fps = fps * step / extract_step if fps else 25
+                # lmk_every > 1 runs the landmarker on every lmk_every-th tracked frame only and interpolates the rest
+                with LMKExtractorPool(num_workers=lmk_workers, FPS=lmk_fps / lmk_every, mode=lmk_mode) as lmk_pool:
+                    lmk_extractor_sparse = SparseLMKExtractor(lmk_pool, every=lmk_every, motion_threshold=lmk_motion_threshold)
+                    if lmk_cache:
+                        extra = f"{lmk_mode}/{lmk_fps}/{lmk_every}/{lmk_motion_threshold}"
+                        src_img_results = LandmarkCache(os.path.join(folder_paths.get_temp_directory(), "aniportrait_landmarks")).extract(src_frames, lmk_extractor_sparse, extra=extra)
+                    else:
+                        src_img_results = lmk_extractor_sparse(src_frames)
+                for src_img_result in src_img_results:
+                    if src_img_result is None:
+                        break
+                    pose_trans_list.append(src_img_result['trans_mat'])
+                    verts_list.append(src_img_result['lmks3d'])
+                    bs_list.append(src_img_result['bs'])
             	
-            #pose_arr = np.array(pose_trans_list)
-            trans_mat_arr = np.array(pose_trans_list)
-            verts_arr = np.array(verts_list)
-            bs_arr = np.array(bs_list)
+                #pose_arr = np.array(pose_trans_list)
+                trans_mat_arr = np.array(pose_trans_list)
+                verts_arr = np.array(verts_list)
+                bs_arr = np.array(bs_list)
             min_bs_idx = np.argmin(bs_arr.sum(1))
 
             # compute delta pose
@@ -778,15 +815,20 @@ class Audio2Video:
             #projected_vertices = project_points_with_trans(verts_arr, pose_arr, [frame_height, frame_width])
             projected_vertices = project_points_with_trans(verts_arr, pose_mat_smooth, [frame_height, frame_width])
             
-            pose_list = []
-            for i, verts in enumerate(projected_vertices):
-                lmk_img = vis.draw_landmarks((frame_width, frame_height), verts, normed=False)
-                pose_image_np = cv2.resize(lmk_img,  (width, height))
-                pose_list.append(pose_image_np)
-            
-            pose_list = np.array(pose_list)
+            if adaptive:
+                motion = landmark_motion(projected_vertices, size=max(frame_height, frame_width))
+                keyframes = select_keyframes(motion, fi_max_step, motion_threshold)
+                print(f"adaptive keyframes: {len(keyframes)} of {len(projected_vertices)} frames")
+            else:
+                keyframes = list(range(len(projected_vertices)))
+
+            if pose_renderer == "torch":
+                # drawn on the device as the finished (1, c, t, h, w) condition
+                pose_list = FaceMeshRasterizer(vis, device=device)(projected_vertices[keyframes], (width, height), image_size=(frame_width, frame_height), dtype=weight_dtype)
+            else:
+                pose_list = vis.draw_landmarks_batch(projected_vertices[keyframes], (frame_width, frame_height), out_size=(width, height))
             
-            video_length = len(pose_list)                
+            video_length = len(keyframes)
                 
             '''
             src_tensor = torch.stack(src_tensor_list, dim=0)  # (f, c, h, w)
@@ -806,7 +848,8 @@ class Audio2Video:
             ).videos
 
             if accelerate:
-                video_gen = batch_images_interpolation_tool(video_gen, frame_inter_model, inter_frames=fi_step-1)
+                inter_frames = list(np.diff(keyframes) - 1) if adaptive else fi_step-1
+                video_gen = batch_images_interpolation_tool(video_gen, frame_inter_model, inter_frames=inter_frames, blend_threshold=fi_blend_threshold)
             '''
             ref_image_tensor = pose_transform(ref_image_pil)  # (c, h, w)
             ref_image_tensor = ref_image_tensor.unsqueeze(1).unsqueeze(
@@ -818,16 +861,6 @@ class Audio2Video:
             
             video_gen = torch.cat([ref_image_tensor, video_gen, src_tensor[:,:,:video_gen.shape[2]]], dim=0)
             '''
-            outputs = []
-            video = rearrange(video_gen, "b c t h w -> t b c h w")
-            for x in video:
-                x = torchvision.utils.make_grid(x, nrow=1)  # (c h w)
-                x = x.transpose(0, 1).transpose(1, 2).squeeze(-1)  # (h w c)
-                x = (x * 255).numpy().astype(np.uint8)
-                x = Image.fromarray(x)
-                outputs.append(x)     
-            
-            iterable = (x for x in outputs)
-            gen_images = torch.from_numpy(np.fromiter(iterable, np.dtype((np.float32, (height, width, 3))))) / 255.0      
+            gen_images = videos_to_images(video_gen)
             return (gen_images,)        
       
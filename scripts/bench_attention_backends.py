@@ -0,0 +1,61 @@
+"""
+Attention backends: times every backend of ATTENTION_BACKENDS on the attention shapes of a denoising step (spatial
+with reference tokens, temporal, cross), shows what the autotuner picks for each, and times a whole tiny UNet step
+per backend. Runs on CPU.
+
+    python scripts/bench_attention_backends.py --size 256
+"""
+import argparse
+
+import torch
+from diffusers.models.attention_processor import Attention
+
+from bench_utils import timeit, tiny_unets
+from src.models.attention_backend import ATTENTION_BACKENDS, AttentionAutotuner, set_attention_backend
+
+
+def shapes(size, frames):
+    # (name, batch, query tokens, key tokens, channels, heads) at the first UNet level
+    tokens = (size // 8) ** 2
+    return [
+        ("spatial + reference", 2 * frames, tokens, 2 * tokens, 320, 8),
+        ("temporal", 2 * tokens, frames, frames, 320, 8),
+        ("cross", 2 * frames, tokens, 1, 320, 8),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=256, help="pixel size, the latents are 1/8 of it")
+    parser.add_argument("--frames", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    autotuner = AttentionAutotuner(repeat=args.repeat)
+    for name, batch, query_tokens, key_tokens, channels, heads in shapes(args.size, args.frames):
+        attn = Attention(channels, heads=heads, dim_head=channels // heads)
+        query = torch.randn(batch * heads, query_tokens, channels // heads)
+        key = torch.randn(batch * heads, key_tokens, channels // heads)
+        value = torch.randn(batch * heads, key_tokens, channels // heads)
+        with torch.no_grad():
+            timings = {
+                backend: timeit(lambda: fn(attn, query, key, value), repeat=args.repeat)
+                for backend, fn in ATTENTION_BACKENDS.items()
+            }
+            choice = autotuner.select(attn, query, key, value)
+        row = "  ".join(f"{backend} {t * 1000:8.2f} ms" for backend, t in timings.items())
+        print(f"{name:20s} {query_tokens:5d}x{key_tokens:<5d} {row}  -> auto: {choice}")
+
+    reference_unet, denoising_unet = tiny_unets()
+    latent = args.size // 8
+    latents = torch.randn(2, 4, args.frames, latent, latent)
+    encoder_hidden_states = torch.randn(2, 1, 32)
+    for backend in list(ATTENTION_BACKENDS) + ["auto"]:
+        set_attention_backend(denoising_unet, backend, autotuner=AttentionAutotuner(repeat=args.repeat))
+        with torch.no_grad():
+            step = timeit(lambda: denoising_unet(latents, 500, encoder_hidden_states, return_dict=False), repeat=args.repeat)
+        print(f"tiny UNet step {backend:8s} {step * 1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+torch.compile mode: denoising UNet steps per second eager against `BucketedCompile` (inductor), on a tiny random
+UNet on CPU. Also alternates full and deep-cache-reuse steps to show that every specialisation is one bucket and the
+compiled graphs stay within `max_buckets`.
+
+    python scripts/bench_compile.py --size 128 --frames 8
+"""
+import argparse
+import time
+
+import torch
+import torch._dynamo
+
+from bench_utils import max_abs_diff, timeit, tiny_unets
+from src.utils.compile_util import BucketedCompile
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=128, help="pixel size, the latents are 1/8 of it")
+    parser.add_argument("--frames", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-buckets", type=int, default=4)
+    args = parser.parse_args()
+
+    _, unet = tiny_unets()
+    latent = args.size // 8
+    latents = torch.randn(2, 4, args.frames, latent, latent)
+    encoder_hidden_states = torch.randn(2, 1, 32)
+    t = torch.tensor(500)
+
+    compiled = BucketedCompile(unet, max_buckets=args.max_buckets)
+    with torch.no_grad():
+        eager_step = timeit(lambda: unet(latents, t, encoder_hidden_states, return_dict=False), repeat=args.repeat)
+        start = time.perf_counter()
+        compiled_output = compiled(latents, t, encoder_hidden_states, return_dict=False)[0]
+        compile_time = time.perf_counter() - start
+        compiled_step = timeit(lambda: compiled(latents, t, encoder_hidden_states, return_dict=False), repeat=args.repeat)
+        eager_output = unet(latents, t, encoder_hidden_states, return_dict=False)[0]
+
+        # full and cached steps alternate over two context windows, as in a deep cache run
+        torch._dynamo.reset()
+        compiled = BucketedCompile(unet, max_buckets=args.max_buckets)
+        caches = [{}, {}]
+        for step in range(6):
+            for cache in caches:
+                compiled(
+                    latents, t, encoder_hidden_states, return_dict=False,
+                    deep_cache=cache, deep_cache_depth=1, reuse_deep_cache=step % 2 == 1,
+                )
+
+    print(f"eager      {1 / eager_step:7.2f} steps/s")
+    print(f"compiled   {1 / compiled_step:7.2f} steps/s  (first call with compilation {compile_time:.1f} s)")
+    print(f"max abs difference compiled against eager: {max_abs_diff(eager_output, compiled_output):.3e}")
+    print(f"deep cache run: {len(compiled.buckets)} buckets compiled (max_buckets {args.max_buckets})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+DeepCache: runs the tiny random pipeline on CPU with full UNet steps and with deep feature reuse at a few
+intervals and depths, over more frames than one context window so every window keeps its own cache. Reports the
+speedup, of the run and of the denoising UNet calls alone (the tiny UNet is cheap next to the full-size pose
+guider), and the pixel difference (0..255) of the decoded video against the full run.
+
+    python scripts/bench_deep_cache.py --frames 24 --steps 10
+"""
+import argparse
+import time
+
+import torch
+
+from bench_utils import tiny_inputs, tiny_pipeline
+
+CONFIGS = [
+    # (interval, depth, warmup)
+    (1, 1, 0),
+    (2, 1, 2),
+    (3, 1, 2),
+    (2, 2, 2),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=128)
+    parser.add_argument("--frames", type=int, default=24)
+    parser.add_argument("--steps", type=int, default=10)
+    args = parser.parse_args()
+
+    pipe = tiny_pipeline()
+    ref_image, pose_images, ref_pose = tiny_inputs(args.size, args.frames)
+
+    unet_time = [0.0]
+
+    def start_unet(module, args):
+        unet_time.append(time.perf_counter())
+
+    def stop_unet(module, args, output):
+        unet_time[0] += time.perf_counter() - unet_time.pop()
+
+    pipe.denoising_unet.register_forward_pre_hook(start_unet)
+    pipe.denoising_unet.register_forward_hook(stop_unet)
+
+    full = None
+    for interval, depth, warmup in CONFIGS:
+        unet_time[0] = 0.0
+        start = time.perf_counter()
+        video = pipe(
+            ref_image, pose_images, ref_pose, args.size, args.size, args.frames, args.steps, 3.5,
+            generator=torch.manual_seed(42),
+            context_frames=16, context_overlap=4,
+            deep_cache_interval=interval, deep_cache_depth=depth, deep_cache_warmup=warmup,
+        ).videos
+        elapsed = time.perf_counter() - start
+        if full is None:
+            full, full_time, full_unet_time = video, elapsed, unet_time[0]
+        difference = (video - full).abs() * 255
+        print(f"interval {interval} depth {depth} warmup {warmup}   run {elapsed:6.1f} s ({full_time / elapsed:4.2f}x)   "
+              f"UNet {unet_time[0]:6.1f} s ({full_unet_time / unet_time[0]:4.2f}x)   "
+              f"pixel difference mean {difference.mean():6.3f} max {difference.max():6.2f}")
+
+
+if __name__ == "__main__":
+    main()
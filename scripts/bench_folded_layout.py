@@ -0,0 +1,63 @@
+"""
+Folded layout: counts the tensor copies (clone / copy_ kernels, which is what the `b c f h w <-> (b f) c h w`
+rearranges of non-contiguous tensors turn into) of one denoising UNet call with and without
+`enable_folded_layout`, and times both, on a tiny random UNet on CPU.
+
+    python scripts/bench_folded_layout.py --size 256 --frames 16
+"""
+import argparse
+from collections import Counter
+
+import torch
+from torch.utils._python_dispatch import TorchDispatchMode
+
+from bench_utils import max_abs_diff, timeit, tiny_unets
+
+COPY_OPS = {"aten.clone.default", "aten.copy_.default", "aten._to_copy.default"}
+
+
+class CopyCounter(TorchDispatchMode):
+    def __init__(self):
+        super().__init__()
+        self.counts = Counter()
+        self.bytes = 0
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        name = str(func)
+        if name in COPY_OPS and isinstance(out, torch.Tensor):
+            self.counts[name] += 1
+            self.bytes += out.numel() * out.element_size()
+        return out
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=256, help="pixel size, the latents are 1/8 of it")
+    parser.add_argument("--frames", type=int, default=16)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    _, unet = tiny_unets()
+    latent = args.size // 8
+    latents = torch.randn(2, 4, args.frames, latent, latent)
+    encoder_hidden_states = torch.randn(2, 1, 32)
+
+    def step():
+        return unet(latents, 500, encoder_hidden_states, return_dict=False)[0]
+
+    outputs = {}
+    for folded in (False, True):
+        unet.enable_folded_layout(folded)
+        with torch.no_grad():
+            with CopyCounter() as counter:
+                outputs[folded] = step()
+            step_time = timeit(step, repeat=args.repeat)
+        name = "folded  " if folded else "unfolded"
+        print(f"{name} {sum(counter.counts.values()):4d} copies {counter.bytes / 2**20:9.1f} MiB   "
+              f"step {step_time * 1000:8.2f} ms")
+    print(f"max abs output difference: {max_abs_diff(outputs[False], outputs[True]):.3e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+FILM frame interpolation: output frames per second of the original one pair at a time loop against
+`batch_images_interpolation_tool` (batched bisection levels, and thread parallel on cpu), on frames of
+assets/pose_ref_video.mp4, with the largest difference to the loop's frames. Needs the FILM TorchScript checkpoint
+(pretrained_model/film_net_fp16.pt, or --checkpoint).
+
+With --diffusion-fps (frames per second of the generation the frames would otherwise come from) it also prints the
+speedup of generating every fi_step-th frame and interpolating the rest, to show when FILM pays off.
+
+    python scripts/bench_frame_interpolation.py --device cpu --size 256 --frames 9 --inter-frames 3 --diffusion-fps 0.5
+"""
+import argparse
+import bisect
+import os
+import time
+
+import numpy as np
+import torch
+
+from bench_utils import ROOT, max_abs_diff
+from src.utils.frame_interpolation import batch_images_interpolation_tool, init_frame_interpolation_model
+from src.utils.util import read_video_frames
+
+DTYPES = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+def per_pair_interpolation(input_tensor, model, inter_frames=1):
+    # the original tool: every pair on its own, the bisection order recomputed per pair, results back to cpu float32
+    parameter = next(model.parameters())
+    video_tensor = []
+    for idx in range(input_tensor.shape[2] - 1):
+        results = [input_tensor[:, :, idx], input_tensor[:, :, idx + 1]]
+        idxes = [0, inter_frames + 1]
+        remains = list(range(1, inter_frames + 1))
+        splits = torch.linspace(0, 1, inter_frames + 2)
+        for _ in range(len(remains)):
+            starts = splits[idxes[:-1]]
+            ends = splits[idxes[1:]]
+            distances = ((splits[None, remains] - starts[:, None]) / (ends[:, None] - starts[:, None]) - .5).abs()
+            start_i, step = np.unravel_index(torch.argmin(distances).item(), distances.shape)
+            end_i = start_i + 1
+            x0 = results[start_i].to(device=parameter.device, dtype=parameter.dtype)
+            x1 = results[end_i].to(device=parameter.device, dtype=parameter.dtype)
+            dt = x0.new_full((1, 1), (splits[remains[step]] - splits[idxes[start_i]])) / (splits[idxes[end_i]] - splits[idxes[start_i]])
+            with torch.no_grad():
+                prediction = model(x0, x1, dt)
+            insert_position = bisect.bisect_left(idxes, remains[step])
+            idxes.insert(insert_position, remains[step])
+            results.insert(insert_position, prediction.clamp(0, 1).cpu().float())
+            del remains[step]
+        video_tensor += [r.unsqueeze(2) for r in results[:-1]]
+    video_tensor.append(input_tensor[:, :, -1].unsqueeze(2))
+    return torch.cat(video_tensor, dim=2)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--dtype", choices=list(DTYPES), default=None, help="default fp16 on cuda, fp32 on cpu")
+    parser.add_argument("--checkpoint", default=None)
+    parser.add_argument("--video", default=os.path.join(ROOT, "assets/pose_ref_video.mp4"))
+    parser.add_argument("--size", type=int, default=256)
+    parser.add_argument("--frames", type=int, default=9, help="input frames, the output has (frames - 1) * (inter_frames + 1) + 1")
+    parser.add_argument("--inter-frames", type=int, default=3)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--diffusion-fps", type=float, default=None)
+    args = parser.parse_args()
+
+    dtype = DTYPES[args.dtype] if args.dtype else None
+    if args.checkpoint:
+        model = torch.jit.load(args.checkpoint, map_location="cpu").eval()
+        model = model.to(device=args.device, dtype=dtype or (torch.float16 if args.device == "cuda" else torch.float32))
+    else:
+        model = init_frame_interpolation_model(args.device, dtype)
+    sync = torch.cuda.synchronize if args.device.startswith("cuda") else (lambda: None)
+
+    frames = read_video_frames(args.video, end=args.frames, size=(args.size, args.size))
+    # (1, channel, frame, height, width) on the 0..1 scale, as the nodes hand over the decoded video
+    video = torch.from_numpy(frames).permute(3, 0, 1, 2).unsqueeze(0).float() / 255
+    output_frames = (args.frames - 1) * (args.inter_frames + 1) + 1
+
+    runs = [("per pair loop", lambda: per_pair_interpolation(video, model, args.inter_frames))]
+    runs.append(("batched", lambda: batch_images_interpolation_tool(video, model, args.inter_frames, batch_size=args.batch_size, num_workers=1)))
+    if args.device == "cpu":
+        runs.append(("batched, threads", lambda: batch_images_interpolation_tool(video, model, args.inter_frames, batch_size=args.batch_size)))
+
+    reference = None
+    for name, run in runs:
+        run()
+        sync()
+        start = time.perf_counter()
+        output = run()
+        sync()
+        elapsed = time.perf_counter() - start
+        if reference is None:
+            reference = output
+        print(f"{name:18s} {output_frames / elapsed:7.2f} output frames/s   "
+              f"max abs difference to the loop {max_abs_diff(reference, output) * 255:.3f} (0..255)")
+        interpolated_fps = (output_frames - args.frames) / elapsed
+
+    if args.diffusion_fps:
+        print(f"FILM {interpolated_fps:.2f} interpolated frames/s against diffusion {args.diffusion_fps:.2f} frames/s")
+        for fi_step in range(2, 6):
+            seconds_per_frame = 1 / fi_step / args.diffusion_fps + (fi_step - 1) / fi_step / interpolated_fps
+            print(f"fi_step {fi_step}: {1 / seconds_per_frame / args.diffusion_fps:5.2f}x the frames/s of diffusion only")
+
+
+if __name__ == "__main__":
+    main()
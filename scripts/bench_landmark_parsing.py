@@ -0,0 +1,96 @@
+"""
+Per frame cost of reading the landmarker output into numpy: the proto path (parse every output proto, copy the
+landmark list, then np.fromiter over every lmk.x / lmk.y / lmk.z and every mesh vertex) against
+`_serialized_landmarker_arrays`, which reads the landmarks, the mesh and the pose matrix from the serialized packets
+(what `_build_landmarker_arrays` uses once its first face matched the protos). Prints the time of both per frame next
+to the time of a whole LMKExtractor call, and the largest difference of the arrays.
+
+    python scripts/bench_landmark_parsing.py --video assets/pose_ref_video.mp4 --frames 50
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+
+from bench_utils import ROOT
+from mediapipe.framework.formats import classification_pb2, landmark_pb2, matrix_data_pb2
+from mediapipe.python import packet_getter
+from src.utils import face_landmark
+from src.utils.mp_utils import LMKExtractor
+from src.utils.util import read_video_frames
+
+
+def proto_arrays(output_packets):
+    # the original reading of the landmarker output
+    proto = packet_getter.get_proto_list(output_packets[face_landmark._NORM_LANDMARKS_STREAM_NAME])[0]
+    face_landmarks = landmark_pb2.NormalizedLandmarkList()
+    face_landmarks.MergeFrom(proto)
+    landmarks = face_landmarks.landmark
+    lmks = np.fromiter((v for lmk in landmarks for v in (lmk.x, lmk.y, lmk.z)), dtype=np.float64,
+                       count=3 * len(landmarks)).reshape(-1, 3)
+    classifications = classification_pb2.ClassificationList()
+    classifications.MergeFrom(packet_getter.get_proto_list(output_packets[face_landmark._BLENDSHAPES_STREAM_NAME])[0])
+    blendshapes = np.fromiter((c.score for c in classifications.classification), dtype=np.float64,
+                              count=len(classifications.classification))
+    geometry = packet_getter.get_proto_list(output_packets[face_landmark._FACE_GEOMETRY_STREAM_NAME])[0]
+    matrix_data = matrix_data_pb2.MatrixData()
+    matrix_data.MergeFrom(geometry.pose_transform_matrix)
+    matrix = np.array(matrix_data.packed_data).reshape((matrix_data.rows, matrix_data.cols))
+    matrix = matrix if matrix_data.layout == face_landmark._LayoutEnum.ROW_MAJOR else matrix.T
+    mesh = geometry.mesh
+    vertex_buffer = np.fromiter(mesh.vertex_buffer, dtype=np.float64, count=len(mesh.vertex_buffer))
+    return lmks, blendshapes, matrix, vertex_buffer, np.array(mesh.index_buffer)
+
+
+def buffer_arrays(output_packets):
+    result = face_landmark._serialized_landmarker_arrays(output_packets)
+    return result["lmks"], result["blendshapes"], result["trans_mat"], result["vertex_buffer"], result["index_buffer"]
+
+
+def per_frame(fn, packets, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for output_packets in packets:
+            fn(output_packets)
+    return (time.perf_counter() - start) / repeat / len(packets)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--video", default=os.path.join(ROOT, "assets/pose_ref_video.mp4"))
+    parser.add_argument("--frames", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    frames = read_video_frames(args.video, end=args.frames)[..., ::-1]
+    extractor = LMKExtractor()
+
+    # keep the output packets of every frame the landmarker sees
+    packets = []
+    build_arrays = face_landmark._build_landmarker_arrays
+
+    def keep_packets(output_packets):
+        packets.append(output_packets)
+        return build_arrays(output_packets)
+
+    face_landmark._build_landmarker_arrays = keep_packets
+    start = time.perf_counter()
+    for frame in frames:
+        extractor(np.ascontiguousarray(frame))
+    extractor_time = (time.perf_counter() - start) / len(frames)
+    face_landmark._build_landmarker_arrays = build_arrays
+    packets = [p for p in packets if not p[face_landmark._NORM_LANDMARKS_STREAM_NAME].is_empty()]
+    print(f"{len(packets)} frames with a face of {len(frames)}, LMKExtractor call {extractor_time * 1e3:7.3f} ms/frame")
+
+    proto_time = per_frame(proto_arrays, packets, args.repeat)
+    buffer_time = per_frame(buffer_arrays, packets, args.repeat)
+    print(f"proto path       {proto_time * 1e3:7.3f} ms/frame")
+    print(f"buffer path      {buffer_time * 1e3:7.3f} ms/frame   {proto_time / buffer_time:5.1f}x")
+
+    difference = max(max(np.abs(a - b).max() for a, b in zip(proto_arrays(p), buffer_arrays(p))) for p in packets)
+    print(f"max abs difference of lmks, blendshapes, trans_mat, vertex_buffer and index_buffer {difference:g}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Landmark extraction of a driving video: frames per second of LMKExtractorPool in "image" mode (detection on every
+frame) and "video" mode (tracking), in this process and with worker processes, and the deviation of every run's
+landmarks from the in-process "image" mode run, in pixels.
+
+    python scripts/bench_landmarks.py --video assets/pose_ref_video.mp4 --workers 4
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+
+from bench_utils import ROOT
+from src.utils.mp_utils import LMKExtractorPool
+from src.utils.util import get_fps, read_video_frames
+
+
+def deviation(reference, results, size):
+    # per frame mean landmark distance in pixels, over the frames with a face in both
+    both = [(a, b) for a, b in zip(reference, results) if a is not None and b is not None]
+    missed = sum((a is None) != (b is None) for a, b in zip(reference, results))
+    if not both:
+        return np.full(1, np.nan), missed
+    distances = [np.linalg.norm((a["lmks"][:, :2] - b["lmks"][:, :2]) * size, axis=-1).mean() for a, b in both]
+    return np.array(distances), missed
+
+
+def report(name, reference, results, elapsed, startup, size):
+    distances, missed = deviation(reference, results, size)
+    print(f"{name:20s} {len(results) / elapsed:6.1f} frames/s (start up {startup:4.1f} s)   deviation from image mode: mean {distances.mean():6.3f} px  "
+          f"max {distances.max():6.3f} px   face found in one run only: {missed} frames")
+
+
+def run(frames, **kwargs):
+    with LMKExtractorPool(**kwargs) as pool:
+        # starts the workers and loads their models
+        start = time.perf_counter()
+        pool(frames[:1])
+        startup = time.perf_counter() - start
+        start = time.perf_counter()
+        results = pool(frames)
+    return results, time.perf_counter() - start, startup
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--video", default=os.path.join(ROOT, "assets/pose_ref_video.mp4"))
+    parser.add_argument("--frames", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    fps = get_fps(args.video)
+    frames = np.ascontiguousarray(read_video_frames(args.video, end=args.frames)[..., ::-1])
+    size = np.array([frames.shape[2], frames.shape[1]])
+    print(f"{len(frames)} frames of {frames.shape[2]}x{frames.shape[1]} at {fps} fps, {os.cpu_count()} cpus")
+
+    reference, elapsed, startup = run(frames, num_workers=1, FPS=fps, mode="image")
+    report("image, 1 process", reference, reference, elapsed, startup, size)
+    for mode in ("video", "image"):
+        for workers in (1, args.workers):
+            if mode == "image" and workers == 1:
+                continue
+            results, elapsed, startup = run(frames, num_workers=workers, FPS=fps, mode=mode)
+            report(f"{mode}, {workers} process{'es' if workers > 1 else ''}", reference, results, elapsed, startup, size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Pose frame preprocessing of PoseGenVideo on a long driver: the original per-frame path (the unused PIL Resize +
+ToTensor list, a cv2 colour conversion and resize per frame, then one `cond_image_processor.preprocess` call per pose
+image in the pipeline) against `pose_frames_from_images` + `Pose2VideoPipeline.prepare_pose_condition`. Reports the
+time of both and the largest difference of the pose conditions.
+
+    python scripts/bench_pose_preprocessing.py --frames 2000 --source-size 160 --size 192
+"""
+import argparse
+import time
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+from diffusers.image_processor import VaeImageProcessor
+from PIL import Image
+
+from bench_utils import face_landmarks, max_abs_diff
+from src.pipelines.pipeline_pose2vid_long import Pose2VideoPipeline
+from src.utils.draw_util import FaceMeshVisualizer
+from src.utils.util import pose_frames_from_images
+
+
+def per_frame_condition(pose_images, height, width, processor):
+    # the original node code
+    pose_tensor_list = []
+    pose_transform = transforms.Compose([transforms.Resize((height, width)), transforms.ToTensor()])
+    for pose_image_pil in pose_images:
+        pose_image_pil = (pose_image_pil.numpy() * 255).astype(np.uint8)
+        pose_tensor_list.append(pose_transform(Image.fromarray(pose_image_pil)))
+    pose_list = []
+    for pose_image_pil in pose_images:
+        pose_image = (pose_image_pil.numpy() * 255).astype(np.uint8)
+        pose_image_np = cv2.cvtColor(np.array(pose_image), cv2.COLOR_RGB2BGR)
+        pose_image_np = cv2.resize(pose_image_np, (width, height))
+        pose_list.append(pose_image_np)
+    pose_list = np.array(pose_list)
+    del pose_tensor_list
+
+    # the original pipeline code
+    pose_cond_tensor_list = []
+    for pose_image in pose_list:
+        pose_cond_tensor = processor.preprocess(pose_image, height=height, width=width)
+        pose_cond_tensor_list.append(pose_cond_tensor.unsqueeze(2))
+    return torch.cat(pose_cond_tensor_list, dim=2)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=2000)
+    parser.add_argument("--source-size", type=int, default=160, help="size of the IMAGE batch going in")
+    parser.add_argument("--size", type=int, default=192, help="generation size")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    # a 100 frame render of a moving face mesh, repeated to the driver length, as the 0..1 RGB IMAGE batch
+    vis = FaceMeshVisualizer(forehead_edge=False)
+    renders = vis.draw_landmarks_batch(face_landmarks(100), (args.source_size, args.source_size), normed=True)
+    renders = np.ascontiguousarray(renders[..., ::-1])
+    pose_images = torch.from_numpy(np.resize(renders, (args.frames,) + renders.shape[1:])).float() / 255
+
+    processor = VaeImageProcessor(vae_scale_factor=8, do_convert_rgb=True, do_normalize=True)
+    pipe = SimpleNamespace(cond_image_processor=processor)
+    sync = torch.cuda.synchronize if args.device.startswith("cuda") else (lambda: None)
+
+    start = time.perf_counter()
+    reference = per_frame_condition(pose_images, args.size, args.size, processor)
+    per_frame_time = time.perf_counter() - start
+    print(f"per frame path  {per_frame_time:7.2f} s  {args.frames / per_frame_time:8.1f} frames/s")
+
+    start = time.perf_counter()
+    pose_list = pose_frames_from_images(pose_images, args.size, args.size, args.device)
+    condition = Pose2VideoPipeline.prepare_pose_condition(pipe, pose_list, args.size, args.size, args.device, torch.float32)
+    sync()
+    batched_time = time.perf_counter() - start
+    print(f"batched path    {batched_time:7.2f} s  {args.frames / batched_time:8.1f} frames/s  on {args.device}")
+    # the resize is bilinear on both paths but rounds differently, one level on the 0..255 scale is 2 here
+    print(f"max abs difference of the pose condition {max_abs_diff(reference, condition.cpu()):.0f} (2 * pixel - 1 scale)")
+
+
+if __name__ == "__main__":
+    main()
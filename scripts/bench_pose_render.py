@@ -0,0 +1,80 @@
+"""
+Pose image rendering per frame: the original mediapipe path (a NormalizedLandmarkList proto per frame and
+`drawing_utils.draw_landmarks`, one cv2.line per edge), `FaceMeshVisualizer.draw_landmarks` (one cv2.polylines per
+colour), `draw_landmarks_batch` (frames drawn in threads) and `FaceMeshRasterizer` (torch, on --device), with the
+difference of every path's images to the mediapipe ones.
+
+    python scripts/bench_pose_render.py --frames 64 --size 512
+"""
+import argparse
+import os
+import time
+
+import cv2
+import numpy as np
+import torch
+from mediapipe.framework.formats import landmark_pb2
+
+from bench_utils import face_landmarks
+from src.utils.draw_util import FaceMeshVisualizer
+from src.utils.pose_raster import FaceMeshRasterizer
+
+
+def mediapipe_draw(visualizer, image_size, keypoints):
+    # the original draw_landmarks
+    image = np.zeros([512, 512, 3], dtype=np.uint8)
+    new_landmarks = landmark_pb2.NormalizedLandmarkList()
+    for i in range(keypoints.shape[0]):
+        landmark = new_landmarks.landmark.add()
+        landmark.x = keypoints[i, 0]
+        landmark.y = keypoints[i, 1]
+        landmark.z = 1.0
+    visualizer.mp_drawing.draw_landmarks(
+        image=image,
+        landmark_list=new_landmarks,
+        connections=visualizer.face_connection_spec.keys(),
+        landmark_drawing_spec=None,
+        connection_drawing_spec=visualizer.face_connection_spec,
+    )
+    return cv2.resize(image, (image_size[0], image_size[1]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=64)
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    visualizer = FaceMeshVisualizer(forehead_edge=False)
+    rasterizer = FaceMeshRasterizer(visualizer, device=args.device)
+    sync = torch.cuda.synchronize if args.device.startswith("cuda") else (lambda: None)
+    lmks = face_landmarks(args.frames)
+    size = (args.size, args.size)
+
+    def rasterize():
+        images = torch.cat([rasterizer.render(lmks[start: start + 16], size, normed=True) for start in range(0, len(lmks), 16)])
+        sync()
+        return images.permute(0, 2, 3, 1).cpu().numpy()
+
+    runs = [
+        ("mediapipe protos", lambda: np.stack([mediapipe_draw(visualizer, size, k) for k in lmks])),
+        ("draw_landmarks", lambda: np.stack([visualizer.draw_landmarks(size, k, normed=True) for k in lmks])),
+        (f"batch, {min(8, os.cpu_count() or 1)} threads", lambda: visualizer.draw_landmarks_batch(lmks, size, normed=True)),
+        (f"rasterizer, {args.device}", rasterize),
+    ]
+    reference = None
+    for name, run in runs:
+        run()
+        start = time.perf_counter()
+        images = run()
+        elapsed = time.perf_counter() - start
+        if reference is None:
+            reference = images.astype(np.float32)
+        difference = np.abs(images.astype(np.float32) - reference)
+        print(f"{name:22s} {elapsed / len(lmks) * 1e3:8.3f} ms/frame   difference to mediapipe: mean {difference.mean():6.3f}  "
+              f"max {difference.max():5.0f} (0..255)")
+
+
+if __name__ == "__main__":
+    main()
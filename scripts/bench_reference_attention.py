@@ -0,0 +1,73 @@
+"""
+Reference attention: the monkey-patched block forwards of the original ReferenceAttentionControl against the
+reference attention processors, on a tiny random UNet pair on CPU. Reports the largest output difference of the
+denoising UNet and the time per denoising step and per update() + clear().
+
+    python scripts/bench_reference_attention.py --frames 16 --size 128
+"""
+import argparse
+import copy
+
+import torch
+
+from bench_utils import max_abs_diff, timeit, tiny_unets
+from legacy_reference_hooks import ReferenceAttentionControl as LegacyReferenceAttentionControl
+from src.models.mutual_self_attention import ReferenceAttentionControl
+
+
+def run(control_cls, reference_unet, denoising_unet, args):
+    reference_unet = copy.deepcopy(reference_unet)
+    denoising_unet = copy.deepcopy(denoising_unet)
+    writer = control_cls(reference_unet, do_classifier_free_guidance=True, mode="write", fusion_blocks="full")
+    reader = control_cls(denoising_unet, do_classifier_free_guidance=True, mode="read", fusion_blocks="full")
+
+    generator = torch.manual_seed(0)
+    latent = args.size // 8
+    ref_latents = torch.randn(2, 4, latent, latent, generator=generator)
+    latents = torch.randn(2, 4, args.frames, latent, latent, generator=generator)
+    encoder_hidden_states = torch.randn(2, 1, 32, generator=generator)
+    t = torch.tensor(500)
+
+    def reference():
+        writer.clear()
+        reference_unet(ref_latents, torch.zeros_like(t), encoder_hidden_states=encoder_hidden_states, return_dict=False)
+        reader.update(writer, dtype=torch.float32)
+
+    def step():
+        return denoising_unet(latents, t, encoder_hidden_states=encoder_hidden_states, return_dict=False)[0]
+
+    with torch.no_grad():
+        reference()
+        output = step()
+        step_time = timeit(step, repeat=args.repeat)
+
+        def update_clear():
+            reader.update(writer, dtype=torch.float32)
+            reader.clear()
+
+        update_time = timeit(update_clear, repeat=args.repeat * 10)
+        # without reference tokens, to show the comparison covers the reference path
+        no_reference = step()
+    return output, step_time, update_time, no_reference
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=16)
+    parser.add_argument("--size", type=int, default=128, help="pixel size, the latents are 1/8 of it")
+    parser.add_argument("--channels", type=int, default=32)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    reference_unet, denoising_unet = tiny_unets(args.channels)
+    legacy, legacy_step, legacy_update, no_reference = run(LegacyReferenceAttentionControl, reference_unet, denoising_unet, args)
+    processor, processor_step, processor_update, _ = run(ReferenceAttentionControl, reference_unet, denoising_unet, args)
+
+    print(f"max abs output difference: {max_abs_diff(legacy, processor):.3e} "
+          f"(reference attention changes the output by {max_abs_diff(legacy, no_reference):.3e})")
+    print(f"denoising step   hooks {legacy_step * 1000:8.2f} ms   processors {processor_step * 1000:8.2f} ms")
+    print(f"update + clear   hooks {legacy_update * 1000:8.3f} ms   processors {processor_update * 1000:8.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Reference token pooling: latency of a denoising step against its output difference from the unpooled step, for a
+few `reference_token_ratios`, on a tiny random UNet pair on CPU. The default latent size is odd so the pooling
+windows over the bottom and right edges are partial.
+
+    python scripts/bench_reference_pooling.py --size 248 --frames 8
+"""
+import argparse
+
+import torch
+
+from bench_utils import max_abs_diff, timeit, tiny_unets
+from src.models.mutual_self_attention import ReferenceAttentionControl
+
+RATIOS = [
+    {},
+    {0: 2},
+    {0: 2, 1: 2},
+    {0: 4},
+    {0: 4, 1: 2},
+]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=248, help="pixel size, the latents are 1/8 of it")
+    parser.add_argument("--frames", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    reference_unet, denoising_unet = tiny_unets()
+    latent = args.size // 8
+    generator = torch.manual_seed(0)
+    ref_latents = torch.randn(2, 4, latent, latent, generator=generator)
+    latents = torch.randn(2, 4, args.frames, latent, latent, generator=generator)
+    encoder_hidden_states = torch.randn(2, 1, 32, generator=generator)
+    t = torch.tensor(500)
+
+    writer = ReferenceAttentionControl(reference_unet, do_classifier_free_guidance=True, mode="write", fusion_blocks="full")
+    with torch.no_grad():
+        reference_unet(ref_latents, torch.zeros_like(t), encoder_hidden_states=encoder_hidden_states, return_dict=False)
+
+    unpooled = None
+    for ratios in RATIOS:
+        reader = ReferenceAttentionControl(
+            denoising_unet,
+            do_classifier_free_guidance=True,
+            mode="read",
+            fusion_blocks="full",
+            reference_token_ratios=ratios,
+            latent_size=(latent, latent),
+        )
+        reader.update(writer, dtype=torch.float32)
+
+        def step():
+            return denoising_unet(latents, t, encoder_hidden_states=encoder_hidden_states, return_dict=False)[0]
+
+        with torch.no_grad():
+            output = step()
+            step_time = timeit(step, repeat=args.repeat)
+        if unpooled is None:
+            unpooled = output
+        reader.clear()
+        if not ratios:
+            with torch.no_grad():
+                no_reference = step()
+            print(f"reference attention itself changes the output by {max_abs_diff(unpooled, no_reference):.3e}")
+        print(f"ratios {str(ratios):18s} step {step_time * 1000:8.2f} ms   "
+              f"max abs difference {max_abs_diff(unpooled, output):.3e}   "
+              f"mean {(unpooled - output).abs().mean():.3e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Sparse landmark extraction (SparseLMKExtractor, the lmk_every / lmk_motion_threshold inputs) against dense extraction
+of every frame: frames per second, frames the landmarker ran on, the landmark error against the dense run in pixels,
+and the frame where face reenactment stops (the first frame without a face) for both. Frames `--blank` are blacked
+out to lose the face on the way.
+
+    python scripts/bench_sparse_landmarks.py --video assets/pose_ref_video.mp4 --every 2 4 8 --blank 50 62
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+
+from bench_landmarks import deviation
+from bench_utils import ROOT
+from src.utils.mp_utils import LMKExtractorPool, SparseLMKExtractor
+from src.utils.util import get_fps, read_video_frames
+
+
+class CountingExtractor:
+    # counts the frames the landmarker runs on
+    def __init__(self, extractor):
+        self.extractor = extractor
+        self.sequential = extractor.sequential
+        self.frames = 0
+
+    def __call__(self, frames, **kwargs):
+        self.frames += len(frames)
+        return self.extractor(frames, **kwargs)
+
+
+def first_missing(results):
+    return next((idx for idx, result in enumerate(results) if result is None), len(results))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--video", default=os.path.join(ROOT, "assets/pose_ref_video.mp4"))
+    parser.add_argument("--frames", type=int, default=None)
+    parser.add_argument("--every", type=int, nargs="+", default=[2, 4, 8])
+    parser.add_argument("--motion-threshold", type=float, nargs="+", default=[0.0, 0.005])
+    parser.add_argument("--blank", type=int, nargs=2, default=[50, 62], help="frames [start, end) without a face")
+    parser.add_argument("--mode", choices=["image", "video"], default="image")
+    args = parser.parse_args()
+
+    fps = get_fps(args.video)
+    frames = np.ascontiguousarray(read_video_frames(args.video, end=args.frames)[..., ::-1])
+    frames[args.blank[0]: args.blank[1]] = 0
+    size = np.array([frames.shape[2], frames.shape[1]])
+    print(f"{len(frames)} frames of {frames.shape[2]}x{frames.shape[1]}, frames {args.blank[0]}..{args.blank[1] - 1} blank")
+
+    def run(every, motion_threshold):
+        with LMKExtractorPool(num_workers=1, FPS=fps / every, mode=args.mode) as pool:
+            pool(frames[:1])
+            counter = CountingExtractor(pool)
+            start = time.perf_counter()
+            results = SparseLMKExtractor(counter, every=every, motion_threshold=motion_threshold)(frames)
+            return results, time.perf_counter() - start, counter.frames
+
+    dense, elapsed, _ = run(1, 0.0)
+    print(f"dense              {len(frames) / elapsed:6.1f} frames/s   stops at frame {first_missing(dense)}")
+    for every in args.every:
+        for motion_threshold in args.motion_threshold:
+            results, elapsed, extracted = run(every, motion_threshold)
+            distances, missed = deviation(dense, results, size)
+            print(f"every {every} thr {motion_threshold:5.3f} {len(frames) / elapsed:6.1f} frames/s   {extracted:4d} frames extracted   "
+                  f"error mean {distances.mean():6.3f} px max {distances.max():6.3f} px   face in one run only: {missed} frames   "
+                  f"stops at frame {first_missing(results)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""
+Shared helpers of the benchmark scripts: importing the node package sources from a checkout, timing, and a tiny
+randomly initialised AniPortrait pipeline that runs on CPU without any downloaded weights.
+"""
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+import torch
+
+
+def timeit(fn, repeat=5, warmup=1, sync=None):
+    # mean seconds per call of `fn` after `warmup` calls
+    for _ in range(warmup):
+        fn()
+    if sync is not None:
+        sync()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    if sync is not None:
+        sync()
+    return (time.perf_counter() - start) / repeat
+
+
+def max_abs_diff(a, b):
+    return (a.float() - b.float()).abs().max().item()
+
+
+def tiny_unet_config(channels=32):
+    # the pose guider emits (c, 2c, 4c, 4c) features, the UNet blocks have to follow it
+    return dict(
+        sample_size=16,
+        block_out_channels=(channels, channels * 2, channels * 4, channels * 4),
+        layers_per_block=1,
+        cross_attention_dim=32,
+        attention_head_dim=8,
+        norm_num_groups=32,
+    )
+
+
+def tiny_unets(channels=32, seed=0):
+    # reference UNet and a denoising UNet inflated from the same 2D weights, as `from_pretrained_2d` does
+    from omegaconf import OmegaConf
+
+    from src.models.unet_2d_condition import UNet2DConditionModel
+    from src.models.unet_3d import UNet3DConditionModel
+
+    torch.manual_seed(seed)
+    config = tiny_unet_config(channels)
+    reference_unet = UNet2DConditionModel(**config)
+    additional_kwargs = OmegaConf.to_container(
+        OmegaConf.load(os.path.join(ROOT, "configs/inference/inference_v2.yaml")).unet_additional_kwargs
+    )
+    denoising_unet = UNet3DConditionModel(
+        down_block_types=("CrossAttnDownBlock3D",) * 3 + ("DownBlock3D",),
+        up_block_types=("UpBlock3D",) + ("CrossAttnUpBlock3D",) * 3,
+        mid_block_type="UNetMidBlock3DCrossAttn",
+        **config,
+        **additional_kwargs,
+    )
+    denoising_unet.load_state_dict(reference_unet.state_dict(), strict=False)
+    return reference_unet.eval(), denoising_unet.eval()
+
+
+def tiny_pipeline(channels=32, seed=0):
+    from diffusers import AutoencoderKL, DDIMScheduler
+    from transformers import CLIPVisionConfig, CLIPVisionModelWithProjection
+
+    from src.models.pose_guider import PoseGuider
+    from src.pipelines.pipeline_pose2vid_long import Pose2VideoPipeline
+
+    reference_unet, denoising_unet = tiny_unets(channels, seed)
+    torch.manual_seed(seed)
+    vae = AutoencoderKL(
+        down_block_types=("DownEncoderBlock2D",) * 4,
+        up_block_types=("UpDecoderBlock2D",) * 4,
+        block_out_channels=(32,) * 4,
+        layers_per_block=1,
+        latent_channels=4,
+    )
+    image_encoder = CLIPVisionModelWithProjection(
+        CLIPVisionConfig(
+            hidden_size=32,
+            intermediate_size=64,
+            num_hidden_layers=1,
+            num_attention_heads=4,
+            image_size=224,
+            patch_size=32,
+            projection_dim=32,
+        )
+    )
+    pose_guider = PoseGuider(noise_latent_channels=channels, use_ca=True)
+    # the final projection starts at zero, random weights let the pose condition reach the UNet
+    torch.nn.init.normal_(pose_guider.final_proj.weight, std=0.02)
+    scheduler = DDIMScheduler(
+        beta_start=0.00085,
+        beta_end=0.012,
+        beta_schedule="linear",
+        clip_sample=False,
+        steps_offset=1,
+        prediction_type="v_prediction",
+        rescale_betas_zero_snr=True,
+        timestep_spacing="trailing",
+    )
+    pipe = Pose2VideoPipeline(
+        vae=vae.eval(),
+        image_encoder=image_encoder.eval(),
+        reference_unet=reference_unet,
+        denoising_unet=denoising_unet,
+        pose_guider=pose_guider.eval(),
+        scheduler=scheduler,
+    )
+    pipe.set_progress_bar_config(disable=True)
+    return pipe
+
+
+def tiny_inputs(size=128, frames=16):
+    # reference image, pose frames and reference pose of a face mesh moving over `frames` frames
+    import cv2
+    from PIL import Image
+
+    from src.utils.draw_util import FaceMeshVisualizer
+
+    landmarks = face_landmarks(frames)
+    vis = FaceMeshVisualizer(forehead_edge=False)
+    pose_images = vis.draw_landmarks_batch(landmarks, (size, size), normed=True)
+    ref_pose = vis.draw_landmarks((size, size), landmarks[0], normed=True)
+    ref_image = cv2.resize(cv2.imread(os.path.join(ROOT, "assets/woman.jpg"))[..., ::-1], (size, size))
+    return Image.fromarray(ref_image), pose_images, ref_pose
+
+
+_face_landmarks = None
+
+
+def face_landmarks(frames=1, motion=0.004, image="assets/woman.jpg"):
+    r"""
+    (frames, 478, 3) normalised landmarks of the face in `image`, turning and drifting by about `motion` of the frame
+    per frame. Stands in for a tracked driving video.
+    """
+    global _face_landmarks
+    import cv2
+    import numpy as np
+
+    if _face_landmarks is None:
+        from src.utils.mp_utils import LMKExtractor
+
+        _face_landmarks = LMKExtractor()(cv2.imread(os.path.join(ROOT, image)))["lmks"].astype(np.float32)
+    t = np.arange(frames, dtype=np.float32)
+    angle = 0.5 * motion * np.sin(t * 0.3)
+    cos, sin = np.cos(angle)[:, None], np.sin(angle)[:, None]
+    centre = _face_landmarks[:, :2].mean(0)
+    xy = _face_landmarks[None, :, :2] - centre
+    rotated = np.stack([cos * xy[..., 0] - sin * xy[..., 1], sin * xy[..., 0] + cos * xy[..., 1]], -1)
+    drift = motion * np.stack([np.sin(t * 0.2), np.cos(t * 0.25) - 1], -1)[:, None]
+    lmks = np.repeat(_face_landmarks[None], frames, 0)
+    lmks[..., :2] = centre + rotated + drift
+    return lmks
@@ -0,0 +1,67 @@
+"""
+Video output adapter: the per-frame make_grid / uint8 / PIL / np.fromiter path the nodes used to turn the pipeline's
+(b c t h w) video into an IMAGE batch, against `videos_to_images` (float32 and uint8), at 1000 frames on CPU.
+
+    python scripts/bench_video_output.py --frames 1000 --size 256
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+import torchvision
+from einops import rearrange
+from PIL import Image
+
+from bench_utils import max_abs_diff
+from src.utils.util import videos_to_images
+
+
+def per_frame_images(video):
+    # the original node code
+    height, width = video.shape[-2:]
+    outputs = []
+    video = rearrange(video, "b c t h w -> t b c h w")
+    for x in video:
+        x = torchvision.utils.make_grid(x, nrow=1)  # (c h w)
+        x = x.transpose(0, 1).transpose(1, 2).squeeze(-1)  # (h w c)
+        x = (x * 255).numpy().astype(np.uint8)
+        x = Image.fromarray(x)
+        outputs.append(x)
+
+    iterable = (x for x in outputs)
+    return torch.from_numpy(np.fromiter(iterable, np.dtype((np.float32, (height, width, 3))))) / 255.0
+
+
+def timed(fn):
+    start = time.perf_counter()
+    out = fn()
+    return out, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=1000)
+    parser.add_argument("--size", type=int, default=256)
+    args = parser.parse_args()
+
+    video = torch.rand(1, 3, args.frames, args.size, args.size, generator=torch.manual_seed(0))
+
+    reference, reference_time = timed(lambda: per_frame_images(video))
+    print(f"per frame PIL path   {reference_time:7.3f} s  {args.frames / reference_time:9.1f} frames/s")
+    del reference
+
+    images, images_time = timed(lambda: videos_to_images(video))
+    print(f"videos_to_images     {images_time:7.3f} s  {args.frames / images_time:9.1f} frames/s")
+    reference = per_frame_images(video)
+    # the old path truncated to uint8 on the way, the new one keeps the float values
+    print(f"  max abs difference {max_abs_diff(reference, images):.4f} (old path quantised to 1/255 = {1 / 255:.4f})")
+    del images
+
+    images_uint8, uint8_time = timed(lambda: videos_to_images(video, uint8=True))
+    print(f"videos_to_images u8  {uint8_time:7.3f} s  {args.frames / uint8_time:9.1f} frames/s")
+    print(f"  max abs difference {max_abs_diff(reference * 255, images_uint8):.0f} levels of 255")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+import json
+import os
+import time
+from typing import Callable, Dict, Optional
+
+import torch
+import torch.nn.functional as F
+from diffusers.models.attention_processor import Attention
+
+from ..utils.logger import logger
+from .mutual_self_attention import (
+    ReferenceReadAttnProcessor,
+    ReferenceWriteAttnProcessor,
+)
+
+
+def naive_attention(attn, query, key, value, attention_mask=None):
+    attention_probs = attn.get_attention_scores(query, key, attention_mask)
+    return torch.bmm(attention_probs, value)
+
+
+def sliced_attention(attn, query, key, value, attention_mask=None, slice_size=None):
+    # slice over the (batch * heads) dimension
+    slice_size = slice_size or attn.heads
+    batch_size_attention, query_tokens, _ = query.shape
+    hidden_states = torch.zeros(
+        (batch_size_attention, query_tokens, value.shape[-1]),
+        device=query.device,
+        dtype=query.dtype,
+    )
+    for start in range(0, batch_size_attention, slice_size):
+        end = start + slice_size
+        attn_mask_slice = (
+            attention_mask[start:end] if attention_mask is not None else None
+        )
+        attention_probs = attn.get_attention_scores(
+            query[start:end], key[start:end], attn_mask_slice
+        )
+        hidden_states[start:end] = torch.bmm(attention_probs, value[start:end])
+    return hidden_states
+
+
+def chunked_query_attention(
+    attn, query, key, value, attention_mask=None, chunk_size=1024
+):
+    # slice over the query tokens, keys and values are shared by every chunk
+    query_tokens = query.shape[1]
+    if query_tokens <= chunk_size:
+        return naive_attention(attn, query, key, value, attention_mask)
+    hidden_states = torch.empty(
+        (query.shape[0], query_tokens, value.shape[-1]),
+        device=query.device,
+        dtype=query.dtype,
+    )
+    for start in range(0, query_tokens, chunk_size):
+        end = start + chunk_size
+        attn_mask_chunk = attention_mask
+        if attention_mask is not None and attention_mask.shape[1] != 1:
+            attn_mask_chunk = attention_mask[:, start:end]
+        attention_probs = attn.get_attention_scores(
+            query[:, start:end], key, attn_mask_chunk
+        )
+        hidden_states[:, start:end] = torch.bmm(attention_probs, value)
+    return hidden_states
+
+
+def sdpa_attention(attn, query, key, value, attention_mask=None):
+    # (batch * heads, tokens, dim) -> (batch, heads, tokens, dim) so the fused kernels can be picked
+    query, key, value = (x.unflatten(0, (-1, attn.heads)) for x in (query, key, value))
+    if attention_mask is not None:
+        attention_mask = attention_mask.unflatten(0, (-1, attn.heads))
+    hidden_states = F.scaled_dot_product_attention(
+        query, key, value, attn_mask=attention_mask, dropout_p=0.0, scale=attn.scale
+    )
+    return hidden_states.flatten(0, 1)
+
+
+ATTENTION_BACKENDS: Dict[str, Callable] = {
+    "naive": naive_attention,
+    "sliced": sliced_attention,
+    "chunked": chunked_query_attention,
+    "sdpa": sdpa_attention,
+}
+
+
+def get_attention_backend(name: str) -> Callable:
+    if name not in ATTENTION_BACKENDS:
+        raise ValueError(
+            f"Unknown attention backend {name}, expected one of {list(ATTENTION_BACKENDS)} or 'auto'"
+        )
+    return ATTENTION_BACKENDS[name]
+
+
+class AttentionAutotuner:
+    r"""
+    Picks the fastest attention backend per (query tokens, key tokens, heads, head dim, dtype, device) shape by timing
+    every candidate on the first call with that shape. Choices are kept in memory and, when `cache_path` is set,
+    persisted as json so later runs skip the timing.
+    """
+
+    def __init__(self, cache_path=None, backends=None, warmup=1, repeat=3):
+        self.cache_path = cache_path
+        self.backends = list(backends or ATTENTION_BACKENDS)
+        self.warmup = warmup
+        self.repeat = repeat
+        self.choices = {}
+        if cache_path is not None and os.path.isfile(cache_path):
+            with open(cache_path, "r") as f:
+                self.choices = json.load(f)
+
+    @staticmethod
+    def shape_key(attn, query, key):
+        return "{}x{}/{}x{}/{}/{}".format(
+            query.shape[1],
+            key.shape[1],
+            attn.heads,
+            query.shape[-1],
+            str(query.dtype).replace("torch.", ""),
+            query.device.type,
+        )
+
+    def _time(self, backend, attn, query, key, value, attention_mask):
+        def sync():
+            if query.device.type == "cuda":
+                torch.cuda.synchronize(query.device)
+
+        for _ in range(self.warmup):
+            backend(attn, query, key, value, attention_mask)
+        sync()
+        start = time.perf_counter()
+        for _ in range(self.repeat):
+            backend(attn, query, key, value, attention_mask)
+        sync()
+        return (time.perf_counter() - start) / self.repeat
+
+    def select(self, attn, query, key, value, attention_mask=None) -> str:
+        shape_key = self.shape_key(attn, query, key)
+        if shape_key in self.choices:
+            return self.choices[shape_key]
+
+        timings = {}
+        for name in self.backends:
+            try:
+                timings[name] = self._time(
+                    get_attention_backend(name), attn, query, key, value, attention_mask
+                )
+            except RuntimeError as e:
+                # e.g. out of memory for the naive backend or no fused kernel for this dtype
+                logger.debug(f"attention backend {name} failed for {shape_key}: {e}")
+        if not timings:
+            raise RuntimeError(f"No attention backend could run shape {shape_key}")
+
+        choice = min(timings, key=timings.get)
+        logger.info(f"attention autotune {shape_key}: {choice}")
+        self.choices[shape_key] = choice
+        self.save()
+        return choice
+
+    def save(self):
+        if self.cache_path is None:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)), exist_ok=True)
+        with open(self.cache_path, "w") as f:
+            json.dump(self.choices, f, indent=2, sort_keys=True)
+
+
+class BackendAttnProcessor:
+    r"""
+    Attention processor computing the attention product with one of `ATTENTION_BACKENDS`, or with the one the
+    `autotuner` selects for the current shape when `backend` is "auto".
+    """
+
+    def __init__(self, backend="sdpa", autotuner: Optional[AttentionAutotuner] = None):
+        if backend == "auto":
+            if autotuner is None:
+                autotuner = AttentionAutotuner()
+        else:
+            get_attention_backend(backend)
+        self.backend = backend
+        self.autotuner = autotuner
+
+    def __call__(
+        self,
+        attn: Attention,
+        hidden_states: torch.FloatTensor,
+        encoder_hidden_states: Optional[torch.FloatTensor] = None,
+        attention_mask: Optional[torch.FloatTensor] = None,
+        temb: Optional[torch.FloatTensor] = None,
+        **kwargs,
+    ) -> torch.FloatTensor:
+        residual = hidden_states
+
+        if attn.spatial_norm is not None:
+            hidden_states = attn.spatial_norm(hidden_states, temb)
+
+        input_ndim = hidden_states.ndim
+
+        if input_ndim == 4:
+            batch_size, channel, height, width = hidden_states.shape
+            hidden_states = hidden_states.view(
+                batch_size, channel, height * width
+            ).transpose(1, 2)
+
+        batch_size, sequence_length, _ = (
+            hidden_states.shape
+            if encoder_hidden_states is None
+            else encoder_hidden_states.shape
+        )
+        attention_mask = attn.prepare_attention_mask(
+            attention_mask, sequence_length, batch_size
+        )
+
+        if attn.group_norm is not None:
+            hidden_states = attn.group_norm(hidden_states.transpose(1, 2)).transpose(
+                1, 2
+            )
+
+        query = attn.to_q(hidden_states)
+
+        if encoder_hidden_states is None:
+            encoder_hidden_states = hidden_states
+        elif attn.norm_cross:
+            encoder_hidden_states = attn.norm_encoder_hidden_states(
+                encoder_hidden_states
+            )
+
+        key = attn.to_k(encoder_hidden_states)
+        value = attn.to_v(encoder_hidden_states)
+
+        query = attn.head_to_batch_dim(query)
+        key = attn.head_to_batch_dim(key)
+        value = attn.head_to_batch_dim(value)
+
+        backend = self.backend
+        if backend == "auto":
+            backend = self.autotuner.select(attn, query, key, value, attention_mask)
+        hidden_states = get_attention_backend(backend)(
+            attn, query, key, value, attention_mask
+        )
+        hidden_states = attn.batch_to_head_dim(hidden_states)
+
+        # linear proj
+        hidden_states = attn.to_out[0](hidden_states)
+        # dropout
+        hidden_states = attn.to_out[1](hidden_states)
+
+        if input_ndim == 4:
+            hidden_states = hidden_states.transpose(-1, -2).reshape(
+                batch_size, channel, height, width
+            )
+
+        if attn.residual_connection:
+            hidden_states = hidden_states + residual
+
+        hidden_states = hidden_states / attn.rescale_output_factor
+
+        return hidden_states
+
+
+def set_attention_backend(
+    model: torch.nn.Module,
+    backend="sdpa",
+    autotuner: Optional[AttentionAutotuner] = None,
+):
+    r"""
+    Sets a `BackendAttnProcessor` on every attention layer of `model`, spatial, temporal (motion module) and cross
+    attention alike. A reference attention processor already installed on a layer keeps wrapping the new backend.
+    """
+    if backend == "auto" and autotuner is None:
+        autotuner = AttentionAutotuner()
+    processor = BackendAttnProcessor(backend, autotuner=autotuner)
+    for module in model.modules():
+        if not isinstance(module, Attention):
+            continue
+        if isinstance(
+            module.processor, (ReferenceWriteAttnProcessor, ReferenceReadAttnProcessor)
+        ):
+            module.processor.processor = processor
+        else:
+            module.set_processor(processor)
@@ -83,8 +83,12 @@ class VanillaTemporalModule(nn.Module):
         anchor_frame_idx=None,
     ):
         hidden_states = input_tensor
+        video_length = None
+        if hidden_states.dim() == 4:
+            # folded (b f) c h w layout, temb has one row per video
+            video_length = hidden_states.shape[0] // temb.shape[0]
         hidden_states = self.temporal_transformer(
-            hidden_states, encoder_hidden_states, attention_mask
+            hidden_states, encoder_hidden_states, attention_mask, video_length
         )
 
         output = hidden_states
@@ -143,21 +147,38 @@ class TemporalTransformer3DModel(nn.Module):
         )
         self.proj_out = nn.Linear(inner_dim, in_channels)
 
-    def forward(self, hidden_states, encoder_hidden_states=None, attention_mask=None):
-        assert (
-            hidden_states.dim() == 5
-        ), f"Expected hidden_states to have ndim=5, but got ndim={hidden_states.dim()}."
-        video_length = hidden_states.shape[2]
-        hidden_states = rearrange(hidden_states, "b c f h w -> (b f) c h w")
+    def forward(
+        self,
+        hidden_states,
+        encoder_hidden_states=None,
+        attention_mask=None,
+        video_length=None,
+    ):
+        assert hidden_states.dim() in (
+            4,
+            5,
+        ), f"Expected hidden_states to have ndim=4 or 5, but got ndim={hidden_states.dim()}."
+        folded = hidden_states.dim() == 4
+        if folded:
+            assert video_length is not None, "video_length is required for folded (b f) c h w input"
+        else:
+            video_length = hidden_states.shape[2]
+            hidden_states = rearrange(hidden_states, "b c f h w -> (b f) c h w")
 
         batch, channel, height, weight = hidden_states.shape
         residual = hidden_states
 
         hidden_states = self.norm(hidden_states)
         inner_dim = hidden_states.shape[1]
-        hidden_states = hidden_states.permute(0, 2, 3, 1).reshape(
-            batch, height * weight, inner_dim
-        )
+        if folded:
+            # straight to the (b h w) f c layout of the temporal attention, one permute each way
+            hidden_states = rearrange(
+                hidden_states, "(b f) c h w -> (b h w) f c", f=video_length
+            )
+        else:
+            hidden_states = hidden_states.permute(0, 2, 3, 1).reshape(
+                batch, height * weight, inner_dim
+            )
         hidden_states = self.proj_in(hidden_states)
 
         # Transformer Blocks
@@ -166,18 +187,25 @@ class TemporalTransformer3DModel(nn.Module):
                 hidden_states,
                 encoder_hidden_states=encoder_hidden_states,
                 video_length=video_length,
+                temporal_layout=folded,
             )
 
         # output
         hidden_states = self.proj_out(hidden_states)
-        hidden_states = (
-            hidden_states.reshape(batch, height, weight, inner_dim)
-            .permute(0, 3, 1, 2)
-            .contiguous()
-        )
+        if folded:
+            hidden_states = rearrange(
+                hidden_states, "(b h w) f c -> (b f) c h w", h=height, w=weight
+            )
+        else:
+            hidden_states = (
+                hidden_states.reshape(batch, height, weight, inner_dim)
+                .permute(0, 3, 1, 2)
+                .contiguous()
+            )
 
         output = hidden_states + residual
-        output = rearrange(output, "(b f) c h w -> b c f h w", f=video_length)
+        if not folded:
+            output = rearrange(output, "(b f) c h w -> b c f h w", f=video_length)
 
         return output
 
@@ -239,6 +267,7 @@ class TemporalTransformerBlock(nn.Module):
         encoder_hidden_states=None,
         attention_mask=None,
         video_length=None,
+        temporal_layout=False,
     ):
         for attention_block, norm in zip(self.attention_blocks, self.norms):
             norm_hidden_states = norm(hidden_states)
@@ -249,6 +278,7 @@ class TemporalTransformerBlock(nn.Module):
                     if attention_block.is_cross_attention
                     else None,
                     video_length=video_length,
+                    temporal_layout=temporal_layout,
                 )
                 + hidden_states
             )
@@ -354,9 +384,20 @@ class VersatileAttention(Attention):
         encoder_hidden_states=None,
         attention_mask=None,
         video_length=None,
+        temporal_layout=False,
         **cross_attention_kwargs,
     ):
-        if self.attention_mode == "Temporal":
+        if self.attention_mode == "Temporal" and temporal_layout:
+            # the caller already hands over (b d) f c tokens
+            if encoder_hidden_states is not None:
+                d = hidden_states.shape[0] // encoder_hidden_states.shape[0]
+                encoder_hidden_states = repeat(
+                    encoder_hidden_states, "b n c -> (b d) n c", d=d
+                )
+            if self.pos_encoder is not None:
+                hidden_states = self.pos_encoder(hidden_states)
+
+        elif self.attention_mode == "Temporal":
             d = hidden_states.shape[1]  # d means HxW
             hidden_states = rearrange(
                 hidden_states, "(b f) d c -> (b d) f c", f=video_length
@@ -382,7 +423,7 @@ class VersatileAttention(Attention):
             **cross_attention_kwargs,
         )
 
-        if self.attention_mode == "Temporal":
+        if self.attention_mode == "Temporal" and not temporal_layout:
             hidden_states = rearrange(hidden_states, "(b d) f c -> (b f) d c", d=d)
 
         return hidden_states
@@ -1,8 +1,9 @@
 # Adapted from https://github.com/magic-research/magic-animate/blob/main/magicanimate/models/mutual_self_attention.py
-from typing import Any, Dict, Optional
+import math
+from typing import Dict, Optional, Tuple
 
 import torch
-from einops import rearrange
+import torch.nn.functional as F
 
 from .attention import TemporalBasicTransformerBlock
 
@@ -16,6 +17,92 @@ def torch_dfs(model: torch.nn.Module):
     return result
 
 
+class ReferenceWriteAttnProcessor:
+    r"""
+    Self-attention processor for the reference UNet. Stores the normalized hidden states of every call in `bank`
+    and otherwise defers to the wrapped processor.
+    """
+
+    def __init__(self, processor):
+        self.processor = processor
+        self.bank = []
+
+    def __call__(
+        self,
+        attn,
+        hidden_states: torch.FloatTensor,
+        encoder_hidden_states: Optional[torch.FloatTensor] = None,
+        attention_mask: Optional[torch.FloatTensor] = None,
+        **kwargs,
+    ):
+        self.bank.append(hidden_states.clone())
+        return self.processor(
+            attn,
+            hidden_states,
+            encoder_hidden_states=encoder_hidden_states,
+            attention_mask=attention_mask,
+            **kwargs,
+        )
+
+
+class ReferenceReadAttnProcessor:
+    r"""
+    Self-attention processor for the denoising UNet. Attends over the frame tokens concatenated with the reference
+    tokens in `bank`. With classifier free guidance the unconditional half attends over its own tokens only.
+
+    `bank_areas` holds, per bank entry, None or a (l,) tensor of how many original reference tokens each pooled bank
+    token stands for. Pooled entries get a log(area) bias on their keys so they keep the attention mass of the tokens
+    they replace.
+    """
+
+    def __init__(self, processor, do_classifier_free_guidance=False):
+        self.processor = processor
+        self.do_classifier_free_guidance = do_classifier_free_guidance
+        self.bank = []
+        self.bank_areas = []
+
+    def __call__(
+        self,
+        attn,
+        hidden_states: torch.FloatTensor,
+        encoder_hidden_states: Optional[torch.FloatTensor] = None,
+        attention_mask: Optional[torch.FloatTensor] = None,
+        **kwargs,
+    ):
+        # bank entries are (b, l, c), hidden states are ((b f), l, c)
+        bank_fea = [
+            d.repeat_interleave(hidden_states.shape[0] // d.shape[0], dim=0)
+            for d in self.bank
+        ]
+        modify_norm_hidden_states = torch.cat([hidden_states] + bank_fea, dim=1)
+        reference_mask = attention_mask
+        if any(area is not None for area in self.bank_areas):
+            reference_mask = torch.cat(
+                [hidden_states.new_zeros(hidden_states.shape[1])]
+                + [
+                    d.new_zeros(d.shape[1]) if area is None else area.log().to(d)
+                    for d, area in zip(self.bank, self.bank_areas)
+                ]
+            ).expand(hidden_states.shape[0], 1, -1)
+            if attention_mask is not None:
+                reference_mask = reference_mask + attention_mask
+        output = self.processor(
+            attn,
+            hidden_states,
+            encoder_hidden_states=modify_norm_hidden_states,
+            attention_mask=reference_mask,
+        )
+        if self.do_classifier_free_guidance:
+            uc = hidden_states.shape[0] // 2
+            output[:uc] = self.processor(
+                attn,
+                hidden_states[:uc],
+                encoder_hidden_states=hidden_states[:uc],
+                attention_mask=attention_mask,
+            )
+        return output
+
+
 class ReferenceAttentionControl:
     def __init__(
         self,
@@ -29,6 +116,8 @@ class ReferenceAttentionControl:
         reference_adain=False,
         fusion_blocks="midup",
         batch_size=1,
+        reference_token_ratios: Optional[Dict[int, int]] = None,
+        latent_size: Optional[Tuple[int, int]] = None,
     ) -> None:
         # 10. Modify self attention and group norm
         self.unet = unet
@@ -37,6 +126,11 @@ class ReferenceAttentionControl:
         self.reference_attn = reference_attn
         self.reference_adain = reference_adain
         self.fusion_blocks = fusion_blocks
+        # {resolution level: pooling size}, level 0 is the latent resolution, every level halves it
+        self.reference_token_ratios = reference_token_ratios or {}
+        self.latent_size = latent_size
+        self.attn_modules = []
+        self.attn_processors = []
         self.register_reference_hooks(
             mode,
             do_classifier_free_guidance,
@@ -45,8 +139,8 @@ class ReferenceAttentionControl:
             style_fidelity,
             reference_attn,
             reference_adain,
-            fusion_blocks,
             batch_size=batch_size,
+            fusion_blocks=fusion_blocks,
         )
 
     def register_reference_hooks(
@@ -64,300 +158,80 @@ class ReferenceAttentionControl:
         device=torch.device("cpu"),
         fusion_blocks="midup",
     ):
-        MODE = mode
-        do_classifier_free_guidance = do_classifier_free_guidance
-        attention_auto_machine_weight = attention_auto_machine_weight
-        gn_auto_machine_weight = gn_auto_machine_weight
-        style_fidelity = style_fidelity
-        reference_attn = reference_attn
-        reference_adain = reference_adain
-        fusion_blocks = fusion_blocks
-        num_images_per_prompt = num_images_per_prompt
-        dtype = dtype
-        if do_classifier_free_guidance:
-            uc_mask = (
-                torch.Tensor(
-                    [1] * batch_size * num_images_per_prompt * 16
-                    + [0] * batch_size * num_images_per_prompt * 16
-                )
-                .to(device)
-                .bool()
-            )
-        else:
-            uc_mask = (
-                torch.Tensor([0] * batch_size * num_images_per_prompt * 2)
-                .to(device)
-                .bool()
-            )
-
-        def hacked_basic_transformer_inner_forward(
-            self,
-            hidden_states: torch.FloatTensor,
-            attention_mask: Optional[torch.FloatTensor] = None,
-            encoder_hidden_states: Optional[torch.FloatTensor] = None,
-            encoder_attention_mask: Optional[torch.FloatTensor] = None,
-            timestep: Optional[torch.LongTensor] = None,
-            cross_attention_kwargs: Dict[str, Any] = None,
-            class_labels: Optional[torch.LongTensor] = None,
-            video_length=None,
-        ):
-            if self.use_ada_layer_norm:  # False
-                norm_hidden_states = self.norm1(hidden_states, timestep)
-            elif self.use_ada_layer_norm_zero:
-                (
-                    norm_hidden_states,
-                    gate_msa,
-                    shift_mlp,
-                    scale_mlp,
-                    gate_mlp,
-                ) = self.norm1(
-                    hidden_states,
-                    timestep,
-                    class_labels,
-                    hidden_dtype=hidden_states.dtype,
-                )
-            else:
-                norm_hidden_states = self.norm1(hidden_states)
+        if not reference_attn:
+            return
+
+        if fusion_blocks == "midup":
+            modules = torch_dfs(self.unet.mid_block) + torch_dfs(self.unet.up_blocks)
+        elif fusion_blocks == "full":
+            modules = torch_dfs(self.unet)
+        attn_modules = [
+            module
+            for module in modules
+            if isinstance(module, (BasicTransformerBlock, TemporalBasicTransformerBlock))
+            and not module.only_cross_attention
+        ]
+        # the block lists of the reader and the writer are paired by position in update()
+        self.attn_modules = sorted(
+            attn_modules, key=lambda x: -x.norm1.normalized_shape[0]
+        )
 
-            # 1. Self-Attention
-            # self.only_cross_attention = False
-            cross_attention_kwargs = (
-                cross_attention_kwargs if cross_attention_kwargs is not None else {}
-            )
-            if self.only_cross_attention:
-                attn_output = self.attn1(
-                    norm_hidden_states,
-                    encoder_hidden_states=encoder_hidden_states
-                    if self.only_cross_attention
-                    else None,
-                    attention_mask=attention_mask,
-                    **cross_attention_kwargs,
-                )
+        for module in self.attn_modules:
+            processor = module.attn1.processor
+            if isinstance(
+                processor, (ReferenceWriteAttnProcessor, ReferenceReadAttnProcessor)
+            ):
+                processor = processor.processor
+            if mode == "write":
+                processor = ReferenceWriteAttnProcessor(processor)
             else:
-                if MODE == "write":
-                    self.bank.append(norm_hidden_states.clone())
-                    attn_output = self.attn1(
-                        norm_hidden_states,
-                        encoder_hidden_states=encoder_hidden_states
-                        if self.only_cross_attention
-                        else None,
-                        attention_mask=attention_mask,
-                        **cross_attention_kwargs,
-                    )
-                if MODE == "read":
-                    bank_fea = [
-                        rearrange(
-                            d.unsqueeze(1).repeat(1, video_length, 1, 1),
-                            "b t l c -> (b t) l c",
-                        )
-                        for d in self.bank
-                    ]
-                    modify_norm_hidden_states = torch.cat(
-                        [norm_hidden_states] + bank_fea, dim=1
-                    )
-                    hidden_states_uc = (
-                        self.attn1(
-                            norm_hidden_states,
-                            encoder_hidden_states=modify_norm_hidden_states,
-                            attention_mask=attention_mask,
-                        )
-                        + hidden_states
-                    )
-                    if do_classifier_free_guidance:
-                        hidden_states_c = hidden_states_uc.clone()
-                        _uc_mask = uc_mask.clone()
-                        if hidden_states.shape[0] != _uc_mask.shape[0]:
-                            _uc_mask = (
-                                torch.Tensor(
-                                    [1] * (hidden_states.shape[0] // 2)
-                                    + [0] * (hidden_states.shape[0] // 2)
-                                )
-                                .to(device)
-                                .bool()
-                            )
-                        hidden_states_c[_uc_mask] = (
-                            self.attn1(
-                                norm_hidden_states[_uc_mask],
-                                encoder_hidden_states=norm_hidden_states[_uc_mask],
-                                attention_mask=attention_mask,
-                            )
-                            + hidden_states[_uc_mask]
-                        )
-                        hidden_states = hidden_states_c.clone()
-                    else:
-                        hidden_states = hidden_states_uc
-
-                    # self.bank.clear()
-                    if self.attn2 is not None:
-                        # Cross-Attention
-                        norm_hidden_states = (
-                            self.norm2(hidden_states, timestep)
-                            if self.use_ada_layer_norm
-                            else self.norm2(hidden_states)
-                        )
-                        hidden_states = (
-                            self.attn2(
-                                norm_hidden_states,
-                                encoder_hidden_states=encoder_hidden_states,
-                                attention_mask=attention_mask,
-                            )
-                            + hidden_states
-                        )
-
-                    # Feed-forward
-                    hidden_states = self.ff(self.norm3(hidden_states)) + hidden_states
-
-                    # Temporal-Attention
-                    if self.unet_use_temporal_attention:
-                        d = hidden_states.shape[1]
-                        hidden_states = rearrange(
-                            hidden_states, "(b f) d c -> (b d) f c", f=video_length
-                        )
-                        norm_hidden_states = (
-                            self.norm_temp(hidden_states, timestep)
-                            if self.use_ada_layer_norm
-                            else self.norm_temp(hidden_states)
-                        )
-                        hidden_states = (
-                            self.attn_temp(norm_hidden_states) + hidden_states
-                        )
-                        hidden_states = rearrange(
-                            hidden_states, "(b d) f c -> (b f) d c", d=d
-                        )
-
-                    return hidden_states
-
-            if self.use_ada_layer_norm_zero:
-                attn_output = gate_msa.unsqueeze(1) * attn_output
-            hidden_states = attn_output + hidden_states
-
-            if self.attn2 is not None:
-                norm_hidden_states = (
-                    self.norm2(hidden_states, timestep)
-                    if self.use_ada_layer_norm
-                    else self.norm2(hidden_states)
-                )
-
-                # 2. Cross-Attention
-                attn_output = self.attn2(
-                    norm_hidden_states,
-                    encoder_hidden_states=encoder_hidden_states,
-                    attention_mask=encoder_attention_mask,
-                    **cross_attention_kwargs,
-                )
-                hidden_states = attn_output + hidden_states
-
-            # 3. Feed-forward
-            norm_hidden_states = self.norm3(hidden_states)
-
-            if self.use_ada_layer_norm_zero:
-                norm_hidden_states = (
-                    norm_hidden_states * (1 + scale_mlp[:, None]) + shift_mlp[:, None]
+                processor = ReferenceReadAttnProcessor(
+                    processor,
+                    do_classifier_free_guidance=do_classifier_free_guidance,
                 )
-
-            ff_output = self.ff(norm_hidden_states)
-
-            if self.use_ada_layer_norm_zero:
-                ff_output = gate_mlp.unsqueeze(1) * ff_output
-
-            hidden_states = ff_output + hidden_states
-
-            return hidden_states
-
-        if self.reference_attn:
-            if self.fusion_blocks == "midup":
-                attn_modules = [
-                    module
-                    for module in (
-                        torch_dfs(self.unet.mid_block) + torch_dfs(self.unet.up_blocks)
-                    )
-                    if isinstance(module, BasicTransformerBlock)
-                    or isinstance(module, TemporalBasicTransformerBlock)
-                ]
-            elif self.fusion_blocks == "full":
-                attn_modules = [
-                    module
-                    for module in torch_dfs(self.unet)
-                    if isinstance(module, BasicTransformerBlock)
-                    or isinstance(module, TemporalBasicTransformerBlock)
-                ]
-            attn_modules = sorted(
-                attn_modules, key=lambda x: -x.norm1.normalized_shape[0]
-            )
-
-            for i, module in enumerate(attn_modules):
-                module._original_inner_forward = module.forward
-                if isinstance(module, BasicTransformerBlock):
-                    module.forward = hacked_basic_transformer_inner_forward.__get__(
-                        module, BasicTransformerBlock
-                    )
-                if isinstance(module, TemporalBasicTransformerBlock):
-                    module.forward = hacked_basic_transformer_inner_forward.__get__(
-                        module, TemporalBasicTransformerBlock
-                    )
-
-                module.bank = []
-                module.attn_weight = float(i) / float(len(attn_modules))
+            module.attn1.set_processor(processor)
+            self.attn_processors.append(processor)
+
+    def pool_reference_tokens(self, bank):
+        r"""
+        Average pools the (b, h*w, c) reference tokens of `bank` over `reference_token_ratios[level]` sized windows.
+        Returns the pooled tokens and the (l,) number of original tokens per pooled token, None when not pooled.
+        """
+        if not self.reference_token_ratios or self.latent_size is None:
+            return bank, None
+
+        height, width = self.latent_size
+        for level in range(4):
+            if height * width == bank.shape[1]:
+                break
+            height, width = math.ceil(height / 2), math.ceil(width / 2)
+        else:
+            return bank, None
+
+        ratio = self.reference_token_ratios.get(level, 1)
+        if ratio <= 1:
+            return bank, None
+        b, _, c = bank.shape
+        pooled = F.avg_pool2d(
+            bank.transpose(1, 2).reshape(b, c, height, width), ratio, ceil_mode=True
+        )
+        # windows over the bottom and right edges cover fewer than ratio * ratio tokens
+        area = F.avg_pool2d(
+            bank.new_ones((1, 1, height, width), dtype=torch.float32),
+            ratio,
+            ceil_mode=True,
+            divisor_override=1,
+        )
+        return pooled.flatten(2).transpose(1, 2), area.flatten()
 
     def update(self, writer, dtype=torch.float16):
-        if self.reference_attn:
-            if self.fusion_blocks == "midup":
-                reader_attn_modules = [
-                    module
-                    for module in (
-                        torch_dfs(self.unet.mid_block) + torch_dfs(self.unet.up_blocks)
-                    )
-                    if isinstance(module, TemporalBasicTransformerBlock)
-                ]
-                writer_attn_modules = [
-                    module
-                    for module in (
-                        torch_dfs(writer.unet.mid_block)
-                        + torch_dfs(writer.unet.up_blocks)
-                    )
-                    if isinstance(module, BasicTransformerBlock)
-                ]
-            elif self.fusion_blocks == "full":
-                reader_attn_modules = [
-                    module
-                    for module in torch_dfs(self.unet)
-                    if isinstance(module, TemporalBasicTransformerBlock)
-                ]
-                writer_attn_modules = [
-                    module
-                    for module in torch_dfs(writer.unet)
-                    if isinstance(module, BasicTransformerBlock)
-                ]
-            reader_attn_modules = sorted(
-                reader_attn_modules, key=lambda x: -x.norm1.normalized_shape[0]
-            )
-            writer_attn_modules = sorted(
-                writer_attn_modules, key=lambda x: -x.norm1.normalized_shape[0]
-            )
-            for r, w in zip(reader_attn_modules, writer_attn_modules):
-                r.bank = [v.clone().to(dtype) for v in w.bank]
-                # w.bank.clear()
+        for r, w in zip(self.attn_processors, writer.attn_processors):
+            pooled = [self.pool_reference_tokens(v) for v in w.bank]
+            r.bank = [v.to(dtype=dtype, copy=True) for v, _ in pooled]
+            r.bank_areas = [area for _, area in pooled]
 
     def clear(self):
-        if self.reference_attn:
-            if self.fusion_blocks == "midup":
-                reader_attn_modules = [
-                    module
-                    for module in (
-                        torch_dfs(self.unet.mid_block) + torch_dfs(self.unet.up_blocks)
-                    )
-                    if isinstance(module, BasicTransformerBlock)
-                    or isinstance(module, TemporalBasicTransformerBlock)
-                ]
-            elif self.fusion_blocks == "full":
-                reader_attn_modules = [
-                    module
-                    for module in torch_dfs(self.unet)
-                    if isinstance(module, BasicTransformerBlock)
-                    or isinstance(module, TemporalBasicTransformerBlock)
-                ]
-            reader_attn_modules = sorted(
-                reader_attn_modules, key=lambda x: -x.norm1.normalized_shape[0]
-            )
-            for r in reader_attn_modules:
-                r.bank.clear()
+        for processor in self.attn_processors:
+            processor.bank.clear()
+            if isinstance(processor, ReferenceReadAttnProcessor):
+                processor.bank_areas.clear()
@@ -93,6 +93,9 @@ class PoseGuider(ModelMixin):
 
         self.scale = nn.Parameter(torch.ones(1) * 2)
 
+        # return the features as (b f) c h w for a denoising UNet running in the folded layout
+        self.folded_output = False
+
     # def _initialize_weights(self):
     #     # Initialize weights with Gaussian distribution and zero out the final layer
     #     for m in self.conv_layers:
@@ -124,13 +127,18 @@ class PoseGuider(ModelMixin):
     def forward(self, x, ref_x):
         fea = []
         b = x.shape[0]
+
+        def unfold(x):
+            if self.folded_output:
+                return x
+            return rearrange(x, "(b f) c h w -> b c f h w", b=b)
         
         x = rearrange(x, "b c f h w -> (b f) c h w")
         x = self.conv_layers(x)
         x = self.final_proj(x)
         x = x * self.scale
         # x = rearrange(x, "(b f) c h w -> b c f h w", b=b)
-        fea.append(rearrange(x, "(b f) c h w -> b c f h w", b=b))
+        fea.append(unfold(x))
         
         x = self.conv_layers_1(x)
         if self.use_ca:
@@ -139,25 +147,25 @@ class PoseGuider(ModelMixin):
             ref_x = ref_x * self.scale
             ref_x = self.conv_layers_1(ref_x)
             x = self.cross_attn1(x, ref_x)
-        fea.append(rearrange(x, "(b f) c h w -> b c f h w", b=b))
+        fea.append(unfold(x))
         
         x = self.conv_layers_2(x)
         if self.use_ca:
             ref_x = self.conv_layers_2(ref_x)
             x = self.cross_attn2(x, ref_x)
-        fea.append(rearrange(x, "(b f) c h w -> b c f h w", b=b))
+        fea.append(unfold(x))
         
         x = self.conv_layers_3(x)
         if self.use_ca:
             ref_x = self.conv_layers_3(ref_x)
             x = self.cross_attn3(x, ref_x)
-        fea.append(rearrange(x, "(b f) c h w -> b c f h w", b=b))
+        fea.append(unfold(x))
         
         x = self.conv_layers_4(x)
         if self.use_ca:
             ref_x = self.conv_layers_4(ref_x)
             x = self.cross_attn4(x, ref_x)
-        fea.append(rearrange(x, "(b f) c h w -> b c f h w", b=b))
+        fea.append(unfold(x))
 
         return fea
 
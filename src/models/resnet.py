@@ -9,6 +9,10 @@ from typing import Dict, Optional
 
 class InflatedConv3d(nn.Conv2d):
     def forward(self, x):
+        # already folded to (b f) c h w, see UNet3DConditionModel.enable_folded_layout
+        if x.ndim == 4:
+            return super().forward(x)
+
         video_length = x.shape[2]
 
         x = rearrange(x, "b c f h w -> (b f) c h w")
@@ -20,6 +24,9 @@ class InflatedConv3d(nn.Conv2d):
 
 class InflatedGroupNorm(nn.GroupNorm):
     def forward(self, x):
+        if x.ndim == 4:
+            return super().forward(x)
+
         video_length = x.shape[2]
 
         x = rearrange(x, "b c f h w -> (b f) c h w")
@@ -70,7 +77,9 @@ class Upsample3D(nn.Module):
         # size and do not make use of `scale_factor=2`
         if output_size is None:
             hidden_states = F.interpolate(
-                hidden_states, scale_factor=[1.0, 2.0, 2.0], mode="nearest"
+                hidden_states,
+                scale_factor=[1.0, 2.0, 2.0] if hidden_states.ndim == 5 else 2.0,
+                mode="nearest",
             )
         else:
             hidden_states = F.interpolate(
@@ -224,7 +233,21 @@ class ResnetBlock3D(nn.Module):
         hidden_states = self.conv1(hidden_states)
 
         if temb is not None:
-            temb = self.time_emb_proj(self.nonlinearity(temb))[:, :, None, None, None]
+            temb = self.time_emb_proj(self.nonlinearity(temb))
+            if hidden_states.ndim == 4 and self.time_embedding_norm == "default":
+                # folded (b f) c h w layout, broadcast over the frames of a view instead of repeating temb
+                hidden_states = (
+                    hidden_states.unflatten(0, (temb.shape[0], -1))
+                    + temb[:, None, :, None, None]
+                ).flatten(0, 1)
+                temb = None
+            elif hidden_states.ndim == 4:
+                # folded (b f) c h w layout, one embedding per frame
+                temb = temb.repeat_interleave(
+                    hidden_states.shape[0] // temb.shape[0], dim=0
+                )[:, :, None, None]
+            else:
+                temb = temb[:, :, None, None, None]
 
         if temb is not None and self.time_embedding_norm == "default":
             hidden_states = hidden_states + temb
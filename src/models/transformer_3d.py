@@ -106,13 +106,21 @@ class Transformer3DModel(ModelMixin, ConfigMixin):
         encoder_hidden_states=None,
         timestep=None,
         return_dict: bool = True,
+        video_length=None,
     ):
         # Input
-        assert (
-            hidden_states.dim() == 5
-        ), f"Expected hidden_states to have ndim=5, but got ndim={hidden_states.dim()}."
-        video_length = hidden_states.shape[2]
-        hidden_states = rearrange(hidden_states, "b c f h w -> (b f) c h w")
+        assert hidden_states.dim() in (
+            4,
+            5,
+        ), f"Expected hidden_states to have ndim=4 or 5, but got ndim={hidden_states.dim()}."
+        folded = hidden_states.dim() == 4
+        if folded:
+            # already (b f) c h w, the caller keeps the folded layout
+            if video_length is None:
+                video_length = hidden_states.shape[0] // encoder_hidden_states.shape[0]
+        else:
+            video_length = hidden_states.shape[2]
+            hidden_states = rearrange(hidden_states, "b c f h w -> (b f) c h w")
         if encoder_hidden_states.shape[0] != hidden_states.shape[0]:
             encoder_hidden_states = repeat(
                 encoder_hidden_states, "b n c -> (b f) n c", f=video_length
@@ -162,7 +170,8 @@ class Transformer3DModel(ModelMixin, ConfigMixin):
 
         output = hidden_states + residual
 
-        output = rearrange(output, "(b f) c h w -> b c f h w", f=video_length)
+        if not folded:
+            output = rearrange(output, "(b f) c h w -> b c f h w", f=video_length)
         if not return_dict:
             return (output,)
 
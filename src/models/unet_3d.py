@@ -16,6 +16,7 @@ from diffusers.models.attention_processor import AttentionProcessor
 from diffusers.models.embeddings import TimestepEmbedding, Timesteps
 from diffusers.models.modeling_utils import ModelMixin
 from diffusers.utils import SAFETENSORS_WEIGHTS_NAME, WEIGHTS_NAME, BaseOutput, logging
+from einops import rearrange
 from safetensors.torch import load_file
 
 from .resnet import InflatedConv3d, InflatedGroupNorm
@@ -251,6 +252,8 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin):
             block_out_channels[0], out_channels, kernel_size=3, padding=1
         )
 
+        self.folded_layout = False
+
     @property
     # Copied from diffusers.models.unet_2d_condition.UNet2DConditionModel.attn_processors
     def attn_processors(self) -> Dict[str, AttentionProcessor]:
@@ -357,6 +360,18 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin):
         if hasattr(module, "gradient_checkpointing"):
             module.gradient_checkpointing = value
 
+    def enable_folded_layout(self, enabled: bool = True):
+        r"""
+        Keeps activations folded as (batch * frames, channel, height, width) from `conv_in` to `conv_out` instead of
+        rearranging between `b c f h w` and `(b f) c h w` around every inflated conv, group norm and transformer.
+        Only the temporal attention still permutes, to `(b h w) f c`. `pose_cond_fea` may be passed folded too.
+        """
+        if enabled and not self.config.use_inflated_groupnorm:
+            raise ValueError(
+                "The folded layout requires `use_inflated_groupnorm`, a plain GroupNorm normalizes over all frames."
+            )
+        self.folded_layout = enabled
+
     # Copied from diffusers.models.unet_2d_condition.UNet2DConditionModel.set_attn_processor
     def set_attn_processor(
         self, processor: Union[AttentionProcessor, Dict[str, AttentionProcessor]]
@@ -407,6 +422,9 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin):
         down_block_additional_residuals: Optional[Tuple[torch.Tensor]] = None,
         mid_block_additional_residual: Optional[torch.Tensor] = None,
         return_dict: bool = True,
+        deep_cache: Optional[Dict[str, torch.Tensor]] = None,
+        deep_cache_depth: int = 1,
+        reuse_deep_cache: bool = False,
     ) -> Union[UNet3DConditionOutput, Tuple]:
         r"""
         Args:
@@ -415,6 +433,14 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin):
             encoder_hidden_states (`torch.FloatTensor`): (batch, sequence_length, feature_dim) encoder hidden states
             return_dict (`bool`, *optional*, defaults to `True`):
                 Whether or not to return a [`models.unet_2d_condition.UNet2DConditionOutput`] instead of a plain tuple.
+            deep_cache (`dict`, *optional*):
+                Caller owned feature cache. A full forward stores the input of the last `deep_cache_depth` up blocks
+                in it.
+            deep_cache_depth (`int`, *optional*, defaults to 1):
+                Number of shallow down / up blocks that are recomputed when the cache is reused.
+            reuse_deep_cache (`bool`, *optional*, defaults to `False`):
+                Run only `conv_in`, the first `deep_cache_depth` down blocks and the last `deep_cache_depth` up blocks,
+                taking the deep features from `deep_cache` instead of the mid block and the remaining up blocks.
 
         Returns:
             [`~models.unet_2d_condition.UNet2DConditionOutput`] or `tuple`:
@@ -481,14 +507,36 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin):
             emb = emb + class_emb
 
         # pre-process
+        video_length = sample.shape[2]
+        if self.folded_layout:
+            sample = rearrange(sample, "b c f h w -> (b f) c h w")
+            if pose_cond_fea is not None:
+                pose_cond_fea = [
+                    rearrange(fea, "b c f h w -> (b f) c h w") if fea.ndim == 5 else fea
+                    for fea in pose_cond_fea
+                ]
         sample = self.conv_in(sample)
         if pose_cond_fea is not None:
             sample = sample + pose_cond_fea[0]
 
+        if deep_cache is not None and not 0 < deep_cache_depth < len(self.up_blocks):
+            raise ValueError(
+                f"deep_cache_depth has to be between 1 and {len(self.up_blocks) - 1}, got {deep_cache_depth}"
+            )
+        reuse_deep_cache = (
+            reuse_deep_cache and deep_cache is not None and "feature" in deep_cache
+        )
+        up_blocks_start = (
+            len(self.up_blocks) - deep_cache_depth if deep_cache is not None else 0
+        )
+
         # down
         down_block_res_samples = (sample,)
         block_count = 1
-        for downsample_block in self.down_blocks:
+        down_blocks = (
+            self.down_blocks[:deep_cache_depth] if reuse_deep_cache else self.down_blocks
+        )
+        for downsample_block in down_blocks:
             if (
                 hasattr(downsample_block, "has_cross_attention")
                 and downsample_block.has_cross_attention
@@ -523,19 +571,33 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin):
 
             down_block_res_samples = new_down_block_res_samples
 
-        # mid
-        sample = self.mid_block(
-            sample,
-            emb,
-            encoder_hidden_states=encoder_hidden_states,
-            attention_mask=attention_mask,
-        )
+        if reuse_deep_cache:
+            # the deep path is taken from the cache, keep the skips of the shallow up blocks only
+            sample = deep_cache["feature"]
+            num_shallow_res = sum(
+                len(upsample_block.resnets)
+                for upsample_block in self.up_blocks[up_blocks_start:]
+            )
+            down_block_res_samples = down_block_res_samples[:num_shallow_res]
+        else:
+            # mid
+            sample = self.mid_block(
+                sample,
+                emb,
+                encoder_hidden_states=encoder_hidden_states,
+                attention_mask=attention_mask,
+            )
 
-        if mid_block_additional_residual is not None:
-            sample = sample + mid_block_additional_residual
+            if mid_block_additional_residual is not None:
+                sample = sample + mid_block_additional_residual
 
         # up
         for i, upsample_block in enumerate(self.up_blocks):
+            if reuse_deep_cache and i < up_blocks_start:
+                continue
+            if deep_cache is not None and not reuse_deep_cache and i == up_blocks_start:
+                deep_cache["feature"] = sample
+
             is_final_block = i == len(self.up_blocks) - 1
 
             res_samples = down_block_res_samples[-len(upsample_block.resnets) :]
@@ -573,6 +635,8 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin):
         sample = self.conv_norm_out(sample)
         sample = self.conv_act(sample)
         sample = self.conv_out(sample)
+        if self.folded_layout:
+            sample = rearrange(sample, "(b f) c h w -> b c f h w", f=video_length)
 
         if not return_dict:
             return (sample,)
@@ -6,6 +6,7 @@ from typing import Callable, List, Optional, Union
 
 import numpy as np
 import torch
+import torch.nn.functional as F
 import torchvision.transforms as transforms
 from diffusers import DiffusionPipeline
 from diffusers.image_processor import VaeImageProcessor
@@ -23,7 +24,9 @@ from einops import rearrange
 from tqdm import tqdm
 from transformers import CLIPImageProcessor
 
+from ..models.attention_backend import AttentionAutotuner, set_attention_backend
 from ..models.mutual_self_attention import ReferenceAttentionControl
+from ..utils.compile_util import BucketedCompile, enable_compile_cache
 from .context import get_context_scheduler
 from .utils import get_tensor_interpolation_method
 
@@ -78,6 +81,7 @@ class Pose2VideoPipeline(DiffusionPipeline):
             do_convert_rgb=True,
             do_normalize=True,
         )
+        self.compiled_modules = {}
 
     def enable_vae_slicing(self):
         self.vae.enable_slicing()
@@ -85,6 +89,20 @@ class Pose2VideoPipeline(DiffusionPipeline):
     def disable_vae_slicing(self):
         self.vae.disable_slicing()
 
+    def set_attention_backend(self, backend="sdpa", autotune_cache_path=None):
+        r"""
+        Selects the attention backend ("naive", "sliced", "chunked", "sdpa" or "auto") of the reference UNet, the
+        denoising UNet and the pose guider. "auto" times the backends per attention shape on first use and keeps the
+        fastest, persisting the choices to `autotune_cache_path` when given.
+        """
+        autotuner = (
+            AttentionAutotuner(cache_path=autotune_cache_path)
+            if backend == "auto"
+            else None
+        )
+        for model in [self.reference_unet, self.denoising_unet, self.pose_guider]:
+            set_attention_backend(model, backend, autotuner=autotuner)
+
     def enable_sequential_cpu_offload(self, gpu_id=0):
         if is_accelerate_available():
             from accelerate import cpu_offload
@@ -97,6 +115,42 @@ class Pose2VideoPipeline(DiffusionPipeline):
             if cpu_offloaded_model is not None:
                 cpu_offload(cpu_offloaded_model, device)
 
+    def enable_folded_layout(self, enabled=True):
+        r"""
+        Runs the denoising UNet with activations kept in the folded `(b f) c h w` layout, the pose guider then hands
+        over its features already folded.
+        """
+        self.denoising_unet.enable_folded_layout(enabled)
+        self.pose_guider.folded_output = enabled
+
+    def enable_compile(
+        self, backend="inductor", mode=None, max_buckets=4, cache_dir=None
+    ):
+        r"""
+        Runs the denoising UNet, the pose guider and the VAE decoder through `torch.compile` with one static graph
+        per input shape bucket (resolution x context frames), at most `max_buckets` of them per model. With
+        `cache_dir` the inductor artifacts are cached on disk and reused by later runs.
+        """
+        if cache_dir is not None:
+            enable_compile_cache(cache_dir)
+
+        def vae_decode(latents):
+            return self.vae.decode(latents).sample
+
+        self.compiled_modules = {
+            name: BucketedCompile(
+                fn, backend=backend, mode=mode, max_buckets=max_buckets
+            )
+            for name, fn in [
+                ("denoising_unet", self.denoising_unet),
+                ("pose_guider", self.pose_guider),
+                ("vae_decode", vae_decode),
+            ]
+        }
+
+    def disable_compile(self):
+        self.compiled_modules = {}
+
     @property
     def _execution_device(self):
         if self.device != torch.device("meta") or not hasattr(self.unet, "_hf_hook"):
@@ -115,9 +169,12 @@ class Pose2VideoPipeline(DiffusionPipeline):
         latents = 1 / 0.18215 * latents
         latents = rearrange(latents, "b c f h w -> (b f) c h w")
         # video = self.vae.decode(latents).sample
+        vae_decode = self.compiled_modules.get(
+            "vae_decode", lambda x: self.vae.decode(x).sample
+        )
         video = []
         for frame_idx in tqdm(range(latents.shape[0])):
-            video.append(self.vae.decode(latents[frame_idx : frame_idx + 1]).sample)
+            video.append(vae_decode(latents[frame_idx : frame_idx + 1]))
         video = torch.cat(video)
         video = rearrange(video, "(b f) c h w -> b c f h w", f=video_length)
         video = (video / 2 + 0.5).clamp(0, 1)
@@ -335,6 +392,48 @@ class Pose2VideoPipeline(DiffusionPipeline):
 
         return new_latents
 
+    def prepare_pose_condition(self, pose_images, height, width, device, dtype):
+        r"""
+        Batched `cond_image_processor.preprocess` of all pose images at once. Arrays and tensors, a (t, h, w, c) batch
+        or a list of (h, w, c) images, are resized and normalised on `device` exactly like the processor does, pixel
+        values taken as they are. Returns the (1, c, t, height, width) pose condition. A (1, c, t, height, width)
+        tensor, e.g. from `FaceMeshRasterizer`, is taken as the finished condition.
+        """
+        if isinstance(pose_images, torch.Tensor) and pose_images.ndim == 5:
+            return pose_images.to(device=device, dtype=dtype)
+        if isinstance(pose_images, (list, tuple)) and not isinstance(
+            pose_images[0], (np.ndarray, torch.Tensor)
+        ):
+            pose_cond_tensor = self.cond_image_processor.preprocess(
+                list(pose_images), height=height, width=width
+            )
+        else:
+            if isinstance(pose_images, (list, tuple)):
+                pose_images = (
+                    torch.stack(pose_images)
+                    if isinstance(pose_images[0], torch.Tensor)
+                    else np.stack(pose_images)
+                )
+            if isinstance(pose_images, np.ndarray):
+                pose_images = torch.from_numpy(pose_images)
+            frames = pose_images.to(device)
+            if frames.shape[1:3] != (height, width):
+                # nearest, like VaeImageProcessor.resize for tensors
+                frames = F.interpolate(
+                    frames.permute(0, 3, 1, 2), size=(height, width)
+                ).permute(0, 2, 3, 1)
+            # written straight into the (c, t, h, w) layout, a few frames at a time
+            pose_cond_tensor = torch.empty(
+                (frames.shape[3], len(frames), height, width), device=device, dtype=dtype
+            )
+            for start in range(0, len(frames), 32):
+                pose_cond_tensor[:, start : start + 32].copy_(
+                    frames[start : start + 32].permute(3, 0, 1, 2)
+                ).mul_(2.0).sub_(1.0)
+            return pose_cond_tensor.unsqueeze(0)
+        pose_cond_tensor = pose_cond_tensor.transpose(0, 1).unsqueeze(0)  # (bs, c, t, h, w)
+        return pose_cond_tensor.to(device=device, dtype=dtype)
+
     @torch.no_grad()
     def __call__(
         self,
@@ -359,6 +458,10 @@ class Pose2VideoPipeline(DiffusionPipeline):
         context_overlap=4,
         context_batch_size=1,
         interpolation_factor=1,
+        deep_cache_interval=1,
+        deep_cache_depth=1,
+        deep_cache_warmup=0,
+        reference_token_ratios=None,
         **kwargs,
     ):
         # Default height and width to unet
@@ -403,6 +506,8 @@ class Pose2VideoPipeline(DiffusionPipeline):
             mode="read",
             batch_size=batch_size,
             fusion_blocks="full",
+            reference_token_ratios=reference_token_ratios,
+            latent_size=(height // self.vae_scale_factor, width // self.vae_scale_factor),
         )
 
         num_channels_latents = self.denoising_unet.in_channels
@@ -430,20 +535,11 @@ class Pose2VideoPipeline(DiffusionPipeline):
         ref_image_latents = self.vae.encode(ref_image_tensor).latent_dist.mean
         ref_image_latents = ref_image_latents * 0.18215  # (b, 4, h, w)
 
-        # Prepare a list of pose condition images
-        pose_cond_tensor_list = []
-        for pose_image in pose_images:
-            pose_cond_tensor = self.cond_image_processor.preprocess(
-                pose_image, height=height, width=width
-            )
-            pose_cond_tensor = pose_cond_tensor.unsqueeze(2)  # (bs, c, 1, h, w)
-            pose_cond_tensor_list.append(pose_cond_tensor)
-        pose_cond_tensor = torch.cat(pose_cond_tensor_list, dim=2)  # (bs, c, t, h, w)
-        
-        pose_cond_tensor = pose_cond_tensor.to(
-            device=device, dtype=self.pose_guider.dtype
-        )
-        
+        # Prepare the pose condition images
+        pose_cond_tensor = self.prepare_pose_condition(
+            pose_images, height, width, device, self.pose_guider.dtype
+        )  # (bs, c, t, h, w)
+
         ref_pose_tensor = self.cond_image_processor.preprocess(
             ref_pose_image, height=height, width=width
         )
@@ -452,11 +548,24 @@ class Pose2VideoPipeline(DiffusionPipeline):
         )
 
         context_scheduler = get_context_scheduler(context_schedule)
+        denoising_unet = self.compiled_modules.get(
+            "denoising_unet", self.denoising_unet
+        )
+        pose_guider = self.compiled_modules.get("pose_guider", self.pose_guider)
+
+        # deep feature caches, one per context window. After `deep_cache_warmup` steps the full UNet only runs
+        # every `deep_cache_interval` steps, the steps in between recompute the shallow blocks only.
+        deep_caches = {} if deep_cache_interval > 1 else None
 
         # denoising loop
         num_warmup_steps = len(timesteps) - num_inference_steps * self.scheduler.order
         with self.progress_bar(total=num_inference_steps) as progress_bar:
             for i, t in enumerate(timesteps):
+                reuse_deep_cache = (
+                    deep_caches is not None
+                    and i >= deep_cache_warmup
+                    and (i - deep_cache_warmup) % deep_cache_interval != 0
+                )
                 noise_pred = torch.zeros(
                     (
                         latents.shape[0] * (2 if do_classifier_free_guidance else 1),
@@ -509,10 +618,10 @@ class Pose2VideoPipeline(DiffusionPipeline):
 
                 num_context_batches = math.ceil(len(context_queue) / context_batch_size)
                 global_context = []
-                for i in range(num_context_batches):
+                for k in range(num_context_batches):
                     global_context.append(
                         context_queue[
-                            i * context_batch_size : (i + 1) * context_batch_size
+                            k * context_batch_size : (k + 1) * context_batch_size
                         ]
                     )
 
@@ -533,14 +642,23 @@ class Pose2VideoPipeline(DiffusionPipeline):
                         .to(device)
                         .repeat(2 if do_classifier_free_guidance else 1, 1, 1, 1, 1)
                     )
-                    pose_fea = self.pose_guider(pose_cond_input, ref_pose_tensor)
+                    pose_fea = pose_guider(pose_cond_input, ref_pose_tensor)
+
+                    deep_cache = None
+                    if deep_caches is not None:
+                        deep_cache = deep_caches.setdefault(
+                            tuple(tuple(c) for c in context), {}
+                        )
 
-                    pred = self.denoising_unet(
+                    pred = denoising_unet(
                         latent_model_input,
                         t,
                         encoder_hidden_states=encoder_hidden_states[:b],
                         pose_cond_fea=pose_fea,
                         return_dict=False,
+                        deep_cache=deep_cache,
+                        deep_cache_depth=deep_cache_depth,
+                        reuse_deep_cache=reuse_deep_cache,
                     )[0]
 
                     for j, c in enumerate(context):
@@ -1,19 +1,117 @@
+import io
 import os
 import math
+import struct
+import wave
 
 import librosa
 import numpy as np
 from transformers import Wav2Vec2FeatureExtractor
 
 
+_audio_cache = {}
+
+
+def _memmap_wav(audio_path, sampling_rate):
+    # float32 mono wav already at the sampling rate, mapped instead of read, None for anything else
+    with open(audio_path, "rb") as f:
+        header = f.read(12)
+        if len(header) < 12 or header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+            return None
+        fmt = None
+        while True:
+            chunk = f.read(8)
+            if len(chunk) < 8:
+                return None
+            chunk_id, size = chunk[:4], int.from_bytes(chunk[4:], "little")
+            if chunk_id == b"data":
+                break
+            data = f.read(size + size % 2)
+            if chunk_id == b"fmt " and size >= 16:
+                fmt = list(struct.unpack("<HHIIHH", data[:16]))
+                if fmt[0] == 0xFFFE and size >= 26:
+                    # WAVE_FORMAT_EXTENSIBLE, the format tag is the start of the sub format guid
+                    fmt[0] = struct.unpack("<H", data[24:26])[0]
+        offset = f.tell()
+    if fmt is None:
+        return None
+    audio_format, channels, rate, _, _, bits = fmt
+    if (audio_format, bits, channels, rate) != (3, 32, 1, sampling_rate):
+        return None
+    size = min(size, os.path.getsize(audio_path) - offset)
+    return np.memmap(audio_path, dtype="<f4", mode="r", offset=offset, shape=(size // 4,))
+
+
+def _cache_key(audio_path, *args):
+    st = os.stat(audio_path)
+    return (os.path.abspath(audio_path), st.st_size, st.st_mtime_ns) + args
+
+
+def _cached(key, load):
+    if key not in _audio_cache:
+        value = load()
+        while len(_audio_cache) >= 4:
+            del _audio_cache[next(iter(_audio_cache))]
+        _audio_cache[key] = value
+    return _audio_cache[key]
+
+
+def decode_audio(audio_path):
+    """
+    Decodes `audio_path` at its own sampling rate and channels, once per process and file version. Returns the
+    (channels, samples) float32 array and the sampling rate. `load_audio` and `audio_wav_bytes` both start from it, so
+    the model input and the muxed audio of the same file share one decode.
+    """
+    def load():
+        speech_array, rate = librosa.load(audio_path, sr=None, mono=False)
+        return np.atleast_2d(speech_array).astype(np.float32, copy=False), rate
+
+    return _cached(_cache_key(audio_path), load)
+
+
+def load_audio(audio_path, sampling_rate=16000):
+    """
+    Mono float32 array of `audio_path` at `sampling_rate`, resampled from `decode_audio` and kept once per process and
+    file version. Float32 mono wav files already at that rate are memory-mapped instead of read.
+    """
+    def load():
+        speech_array = _memmap_wav(audio_path, sampling_rate)
+        if speech_array is None:
+            # the steps of librosa.load(sr=sampling_rate), mono then resample
+            channels, rate = decode_audio(audio_path)
+            speech_array = librosa.resample(librosa.to_mono(channels), orig_sr=rate, target_sr=sampling_rate)
+            speech_array = speech_array.astype(np.float32, copy=False)
+        return speech_array
+
+    return _cached(_cache_key(audio_path, sampling_rate), load)
+
+
+def audio_wav_bytes(audio_path, start_time=0):
+    """
+    16-bit PCM wav bytes of `audio_path` from `start_time` seconds on, at the file's own sampling rate and channels,
+    like ffmpeg's `-f wav` output, from `decode_audio`.
+    """
+    channels, rate = decode_audio(audio_path)
+    samples = channels[:, int(round(start_time * rate)):]
+    pcm = (np.clip(samples.T, -1, 1) * 32767).round().astype("<i2")
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as f:
+        f.setnchannels(len(channels))
+        f.setsampwidth(2)
+        f.setframerate(rate)
+        f.writeframes(pcm.tobytes())
+    return buffer.getvalue()
+
+
 class DataProcessor:
     def __init__(self, sampling_rate, wav2vec_model_path):
         self._processor = Wav2Vec2FeatureExtractor.from_pretrained(wav2vec_model_path, local_files_only=True)
         self._sampling_rate = sampling_rate
 
-    def extract_feature(self, audio_path):
-        speech_array, sampling_rate = librosa.load(audio_path, sr=self._sampling_rate)
-        input_value = np.squeeze(self._processor(speech_array, sampling_rate=sampling_rate).input_values)
+    def extract_feature(self, audio):
+        # a path or an array already decoded by load_audio at the sampling rate
+        speech_array = audio if isinstance(audio, np.ndarray) else load_audio(audio, self._sampling_rate)
+        input_value = np.squeeze(self._processor(speech_array, sampling_rate=self._sampling_rate).input_values)
         return input_value
 
 
@@ -0,0 +1,51 @@
+import os
+
+import torch
+
+from .logger import logger
+
+
+def _shape_key(value):
+    if torch.is_tensor(value):
+        return (tuple(value.shape), str(value.dtype), value.device.type)
+    if isinstance(value, (list, tuple)):
+        return tuple(_shape_key(v) for v in value)
+    if isinstance(value, dict):
+        return tuple((k, _shape_key(v)) for k, v in sorted(value.items()))
+    if value is None or isinstance(value, (bool, int, float, str)):
+        # dynamo specialises the graph on python scalars (flags like reuse_deep_cache), so they are part of the key
+        return value
+    return type(value).__qualname__
+
+
+def enable_compile_cache(cache_dir):
+    # inductor reuses compiled graphs from this directory in later processes
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = cache_dir
+    import torch._inductor.config as inductor_config
+
+    inductor_config.fx_graph_cache = True
+
+
+class BucketedCompile:
+    r"""
+    Wraps `fn` in `torch.compile(dynamic=False)`, so every distinct input bucket (resolution, context frames, batch,
+    and the python scalar arguments the graph specialises on) gets its own static graph. Only the first
+    `max_buckets` buckets seen are compiled, calls with any further bucket run `fn` eagerly, which keeps the number
+    of recompiles bounded.
+    """
+
+    def __init__(self, fn, backend="inductor", mode=None, max_buckets=4):
+        self.fn = fn
+        self.compiled_fn = torch.compile(fn, backend=backend, mode=mode, dynamic=False)
+        self.max_buckets = max_buckets
+        self.buckets = set()
+
+    def __call__(self, *args, **kwargs):
+        key = (_shape_key(args), _shape_key(kwargs))
+        if key not in self.buckets:
+            if len(self.buckets) >= self.max_buckets:
+                return self.fn(*args, **kwargs)
+            logger.info(f"compiling {getattr(self.fn, '__qualname__', self.fn)} for a new shape bucket")
+            self.buckets.add(key)
+        return self.compiled_fn(*args, **kwargs)
@@ -1,10 +1,19 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import cv2
 import mediapipe as mp
 import numpy as np
-from mediapipe.framework.formats import landmark_pb2
 
 class FaceMeshVisualizer:
-    def __init__(self, forehead_edge=False):
+    """
+    Draws the face mesh contours of 478 landmarks as a BGR pose image. The edges are drawn on a `canvas_size` canvas
+    and resized to the requested size, which matches the mediapipe drawing_utils renderer pixel for pixel. With
+    `canvas_size` None they are drawn straight at the requested size, skipping the resize; lines are then 2px wide
+    at that size instead of resampled from 512x512, so images differ from the default along the line edges.
+    """
+
+    def __init__(self, forehead_edge=False, canvas_size=(512, 512)):
         self.mp_drawing = mp.solutions.drawing_utils
         mp_face_mesh = mp.solutions.face_mesh
         self.mp_face_mesh = mp_face_mesh
@@ -91,6 +100,19 @@ class FaceMeshVisualizer:
         iris_landmark_spec = {468: right_iris_draw, 473: left_iris_draw}
         
         self.face_connection_spec = face_connection_spec
+        self.canvas_size = canvas_size
+        self.thickness = f_thick
+
+        # runs of consecutive edges sharing a colour, in drawing order, so overlapping edges of different colours
+        # end up on top of each other as with one line per edge
+        edge_runs = []
+        for edge, spec in face_connection_spec.items():
+            if edge_runs and edge_runs[-1][0] == spec.color:
+                edge_runs[-1][1].append(edge)
+            else:
+                edge_runs.append((spec.color, [edge]))
+        self.edge_runs = [(color, np.array(edges, dtype=np.int64)) for color, edges in edge_runs]
+
     def draw_pupils(self, image, landmark_list, drawing_spec, halfwidth: int = 2):
         """We have a custom function to draw the pupils because the mp.draw_landmarks method requires a parameter for all
         landmarks.  Until our PR is merged into mediapipe, we need this separate method."""
@@ -121,29 +143,52 @@ class FaceMeshVisualizer:
         
 
 
-    def draw_landmarks(self, image_size, keypoints, normed=False):
-        ini_size = [512, 512]
-        image = np.zeros([ini_size[1], ini_size[0], 3], dtype=np.uint8)
-        new_landmarks = landmark_pb2.NormalizedLandmarkList()
-        for i in range(keypoints.shape[0]):
-            landmark = new_landmarks.landmark.add()
-            if normed:
-                landmark.x = keypoints[i, 0]
-                landmark.y = keypoints[i, 1]
-            else:
-                landmark.x = keypoints[i, 0] / image_size[0]
-                landmark.y = keypoints[i, 1] / image_size[1]
-            landmark.z = 1.0
+    def pixel_coordinates(self, keypoints, image_size, canvas_size, normed=False):
+        # canvas pixel and validity of every landmark, rounded as mediapipe does from its float32 normalised values
+        points = np.asarray(keypoints, dtype=np.float64)[:, :2]
+        if not normed:
+            points = points / np.asarray(image_size, dtype=np.float64)
+        points = points.astype(np.float32).astype(np.float64)
+        valid = ((points >= 0) & (points <= 1)).all(-1)
+        pixels = np.clip(np.nan_to_num(np.floor(points * canvas_size)), 0, np.asarray(canvas_size) - 1).astype(np.int32)
+        return pixels, valid
 
-        self.mp_drawing.draw_landmarks(
-            image=image,
-            landmark_list=new_landmarks,
-            connections=self.face_connection_spec.keys(),
-            landmark_drawing_spec=None,
-            connection_drawing_spec=self.face_connection_spec
-        )
+    def draw_landmarks(self, image_size, keypoints, normed=False):
+        canvas_size = tuple(self.canvas_size or image_size)
+        image = np.zeros([canvas_size[1], canvas_size[0], 3], dtype=np.uint8)
+        pixels, valid = self.pixel_coordinates(keypoints, image_size, canvas_size, normed)
+        for color, edges in self.edge_runs:
+            # edges with a landmark outside the image are skipped
+            segments = pixels[edges[valid[edges].all(-1)]]
+            if len(segments):
+                cv2.polylines(image, list(segments), False, color, self.thickness)
         # draw_pupils(image, face_landmarks, iris_landmark_spec, 2)
-        image = cv2.resize(image, (image_size[0], image_size[1]))
-        
+        if canvas_size != (image_size[0], image_size[1]):
+            image = cv2.resize(image, (image_size[0], image_size[1]))
+
         return image
 
+    def draw_landmarks_batch(self, keypoints, image_size, normed=False, out_size=None, num_workers=None):
+        """
+        `draw_landmarks` of every frame of the (n, 478, 2 or 3) `keypoints` in `num_workers` threads, cv2 releases the
+        GIL while drawing. Returns one preallocated (n, height, width, 3) uint8 BGR array, frames are resized from
+        `image_size` to `out_size` when it is given.
+        """
+        width, height = out_size or image_size
+        images = np.empty((len(keypoints), height, width, 3), dtype=np.uint8)
+
+        def draw(idx):
+            image = self.draw_landmarks(image_size, keypoints[idx], normed=normed)
+            if (width, height) != (image.shape[1], image.shape[0]):
+                image = cv2.resize(image, (width, height))
+            images[idx] = image
+
+        if num_workers is None:
+            num_workers = min(8, os.cpu_count() or 1)
+        if num_workers <= 1 or len(keypoints) <= 1:
+            for idx in range(len(keypoints)):
+                draw(idx)
+        else:
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                list(executor.map(draw, range(len(keypoints))))
+        return images
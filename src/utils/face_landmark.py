@@ -26,9 +26,7 @@ from mediapipe.python import packet_creator
 from mediapipe.python import packet_getter
 from mediapipe.python._framework_bindings import image as image_module
 from mediapipe.python._framework_bindings import packet as packet_module
-# pylint: disable=unused-import
 from mediapipe.tasks.cc.vision.face_geometry.proto import face_geometry_pb2
-# pylint: enable=unused-import
 from mediapipe.tasks.cc.vision.face_landmarker.proto import face_landmarker_graph_options_pb2
 from mediapipe.tasks.python.components.containers import category as category_module
 from mediapipe.tasks.python.components.containers import landmark as landmark_module
@@ -39,6 +37,14 @@ from mediapipe.tasks.python.vision.core import base_vision_task_api
 from mediapipe.tasks.python.vision.core import image_processing_options as image_processing_options_module
 from mediapipe.tasks.python.vision.core import vision_task_running_mode as running_mode_module
 
+from .logger import logger
+
+try:
+  # private, the serialized bytes of a proto list packet without parsing them
+  from mediapipe.python._framework_bindings._packet_getter import _get_serialized_proto_list
+except ImportError:
+  _get_serialized_proto_list = None
+
 _BaseOptions = base_options_module.BaseOptions
 _FaceLandmarkerGraphOptionsProto = (
     face_landmarker_graph_options_pb2.FaceLandmarkerGraphOptions
@@ -2992,6 +2998,310 @@ def _build_landmarker_result2(
       facial_transformation_matrixes_results,
   ), facial_transformation_matrixes_proto_list[0].mesh
 
+
+def _read_varint(data: bytes, pos: int):
+  """The varint at `pos` of the wire format and the position after it."""
+  value = shift = 0
+  while True:
+    byte = data[pos]
+    value |= (byte & 0x7F) << shift
+    pos += 1
+    if byte < 0x80:
+      return value, pos
+    shift += 7
+
+
+def _message_fields(data: bytes) -> dict:
+  """The top level fields of a serialized message by field number.
+
+  Varints as int, the other wire types as their bytes, the last one of a
+  repeated field. Meant for the few field messages around the large ones.
+  """
+  fields = {}
+  pos = 0
+  while pos < len(data):
+    key, pos = _read_varint(data, pos)
+    wire_type = key & 7
+    if wire_type == 0:
+      value, pos = _read_varint(data, pos)
+    elif wire_type in (1, 2, 5):
+      if wire_type == 2:
+        length, pos = _read_varint(data, pos)
+      else:
+        length = 8 if wire_type == 1 else 4
+      value = data[pos:pos + length]
+      pos += length
+    else:
+      raise ValueError(f'Unsupported wire type {wire_type}.')
+    fields[key >> 3] = value
+  return fields
+
+
+def _fixed32_records(
+    data: bytes, start: int, count: int, stride: int, fields: Mapping[int, int]
+) -> Optional[np.ndarray]:
+  """Reads float fields out of `count` equally encoded records of the wire format.
+
+  Args:
+    data: The serialized message.
+    start: Byte offset of the first record.
+    count: Number of records.
+    stride: Bytes per record.
+    fields: The one byte tag of each fixed32 field to read, mapped to the byte
+      offset of its value in a record (right after the tag).
+
+  Returns:
+    A (count, len(fields)) float64 array, or None when the records are not
+    encoded this way (a missing field, a longer tag).
+  """
+  if count == 0 or len(data) < start + count * stride:
+    return None
+  if max(fields.values()) + 4 > stride:
+    return None
+  raw = np.frombuffer(data, np.uint8, count * stride, start).reshape(count, stride)
+  offsets = list(fields.values())
+  if (raw[:, [offset - 1 for offset in offsets]] != list(fields)).any():
+    return None
+  dtype = np.dtype({
+      'names': [f'f{i}' for i in range(len(fields))],
+      'formats': ['<f4'] * len(fields),
+      'offsets': offsets,
+      'itemsize': stride,
+  })
+  records = np.frombuffer(data, dtype, count, start)
+  return np.stack([records[name] for name in dtype.names], axis=-1).astype(np.float64)
+
+
+def _varint_records(data: bytes, start: int, tag: int) -> Optional[np.ndarray]:
+  """Reads an unpacked repeated varint field filling `data` from `start`.
+
+  Returns:
+    The values as int64, or None when a byte in between is not the one byte
+    `tag` of the field.
+  """
+  raw = np.frombuffer(data, np.uint8, len(data) - start, start)
+  # every tag and every value ends on a byte below 0x80, the tags are one byte
+  ends = np.flatnonzero(raw < 0x80)
+  if len(ends) == 0 or len(ends) % 2 or ends[-1] != len(raw) - 1:
+    return None
+  tags = ends[0::2]
+  if tags[0] != 0 or (raw[tags] != tag).any() or (tags[1:] != ends[1:-1:2] + 1).any():
+    return None
+  lengths = ends[1::2] - tags
+  positions = np.delete(np.arange(len(raw)), tags)
+  shifts = 7 * (positions - np.repeat(tags + 1, lengths))
+  values = (raw[positions].astype(np.uint32) & 0x7F) << shifts.astype(np.uint32)
+  return np.add.reduceat(values, np.cumsum(lengths) - lengths).astype(np.int64)
+
+
+def _landmark_array(data: bytes) -> Optional[np.ndarray]:
+  """(n, 3) x, y, z of a serialized NormalizedLandmarkList.
+
+  Every landmark is a length delimited field 1 of the list holding the fixed32
+  x, y and z (and visibility, presence when set): 2 + 15 (+ 10) bytes, the same
+  for all of them. None when the list is encoded otherwise.
+  """
+  if len(data) < 2 or data[0] != 0x0A:
+    return None
+  stride = data[1] + 2
+  if len(data) % stride:
+    return None
+  raw = np.frombuffer(data, np.uint8).reshape(-1, stride)
+  if (raw[:, 0] != 0x0A).any() or (raw[:, 1] != stride - 2).any():
+    return None
+  return _fixed32_records(data, 0, len(raw), stride, {0x0D: 3, 0x15: 8, 0x1D: 13})
+
+
+def _mesh_arrays(data: bytes):
+  """The vertex and index buffers of a serialized Mesh3d.
+
+  After the varint vertex_type and primitive_type the vertex buffer is an
+  unpacked repeated float, field 3, one tag byte and 4 value bytes per float,
+  and the index buffer an unpacked repeated uint32, field 4, up to the end.
+
+  Returns:
+    The float64 vertex buffer and the int64 index buffer, or None when the
+    mesh is encoded otherwise.
+  """
+  start = 0
+  while start < len(data) and data[start] in (0x08, 0x10):
+    _, start = _read_varint(data, start + 1)
+  # the vertices end at the first tag that is not field 3
+  tags = np.frombuffer(data, np.uint8, (len(data) - start) // 5 * 5, start)[::5]
+  count = int(np.argmin(tags == 0x1D)) if (tags != 0x1D).any() else len(tags)
+  vertices = _fixed32_records(data, start, count, 5, {0x1D: 1})
+  indices = _varint_records(data, start + 5 * count, 0x20)
+  if vertices is None or indices is None:
+    return None
+  return vertices.reshape(-1), indices
+
+
+def _proto_landmarker_arrays(
+    output_packets: Mapping[str, packet_module.Packet]
+) -> Optional[dict]:
+  """`_build_landmarker_arrays` through the public protos of the packets."""
+  face_landmarks_proto_list = packet_getter.get_proto_list(
+      output_packets[_NORM_LANDMARKS_STREAM_NAME]
+  )
+  if len(face_landmarks_proto_list) != 1:
+    return None
+  landmarks = face_landmarks_proto_list[0].landmark
+  lmks = np.fromiter(
+      (v for lmk in landmarks for v in (lmk.x, lmk.y, lmk.z)),
+      dtype=np.float64,
+      count=3 * len(landmarks),
+  ).reshape(-1, 3)
+
+  geometry = packet_getter.get_proto_list(
+      output_packets[_FACE_GEOMETRY_STREAM_NAME]
+  )[0]
+  matrix_data = geometry.pose_transform_matrix
+  matrix = np.array(matrix_data.packed_data, dtype=np.float64).reshape(
+      (matrix_data.rows, matrix_data.cols)
+  )
+  if matrix_data.layout != _LayoutEnum.ROW_MAJOR:
+    matrix = matrix.T
+  mesh3d = geometry.mesh
+
+  return {
+      'lmks': lmks,
+      'blendshapes': _blendshape_array(output_packets),
+      'trans_mat': matrix,
+      'vertex_buffer': np.fromiter(
+          mesh3d.vertex_buffer,
+          dtype=np.float64,
+          count=len(mesh3d.vertex_buffer),
+      ),
+      'index_buffer': np.array(mesh3d.index_buffer, dtype=np.int64),
+  }
+
+
+def _blendshape_array(
+    output_packets: Mapping[str, packet_module.Packet]
+) -> np.ndarray:
+  """The scores of the first face's blendshapes, empty without the stream."""
+  if _BLENDSHAPES_STREAM_NAME not in output_packets:
+    return np.zeros(0)
+  # 52 categories with their names, parsed as protos
+  face_blendshapes_proto_list = packet_getter.get_proto_list(
+      output_packets[_BLENDSHAPES_STREAM_NAME]
+  )
+  if not face_blendshapes_proto_list:
+    return np.zeros(0)
+  classifications = face_blendshapes_proto_list[0].classification
+  return np.fromiter(
+      (c.score for c in classifications),
+      dtype=np.float64,
+      count=len(classifications),
+  )
+
+
+def _serialized_landmarker_arrays(
+    output_packets: Mapping[str, packet_module.Packet]
+) -> Optional[dict]:
+  """`_build_landmarker_arrays` read from the serialized packets.
+
+  The landmarks, the mesh and the pose matrix are read from the wire format,
+  with the protos as fallback for an encoding other than the one mediapipe
+  writes. Needs the private `_get_serialized_proto_list`.
+  """
+  serialized_landmarks = _get_serialized_proto_list(
+      output_packets[_NORM_LANDMARKS_STREAM_NAME]
+  )
+  if len(serialized_landmarks) != 1:
+    return None
+  serialized_geometry = _get_serialized_proto_list(
+      output_packets[_FACE_GEOMETRY_STREAM_NAME]
+  )[0]
+
+  lmks = _landmark_array(serialized_landmarks[0])
+  if lmks is None:
+    landmarks = landmark_pb2.NormalizedLandmarkList.FromString(
+        serialized_landmarks[0]
+    ).landmark
+    lmks = np.fromiter(
+        (v for lmk in landmarks for v in (lmk.x, lmk.y, lmk.z)),
+        dtype=np.float64,
+        count=3 * len(landmarks),
+    ).reshape(-1, 3)
+
+  geometry = _message_fields(serialized_geometry)
+  matrix_data = _message_fields(geometry[2])
+  matrix = np.frombuffer(matrix_data[3], '<f4').astype(np.float64).reshape(
+      (matrix_data[1], matrix_data[2])
+  )
+  if matrix_data.get(4, _LayoutEnum.COLUMN_MAJOR) != _LayoutEnum.ROW_MAJOR:
+    matrix = matrix.T
+  mesh = _mesh_arrays(geometry[1])
+  if mesh is None:
+    mesh3d = face_geometry_pb2.FaceGeometry.FromString(serialized_geometry).mesh
+    mesh = (
+        np.fromiter(
+            mesh3d.vertex_buffer,
+            dtype=np.float64,
+            count=len(mesh3d.vertex_buffer),
+        ),
+        np.array(mesh3d.index_buffer, dtype=np.int64),
+    )
+
+  return {
+      'lmks': lmks,
+      'blendshapes': _blendshape_array(output_packets),
+      'trans_mat': matrix,
+      'vertex_buffer': mesh[0],
+      'index_buffer': mesh[1],
+  }
+
+
+# whether the serialized reader gives the protos' arrays, checked on the first
+# face of the process: None until then
+_serialized_reader_ok = None
+
+
+def _build_landmarker_arrays(
+    output_packets: Mapping[str, packet_module.Packet]
+) -> Optional[dict]:
+  """Reads the first face of the output packets straight into numpy arrays.
+
+  Skips the per landmark and per category containers of
+  `_build_landmarker_result2`. The landmarks, the mesh and the pose matrix
+  are read from the serialized packets by `_serialized_landmarker_arrays`,
+  which depends on a private mediapipe function and on the wire format
+  mediapipe writes. The first face of the process is read both ways, and
+  when the serialized reader is missing, fails or differs from the protos, a
+  warning is logged and the protos are used from then on.
+
+  Returns:
+    A dict with the (478, 3) `lmks`, the (num_blendshapes,) `blendshapes`
+    scores, the (4, 4) `trans_mat`, the `vertex_buffer` and `index_buffer` of
+    the face mesh, or None without a face.
+  """
+  global _serialized_reader_ok
+  if _serialized_reader_ok is False:
+    return _proto_landmarker_arrays(output_packets)
+  if _serialized_reader_ok:
+    return _serialized_landmarker_arrays(output_packets)
+
+  expected = _proto_landmarker_arrays(output_packets)
+  if expected is None:
+    return None
+  try:
+    arrays = _serialized_landmarker_arrays(output_packets)
+    _serialized_reader_ok = arrays is not None and all(
+        arrays[name].shape == value.shape and np.array_equal(arrays[name], value)
+        for name, value in expected.items()
+    )
+  except Exception as e:  # pylint: disable=broad-except
+    logger.warning(f'Reading the serialized landmarker output failed: {e!r}')
+    _serialized_reader_ok = False
+  if not _serialized_reader_ok:
+    logger.warning(
+        'The serialized landmarker output does not read like its protos with'
+        ' this mediapipe version, parsing the protos instead.'
+    )
+  return expected
+
+
 @dataclasses.dataclass
 class FaceLandmarkerOptions:
   """Options for the face landmarker task.
@@ -3174,6 +3484,7 @@ class FaceLandmarker(base_vision_task_api.BaseVisionTaskApi):
       self,
       image: image_module.Image,
       image_processing_options: Optional[_ImageProcessingOptions] = None,
+      as_arrays: bool = False,
   ) -> FaceLandmarkerResult:
     """Performs face landmarks detection on the given image.
 
@@ -3187,6 +3498,7 @@ class FaceLandmarker(base_vision_task_api.BaseVisionTaskApi):
     Args:
       image: MediaPipe Image.
       image_processing_options: Options for image processing.
+      as_arrays: Return the numpy arrays of `_build_landmarker_arrays`.
 
     Returns:
       The face landmarks detection results.
@@ -3206,6 +3518,11 @@ class FaceLandmarker(base_vision_task_api.BaseVisionTaskApi):
         ),
     })
 
+    if as_arrays:
+      if output_packets[_NORM_LANDMARKS_STREAM_NAME].is_empty():
+        return None
+      return _build_landmarker_arrays(output_packets)
+
     if output_packets[_NORM_LANDMARKS_STREAM_NAME].is_empty():
       return FaceLandmarkerResult([], [], [])
 
@@ -3216,6 +3533,7 @@ class FaceLandmarker(base_vision_task_api.BaseVisionTaskApi):
       image: image_module.Image,
       timestamp_ms: int,
       image_processing_options: Optional[_ImageProcessingOptions] = None,
+      as_arrays: bool = False,
   ):
     """Performs face landmarks detection on the provided video frame.
 
@@ -3231,6 +3549,7 @@ class FaceLandmarker(base_vision_task_api.BaseVisionTaskApi):
       image: MediaPipe Image.
       timestamp_ms: The timestamp of the input video frame in milliseconds.
       image_processing_options: Options for image processing.
+      as_arrays: Return the numpy arrays of `_build_landmarker_arrays`.
 
     Returns:
       The face landmarks detection results.
@@ -3251,6 +3570,11 @@ class FaceLandmarker(base_vision_task_api.BaseVisionTaskApi):
         ).at(timestamp_ms * _MICRO_SECONDS_PER_MILLISECOND),
     })
 
+    if as_arrays:
+      if output_packets[_NORM_LANDMARKS_STREAM_NAME].is_empty():
+        return None
+      return _build_landmarker_arrays(output_packets)
+
     if output_packets[_NORM_LANDMARKS_STREAM_NAME].is_empty():
       return FaceLandmarkerResult([], [], [])
 
@@ -3,68 +3,215 @@ import os
 import cv2
 import numpy as np
 import torch
+import torch.nn.functional as F
 import bisect
 import shutil
 import pdb
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
-def init_frame_interpolation_model():
+_frame_interpolation_models = {}
+
+
+def init_frame_interpolation_model(device=None, dtype=None):
+    """
+    Loads the FILM TorchScript model once per process and (device, dtype). Defaults to fp16 on cuda and fp32 on cpu,
+    where bf16 can be passed as well.
+    """
+    device = torch.device(device or ("cuda" if torch.cuda.is_available() else "cpu"))
+    if dtype is None:
+        dtype = torch.float16 if device.type == "cuda" else torch.float32
+    key = (str(device), dtype)
+    if key in _frame_interpolation_models:
+        return _frame_interpolation_models[key]
+
     print("Initializing frame interpolation model")
     checkpoint_name = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),"pretrained_model/film_net_fp16.pt")
     #checkpoint_name = os.path.join("./pretrained_model/film_net_fp16.pt")
 
     model = torch.jit.load(checkpoint_name, map_location='cpu')
     model.eval()
-    model = model.half()
-    model = model.to(device="cuda")
+    model = model.to(device=device, dtype=dtype)
+    _frame_interpolation_models[key] = model
     return model
 
 
-def batch_images_interpolation_tool(input_tensor, model, inter_frames=1):
+def interpolation_schedule(inter_frames):
+    """
+    Bisection order of `batch_images_interpolation_tool` for `inter_frames` frames between a pair, grouped in levels.
+    Every step is (start, end, new, dt) in slot indices, the steps of one level only depend on earlier levels.
+    """
+    idxes = [0, inter_frames + 1]
+    remains = list(range(1, inter_frames + 1))
+    splits = torch.linspace(0, 1, inter_frames + 2)
+    slot_level = {0: 0, inter_frames + 1: 0}
+    levels = []
+
+    for _ in range(len(remains)):
+        starts = splits[idxes[:-1]]
+        ends = splits[idxes[1:]]
+        distances = ((splits[None, remains] - starts[:, None]) / (ends[:, None] - starts[:, None]) - .5).abs()
+        matrix = torch.argmin(distances).item()
+        start_i, step = np.unravel_index(matrix, distances.shape)
+        start, end, new = idxes[start_i], idxes[start_i + 1], remains[step]
+
+        # kept as tensors so dt is rounded exactly like the per pair loop did
+        dt = (splits[new] - splits[start], splits[end] - splits[start])
+        level = max(slot_level[start], slot_level[end]) + 1
+        slot_level[new] = level
+        if len(levels) < level:
+            levels.append([])
+        levels[level - 1].append((start, end, new, dt))
+
+        idxes.insert(bisect.bisect_left(idxes, new), new)
+        del remains[step]
+    return levels
+
+
+def landmark_motion(landmarks, size=1.0):
+    """
+    Mean landmark displacement between consecutive frames of `landmarks` (frame, points, 2 or 3), as a fraction of
+    `size` (the frame size the landmarks are in).
+    """
+    landmarks = np.asarray(landmarks, dtype=np.float32)[..., :2]
+    return np.linalg.norm(np.diff(landmarks, axis=0), axis=-1).mean(-1) / size
+
+
+def pose_image_motion(pose_images, size=64):
+    """
+    Mean absolute difference between consecutive rendered pose images (frame, height, width, channel), a stand-in for
+    `landmark_motion` when only the renders are at hand. Compared at `size` x `size`, on the 0..1 scale of ComfyUI
+    IMAGE batches (VideoGenPose's pose_images). Not on the scale of `landmark_motion`: for face mesh renders of
+    talking-head motion it comes out at about half the landmark displacement, less for fast motion, so thresholds for
+    the two differ.
+    """
+    small = np.stack([cv2.resize(np.asarray(x, dtype=np.float32), (size, size), interpolation=cv2.INTER_AREA) for x in pose_images])
+    return np.abs(np.diff(small, axis=0)).reshape(len(small) - 1, -1).mean(-1)
+
+
+def select_keyframes(motion, max_step, motion_threshold):
+    """
+    Frames to generate with diffusion, given the per step `motion` of a sequence of len(motion) + 1 frames. A new
+    keyframe is taken once the motion accumulated since the last one reaches `motion_threshold`, or after `max_step`
+    frames. The first and last frames are always kept, the gaps in between are filled by frame interpolation.
+    """
+    keyframes = [0]
+    accumulated = 0.0
+    for idx, step_motion in enumerate(motion, start=1):
+        accumulated += float(step_motion)
+        if accumulated >= motion_threshold or idx - keyframes[-1] >= max_step or idx == len(motion):
+            keyframes.append(idx)
+            accumulated = 0.0
+    return keyframes
+
+
+def pair_difference(frames, size=64):
+    """
+    Mean absolute difference of every consecutive pair of `frames` (frame, bs, channel, height, width) at `size` x
+    `size`, on the 0..1 scale of the frames.
+    """
+    small = F.adaptive_avg_pool2d(frames.flatten(0, 1).float(), size).unflatten(0, frames.shape[:2])
+    return (small[1:] - small[:-1]).abs().flatten(1).mean(-1)
+
+
+def _blend_pairs(frames, pair_idx, inter_frames):
+    # linear blend, (bs, channel, pairs, inter_frames, height, width)
+    x0 = frames[pair_idx].permute(1, 2, 0, 3, 4).unsqueeze(3)
+    x1 = frames[pair_idx + 1].permute(1, 2, 0, 3, 4).unsqueeze(3)
+    t = torch.arange(1, inter_frames + 1, device=frames.device, dtype=x0.dtype) / (inter_frames + 1)
+    t = t.view(1, 1, 1, -1, 1, 1)
+    return x0 * (1 - t) + x1 * t
+
+
+def _interpolate_pairs(frames, pair_idx, model, levels, inter_frames, device, dtype):
+    bs = frames.shape[1]
+    slots = [None] * (inter_frames + 2)
+    slots[0] = frames[pair_idx].flatten(0, 1).to(device=device, dtype=dtype)
+    slots[-1] = frames[pair_idx + 1].flatten(0, 1).to(device=device, dtype=dtype)
+
+    for level in levels:
+        x0 = torch.cat([slots[start] for start, _, _, _ in level])
+        x1 = torch.cat([slots[end] for _, end, _, _ in level])
+        dt = torch.cat([slots[start].new_full((slots[start].shape[0], 1), a) / b for start, _, _, (a, b) in level])
+        with torch.no_grad():
+            prediction = model(x0, x1, dt).clamp(0, 1)
+        for (_, _, new, _), chunk in zip(level, prediction.chunk(len(level))):
+            slots[new] = chunk
 
-    video_tensor = []
-    frame_num = input_tensor.shape[2]  # bs, channel, frame, height, width
-    
-    for idx in tqdm(range(frame_num-1)):
-        image1 = input_tensor[:,:,idx]
-        image2 = input_tensor[:,:,idx+1]
+    # (inter_frames, pairs * bs, channel, height, width) -> (bs, channel, pairs, inter_frames, height, width)
+    return torch.stack(slots[1:-1]).unflatten(1, (len(pair_idx), bs)).permute(2, 3, 1, 0, 4, 5)
 
-        results = [image1, image2]
 
-        inter_frames = int(inter_frames)
-        idxes = [0, inter_frames + 1]
-        remains = list(range(1, inter_frames + 1))
+def batch_images_interpolation_tool(input_tensor, model, inter_frames=1, batch_size=8, num_workers=None, blend_threshold=0.0):
+    """
+    Inserts `inter_frames` FILM frames between every pair of consecutive frames of `input_tensor` (bs, channel, frame,
+    height, width), or `inter_frames[i]` frames after frame i when a sequence is given. Pairs with the same count are
+    interpolated `batch_size` at a time, every bisection level of them in one model call.
+    Runs on the device and dtype of `model`. On cpu the micro batches are spread over `num_workers` threads (default
+    up to 4) which share the intra-op threads.
+    Pairs whose `pair_difference` is below `blend_threshold` are linearly blended instead of going through FILM.
+    """
+    bs, channel, frame_num, height, width = input_tensor.shape
+    if isinstance(inter_frames, (int, float)):
+        inter_frames = [int(inter_frames)] * max(frame_num - 1, 0)
+    inter_frames = [max(int(n), 0) for n in inter_frames]
+    if len(inter_frames) != max(frame_num - 1, 0):
+        raise ValueError(f"Expected {frame_num - 1} interpolation counts, got {len(inter_frames)}")
 
-        splits = torch.linspace(0, 1, inter_frames + 2)
+    # output index of every input frame
+    offsets = np.concatenate([[0], np.cumsum(np.array(inter_frames, dtype=np.int64) + 1)])
+    video_tensor = input_tensor.new_empty((bs, channel, int(offsets[-1]) + 1, height, width))
+    video_tensor[:, :, torch.from_numpy(offsets)] = input_tensor
+    if sum(inter_frames) == 0:
+        return video_tensor
 
-        for _ in range(len(remains)):
-            starts = splits[idxes[:-1]]
-            ends = splits[idxes[1:]]
-            distances = ((splits[None, remains] - starts[:, None]) / (ends[:, None] - starts[:, None]) - .5).abs()
-            matrix = torch.argmin(distances).item()
-            start_i, step = np.unravel_index(matrix, distances.shape)
-            end_i = start_i + 1
+    parameter = next(model.parameters())
+    device, dtype = parameter.device, parameter.dtype
+    # (frame, bs, channel, height, width), pairs of a micro batch are stacked on the batch dim
+    frames = input_tensor.permute(2, 0, 1, 3, 4)
+    positions = torch.from_numpy(offsets)
 
-            x0 = results[start_i]
-            x1 = results[end_i]
+    def write(pair_idx, inter):
+        inter = inter.to(device=video_tensor.device, dtype=video_tensor.dtype)
+        for j in range(inter.shape[3]):
+            video_tensor[:, :, positions[pair_idx] + 1 + j] = inter[:, :, :, j]
 
-            x0 = x0.half()
-            x1 = x1.half()
-            x0 = x0.cuda()
-            x1 = x1.cuda()
+    blend = [False] * len(inter_frames)
+    if blend_threshold > 0:
+        blend = (pair_difference(frames) < blend_threshold).tolist()
+    for n in set(inter_frames) - {0}:
+        pairs = [idx for idx, count in enumerate(inter_frames) if count == n and blend[idx]]
+        if pairs:
+            write(torch.tensor(pairs), _blend_pairs(frames, torch.tensor(pairs), n))
+    if blend_threshold > 0:
+        film_pairs = sum(1 for n, b in zip(inter_frames, blend) if n > 0 and not b)
+        blend_pairs = sum(1 for n, b in zip(inter_frames, blend) if n > 0 and b)
+        print(f"frame interpolation: {film_pairs} pairs with FILM, {blend_pairs} pairs blended")
 
-            dt = x0.new_full((1, 1), (splits[remains[step]] - splits[idxes[start_i]])) / (splits[idxes[end_i]] - splits[idxes[start_i]])
+    levels = {n: interpolation_schedule(n) for n in set(inter_frames) if n > 0}
+    jobs = []
+    for n in sorted(levels):
+        pairs = [idx for idx, count in enumerate(inter_frames) if count == n and not blend[idx]]
+        jobs += [(n, torch.tensor(pairs[k:k + batch_size])) for k in range(0, len(pairs), batch_size)]
 
-            with torch.no_grad():
-                prediction = model(x0, x1, dt)
-            insert_position = bisect.bisect_left(idxes, remains[step])
-            idxes.insert(insert_position, remains[step])
-            results.insert(insert_position, prediction.clamp(0, 1).cpu().float())
-            del remains[step]
+    def interpolate(job):
+        n, pair_idx = job
+        write(pair_idx, _interpolate_pairs(frames, pair_idx, model, levels[n], n, device, dtype))
 
-        for sub_idx in range(len(results)-1):
-            video_tensor.append(results[sub_idx].unsqueeze(2))
+    if not jobs:
+        return video_tensor
+    if device.type != "cpu":
+        for job in tqdm(jobs):
+            interpolate(job)
+        return video_tensor
 
-    video_tensor.append(input_tensor[:,:,-1].unsqueeze(2))
-    video_tensor = torch.cat(video_tensor, dim=2)
+    if num_workers is None:
+        num_workers = min(4, len(jobs), os.cpu_count() or 1)
+    num_threads = torch.get_num_threads()
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // max(1, num_workers)))
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+            list(tqdm(executor.map(interpolate, jobs), total=len(jobs)))
+    finally:
+        torch.set_num_threads(num_threads)
     return video_tensor
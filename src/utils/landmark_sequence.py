@@ -0,0 +1,92 @@
+import os
+
+import numpy as np
+
+from .mp_utils import stack_lmk_results
+
+
+class LandmarkSequence:
+    """
+    A tracked face over a video as a struct of arrays, passed between nodes as LANDMARK_SEQUENCE instead of rendered
+    pose images. Holds the normalised `lmks` (n, 478, 3), `lmks3d` (n, 478, 3) and blendshapes `bs` (n, 51) in
+    float16, the `trans_mat` (n, 4, 4) in float32 (translations do not fit float16 precision), a `valid` (n,) mask for
+    frames with a face, the `fps` of the source and the (width, height) `frame_size` of the frames the landmarker ran
+    on, which the 3D pose was solved for. A few MB for thousands of frames, pose images are only rendered by `render`
+    at the size the consumer needs.
+    """
+
+    ARRAYS = ("lmks", "lmks3d", "bs", "trans_mat", "valid")
+
+    def __init__(self, lmks, lmks3d, bs, trans_mat, valid, fps=30, frame_size=None):
+        self.lmks = lmks
+        self.lmks3d = lmks3d
+        self.bs = bs
+        self.trans_mat = trans_mat
+        self.valid = valid
+        self.fps = fps
+        self.frame_size = tuple(int(v) for v in frame_size) if frame_size is not None else None
+
+    @classmethod
+    def from_results(cls, results, fps=30, frame_size=None):
+        # LMKExtractor results, None for frames without a face, of frames of the (width, height) `frame_size`
+        batch = stack_lmk_results(results)
+        if not batch["valid"].any():
+            raise ValueError("Can not detect a face in any frame.")
+        return cls(
+            lmks=batch["lmks"].astype(np.float16),
+            lmks3d=batch["lmks3d"].astype(np.float16),
+            bs=batch["bs"].astype(np.float16),
+            trans_mat=batch["trans_mat"].astype(np.float32),
+            valid=batch["valid"],
+            fps=fps,
+            frame_size=frame_size,
+        )
+
+    def __len__(self):
+        return len(self.valid)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for name in self.ARRAYS:
+            np.save(os.path.join(path, f"{name}.npy"), getattr(self, name))
+        np.save(os.path.join(path, "fps.npy"), np.array(float(self.fps)))
+        if self.frame_size is not None:
+            np.save(os.path.join(path, "frame_size.npy"), np.array(self.frame_size))
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        mmap_mode = "r" if mmap else None
+        arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode) for name in cls.ARRAYS}
+        frame_size_path = os.path.join(path, "frame_size.npy")
+        frame_size = np.load(frame_size_path) if os.path.exists(frame_size_path) else None
+        return cls(fps=float(np.load(os.path.join(path, "fps.npy"))), frame_size=frame_size, **arrays)
+
+    def memory_mapped(self, path):
+        # the same sequence backed by files under `path`, so it stays out of memory between nodes
+        self.save(path)
+        return self.load(path, mmap=True)
+
+    def filled_indices(self):
+        # index of the frame to draw for every frame, frames without a face repeat the last one with a face
+        indices = np.where(self.valid, np.arange(len(self)), 0)
+        np.maximum.accumulate(indices, out=indices)
+        first_valid = int(np.argmax(self.valid))
+        indices[: first_valid] = first_valid
+        return indices
+
+    def render(self, visualizer, size, indices=None):
+        """
+        Draws the (width, height) `size` BGR uint8 pose images of the frames `indices` (all by default) with the
+        FaceMeshVisualizer `visualizer`.
+        """
+        if indices is None:
+            indices = np.arange(len(self))
+        source = self.filled_indices()[np.asarray(indices, dtype=np.int64)]
+        return visualizer.draw_landmarks_batch(self.lmks[source].astype(np.float32), size, normed=True)
+
+    def render_images(self, visualizer, size, indices=None):
+        """
+        `render` as a ComfyUI IMAGE batch, RGB float32 in 0..1.
+        """
+        pose_images = self.render(visualizer, size, indices)
+        return np.divide(pose_images[..., ::-1], np.float32(255), dtype=np.float32)
@@ -4,7 +4,13 @@ import cv2
 import time
 from tqdm import tqdm
 import multiprocessing
+import sys
+import types
+from multiprocessing import shared_memory
 import glob
+import hashlib
+import shutil
+import tempfile
 
 import mediapipe as mp
 from mediapipe import solutions
@@ -12,15 +18,25 @@ from mediapipe.framework.formats import landmark_pb2
 from mediapipe.tasks import python
 from mediapipe.tasks.python import vision
 from . import face_landmark
+from .pose_util import interpolate_trans_mats
 
 CUR_DIR = os.path.dirname(__file__)
+LANDMARKER_ASSET = os.path.join(CUR_DIR, 'mp_models/face_landmarker_v2_with_blendshapes.task')
+WORKER_DIR = os.path.join(CUR_DIR, 'mp_worker')
 
 
 class LMKExtractor():
-    def __init__(self, FPS=25):
+    def __init__(self, FPS=25, mode="image"):
         # Create an FaceLandmarker object.
-        self.mode = mp.tasks.vision.FaceDetectorOptions.running_mode.IMAGE
-        base_options = python.BaseOptions(model_asset_path=os.path.join(CUR_DIR, 'mp_models/face_landmarker_v2_with_blendshapes.task'))
+        # "video" tracks the face roi from frame to frame and only runs face detection again once tracking is lost,
+        # frames then have to come in order with increasing timestamps
+        if mode not in ("image", "video"):
+            raise ValueError(f"Unknown running mode {mode}, expected 'image' or 'video'")
+        if mode == "video":
+            self.mode = mp.tasks.vision.FaceDetectorOptions.running_mode.VIDEO
+        else:
+            self.mode = mp.tasks.vision.FaceDetectorOptions.running_mode.IMAGE
+        base_options = python.BaseOptions(model_asset_path=LANDMARKER_ASSET)
         base_options.delegate = mp.tasks.BaseOptions.Delegate.CPU
         options = vision.FaceLandmarkerOptions(base_options=base_options,
                                             running_mode=self.mode,
@@ -28,6 +44,8 @@ class LMKExtractor():
                                             output_facial_transformation_matrixes=True,
                                             num_faces=1)
         self.detector = face_landmark.FaceLandmarker.create_from_options(options)
+        self.fps = FPS
+        self.faces = None
         self.last_ts = 0
         self.frame_ms = int(1000 / FPS)
 
@@ -36,17 +54,22 @@ class LMKExtractor():
         self.det_detector = vision.FaceDetector.create_from_options(det_options)
                 
 
-    def __call__(self, img):
+    def frame_timestamp(self, index):
+        # timestamp in ms of frame `index` of a source running at FPS
+        return int(round(index * 1000 / self.fps))
+
+    def __call__(self, img, timestamp_ms=None):
         frame = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
         image = mp.Image(image_format=mp.ImageFormat.SRGB, data=frame)
         t0 = time.time()
         if self.mode == mp.tasks.vision.FaceDetectorOptions.running_mode.VIDEO:
-            det_result = self.det_detector.detect(image)
-            if len(det_result.detections) != 1:
-                return None
-            self.last_ts += self.frame_ms
+            # the landmarker re-detects by itself when it loses the face, no separate detector pass per frame
+            if timestamp_ms is None:
+                timestamp_ms = self.last_ts + self.frame_ms
+            # mediapipe rejects timestamps that do not increase
+            self.last_ts = max(int(timestamp_ms), self.last_ts + 1)
             try:
-                detection_result, mesh3d = self.detector.detect_for_video(image, timestamp_ms=self.last_ts)
+                result = self.detector.detect_for_video(image, timestamp_ms=self.last_ts, as_arrays=True)
             except:
                 return None
         elif self.mode == mp.tasks.vision.FaceDetectorOptions.running_mode.IMAGE:
@@ -55,41 +78,359 @@ class LMKExtractor():
             # if len(det_result.detections) != 1:
             #     return None
             try:
-                detection_result, mesh3d = self.detector.detect(image)
+                result = self.detector.detect(image, as_arrays=True)
             except:
                 return None
-            
-        
-        bs_list = detection_result.face_blendshapes
-        if len(bs_list) == 1:
-            bs = bs_list[0]
-            bs_values = []
-            for index in range(len(bs)):
-                bs_values.append(bs[index].score)
-            bs_values = bs_values[1:] # remove neutral
-            trans_mat = detection_result.facial_transformation_matrixes[0]
-            face_landmarks_list = detection_result.face_landmarks
-            face_landmarks = face_landmarks_list[0]
-            lmks = []
-            for index in range(len(face_landmarks)):
-                x = face_landmarks[index].x
-                y = face_landmarks[index].y
-                z = face_landmarks[index].z
-                lmks.append([x, y, z])
-            lmks = np.array(lmks)
-            
-            lmks3d = np.array(mesh3d.vertex_buffer)
-            lmks3d = lmks3d.reshape(-1, 5)[:, :3]
-            mp_tris = np.array(mesh3d.index_buffer).reshape(-1, 3) + 1
-
-            return {
-                "lmks": lmks,
-                'lmks3d': lmks3d,
-                "trans_mat": trans_mat,
-                'faces': mp_tris,
-                "bs": bs_values
-            }
-        else:
+
+        if result is None or len(result['blendshapes']) == 0:
             # print('multiple faces in the image: {}'.format(img_path))
             return None
-        
+
+        if self.faces is None:
+            # the mesh topology is fixed, the triangles are read once
+            self.faces = np.array(result['index_buffer']).reshape(-1, 3) + 1
+        return {
+            "lmks": result['lmks'],
+            'lmks3d': result['vertex_buffer'].reshape(-1, 5)[:, :3],
+            "trans_mat": result['trans_mat'],
+            'faces': self.faces,
+            "bs": result['blendshapes'][1:] # remove neutral
+        }
+
+
+def stack_lmk_results(results):
+    """
+    Struct of arrays view of a list of LMKExtractor results: (n, ...) `lmks`, `lmks3d`, `trans_mat` and `bs` arrays,
+    zero where `valid` (n,) is False, plus the shared `faces`.
+    """
+    faces = [r for r in results if r is not None]
+    if not faces:
+        return {"valid": np.zeros(len(results), dtype=bool)}
+    first = faces[0]
+    batch = {
+        "valid": np.array([r is not None for r in results]),
+        "faces": first["faces"],
+    }
+    for name in ("lmks", "lmks3d", "trans_mat", "bs"):
+        array = np.zeros((len(results),) + np.shape(first[name]), dtype=np.float64)
+        for idx, r in enumerate(results):
+            if r is not None:
+                array[idx] = r[name]
+        batch[name] = array
+    return batch
+
+
+class LMKExtractorPool():
+    """
+    Runs LMKExtractor over a batch of same sized BGR frames in `num_workers` processes, each holding its own
+    extractor. The frames are shared with the workers through one shared memory buffer and processed in chunks of
+    `chunk_size`, results come back in frame order. With `num_workers` <= 1 everything runs in this process.
+    In "video" mode the landmarker tracks the face from the previous frame, so every worker gets one contiguous span
+    of the frames instead and starts it with a fresh landmarker. Frame i gets the timestamp of index i at the
+    extractor's FPS, increasing within every span. A call can override the running `mode`, e.g. "image" for frames
+    that are not a sequence.
+    The workers are spawned, not forked from the ComfyUI process, without the parent's `__main__` (ComfyUI's
+    main.py), and run the top level `aniportrait_lmk_worker` module, which imports the utils modules without the node
+    package.
+    """
+
+    def __init__(self, num_workers=None, chunk_size=16, **extractor_kwargs):
+        if num_workers is None or num_workers <= 0:
+            num_workers = min(8, os.cpu_count() or 1)
+        self.num_workers = num_workers
+        self.chunk_size = chunk_size
+        self.extractor_kwargs = extractor_kwargs
+        self.extractors = {}
+        self.pool = None
+        self.worker = None
+
+    @property
+    def sequential(self):
+        # video mode tracks the face through the frames of a call, they have to be one consecutive sequence
+        return self.extractor_kwargs.get("mode", "image") == "video"
+
+    def _start(self):
+        if self.num_workers > 1 and self.pool is None:
+            # spawned workers get the parent's sys.path, they unpickle the worker functions from there
+            if WORKER_DIR not in sys.path:
+                sys.path.append(WORKER_DIR)
+            import aniportrait_lmk_worker
+
+            # "spawn" runs the parent's __main__ again in every worker, inside ComfyUI its main.py with the custom
+            # node prestartup scripts, torch and comfy. The workers need none of it, they start from a blank __main__
+            context = multiprocessing.get_context("spawn")
+            main = sys.modules["__main__"]
+            sys.modules["__main__"] = types.ModuleType("__main__")
+            try:
+                self.pool = context.Pool(self.num_workers, initializer=aniportrait_lmk_worker.init,
+                                         initargs=(CUR_DIR, self.extractor_kwargs))
+            finally:
+                sys.modules["__main__"] = main
+            self.worker = aniportrait_lmk_worker
+
+    def __call__(self, frames, mode=None):
+        frames = np.ascontiguousarray(np.asarray(frames), dtype=np.uint8)
+        mode = mode or self.extractor_kwargs.get("mode", "image")
+        video = mode == "video"
+        self._start()
+        if self.pool is None:
+            if video or mode not in self.extractors:
+                # tracking starts over for every batch
+                self.extractors[mode] = LMKExtractor(**dict(self.extractor_kwargs, mode=mode))
+            extractor = self.extractors[mode]
+            return [extractor(frame, timestamp_ms=extractor.frame_timestamp(i)) for i, frame in enumerate(tqdm(frames))]
+
+        shm = shared_memory.SharedMemory(create=True, size=max(frames.nbytes, 1))
+        try:
+            np.ndarray(frames.shape, dtype=np.uint8, buffer=shm.buf)[:] = frames
+            if video:
+                bounds = np.linspace(0, len(frames), min(self.num_workers, len(frames)) + 1).astype(int)
+                tasks = [(shm.name, frames.shape, start, end, mode, True) for start, end in zip(bounds[:-1], bounds[1:])]
+            else:
+                tasks = [(shm.name, frames.shape, start, min(start + self.chunk_size, len(frames)), mode, False)
+                         for start in range(0, len(frames), self.chunk_size)]
+            results = []
+            for chunk in tqdm(self.pool.imap(self.worker.extract, tasks), total=len(tasks)):
+                results.extend(chunk)
+            return results
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class SparseLMKExtractor():
+    """
+    Runs the batch `extractor` (LMKExtractorPool) only on every `every`-th frame and on the last one, and fills the
+    frames in between by interpolating between the two nearest keyframes with a face: linear `lmks`, `lmks3d` and
+    `bs`, slerp of the `trans_mat` rotation. With `motion_threshold` > 0 the keyframe gaps whose mean landmark
+    displacement (normalised coordinates) exceeds it are bisected and their middle frame extracted as well, until the
+    motion is below the threshold or the gap is closed. Gaps with a face at one end only are always bisected down to
+    the frame where the face appears or disappears, so the results have None on the same frames as a dense
+    extraction. Gaps without a face at either end stay None.
+    The keyframes go to the extractor as one sequence. The middle frames of a refinement pass come from different gaps,
+    a `sequential` extractor (a tracker) gets them in "image" mode.
+    """
+
+    def __init__(self, extractor, every=4, motion_threshold=0.0):
+        self.extractor = extractor
+        self.every = max(1, int(every))
+        self.motion_threshold = motion_threshold
+
+    @staticmethod
+    def motion(a, b):
+        if a is None or b is None:
+            return np.inf
+        return float(np.linalg.norm(a["lmks"][:, :2] - b["lmks"][:, :2], axis=-1).mean())
+
+    @property
+    def sequential(self):
+        # keyframes are interpolated, the frames of a call have to be one consecutive sequence
+        return self.every > 1 or getattr(self.extractor, "sequential", True)
+
+    def refine(self, first, last):
+        # whether the gap between two extracted frames needs its middle frame
+        if (first is None) != (last is None):
+            return True
+        return self.motion_threshold > 0 and self.motion(first, last) > self.motion_threshold
+
+    def __call__(self, frames):
+        frames = np.asarray(frames)
+        n = len(frames)
+        if n == 0 or self.every == 1:
+            return self.extractor(frames)
+
+        keyframes = sorted(set(range(0, n, self.every)) | {n - 1})
+        extracted = dict(zip(keyframes, self.extractor(frames[keyframes])))
+        while True:
+            keys = sorted(extracted)
+            refine = [(a + b) // 2 for a, b in zip(keys[:-1], keys[1:]) if b - a > 1 and self.refine(extracted[a], extracted[b])]
+            if not refine:
+                break
+            if getattr(self.extractor, "sequential", False):
+                extracted.update(zip(refine, self.extractor(frames[refine], mode="image")))
+            else:
+                extracted.update(zip(refine, self.extractor(frames[refine])))
+        print(f"sparse landmarks: {len(extracted)} of {n} frames extracted")
+        return self.fill(extracted, n)
+
+    @staticmethod
+    def fill(extracted, n):
+        # dense results from the {frame index: result} of the extracted frames
+        results = [None] * n
+        for idx, result in extracted.items():
+            results[idx] = result
+        keys = sorted(extracted)
+        for a, b in zip(keys[:-1], keys[1:]):
+            first, last = extracted[a], extracted[b]
+            if b - a <= 1 or first is None or last is None:
+                continue
+            times = np.arange(a + 1, b)
+            weights = (times - a) / (b - a)
+            trans_mats = interpolate_trans_mats([a, b], [first["trans_mat"], last["trans_mat"]], times)
+            for idx, w, trans_mat in zip(times, weights, trans_mats):
+                results[idx] = {
+                    "lmks": (1 - w) * first["lmks"] + w * last["lmks"],
+                    "lmks3d": (1 - w) * first["lmks3d"] + w * last["lmks3d"],
+                    "trans_mat": trans_mat,
+                    "faces": first["faces"],
+                    "bs": (1 - w) * np.asarray(first["bs"]) + w * np.asarray(last["bs"]),
+                }
+        return results
+
+
+class LandmarkCache():
+    """
+    On-disk store of LMKExtractor results. One directory per driving video, keyed by the video fingerprint (frame
+    size and first frame), the frame size the landmarks were extracted at, the landmarker asset hash and `extra`
+    (e.g. the running mode). It holds one row per frame index of compact `.npy` arrays (lmks, lmks3d, trans_mat, bs),
+    memory-mapped on read, plus a per frame content digest, so only frames that are missing or changed are extracted
+    again. Least recently used videos are evicted once the store exceeds `max_bytes`.
+    The nodes keep the store in ComfyUI's temp directory, the ANIPORTRAIT_LANDMARK_CACHE environment variable
+    overrides `cache_dir`.
+    """
+
+    MISSING, FACE, NO_FACE = 0, 1, 2
+
+    def __init__(self, cache_dir=None, max_bytes=2 * 1024 ** 3):
+        self.cache_dir = os.environ.get("ANIPORTRAIT_LANDMARK_CACHE") or cache_dir or os.path.join(
+            tempfile.gettempdir(), "aniportrait_landmarks")
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def frame_digest(frame):
+        return int.from_bytes(hashlib.blake2b(np.ascontiguousarray(frame).tobytes(), digest_size=8).digest(), "little")
+
+    def video_dir(self, frames, digests, extra=""):
+        # imported here, LMKExtractor alone (in the pool workers) does not need torch and av of util
+        from .util import fingerprint_index
+
+        key = hashlib.blake2b(digest_size=16)
+        key.update(repr((frames.shape[1:], int(digests[0]), fingerprint_index.get(LANDMARKER_ASSET), extra)).encode())
+        return os.path.join(self.cache_dir, key.hexdigest())
+
+    def _load(self, video_dir):
+        try:
+            return {name: np.load(os.path.join(video_dir, f"{name}.npy"), mmap_mode="r")
+                    for name in ("digest", "state", "lmks", "lmks3d", "trans_mat", "bs", "faces")}
+        except (OSError, ValueError):
+            return None
+
+    def _save(self, video_dir, arrays):
+        os.makedirs(video_dir, exist_ok=True)
+        for name, array in arrays.items():
+            tmp_path = os.path.join(video_dir, f"{name}.{os.getpid()}.tmp.npy")
+            np.save(tmp_path, array)
+            os.replace(tmp_path, os.path.join(video_dir, f"{name}.npy"))
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if os.path.isdir(path):
+                size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+                entries.append((os.path.getmtime(path), size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def extract(self, frames, extractor, extra=""):
+        """
+        LMKExtractor results for the (n, h, w, 3) BGR `frames`, in order. `extractor` maps a batch of frames to
+        their results (LMKExtractorPool) and only sees the frames without a valid stored row. Unless the extractor
+        says it is not `sequential` (image mode, every frame extracted), it tracks or interpolates through its frames,
+        and gets every run of consecutive missing frames in a call of its own.
+        """
+        frames = np.asarray(frames)
+        if len(frames) == 0:
+            return []
+        digests = np.array([self.frame_digest(frame) for frame in frames], dtype=np.uint64)
+        video_dir = self.video_dir(frames, digests, extra)
+        stored = self._load(video_dir)
+
+        n = len(frames)
+        hit = np.zeros(n, dtype=bool)
+        if stored is not None:
+            m = min(n, len(stored["digest"]))
+            hit[:m] = (stored["digest"][:m] == digests[:m]) & (stored["state"][:m] != self.MISSING)
+        missing = np.flatnonzero(~hit)
+        if len(missing) and getattr(extractor, "sequential", True):
+            runs = np.split(missing, np.flatnonzero(np.diff(missing) > 1) + 1)
+            computed = [result for run in runs for result in extractor(frames[run])]
+        else:
+            computed = extractor(frames[missing]) if len(missing) else []
+
+        if len(missing):
+            arrays = self._merge(stored, n, digests, missing, computed)
+            # the memory maps have to be closed before their files are replaced, windows refuses otherwise
+            stored = None
+            if arrays is not None:
+                self._save(video_dir, arrays)
+                self.evict()
+                stored = self._load(video_dir)
+        elif os.path.isdir(video_dir):
+            os.utime(video_dir)
+
+        results = [None] * n
+        for idx, result in zip(missing, computed):
+            results[idx] = result
+        if stored is not None:
+            for idx in np.flatnonzero(hit):
+                if stored["state"][idx] == self.FACE:
+                    results[idx] = {
+                        "lmks": np.array(stored["lmks"][idx], dtype=np.float64),
+                        "lmks3d": np.array(stored["lmks3d"][idx], dtype=np.float64),
+                        "trans_mat": np.array(stored["trans_mat"][idx]),
+                        "faces": np.array(stored["faces"]),
+                        "bs": np.array(stored["bs"][idx], dtype=np.float64),
+                    }
+        print(f"landmark cache: {int(hit.sum())} of {n} frames stored, {len(missing)} extracted")
+        return results
+
+    def _merge(self, stored, n, digests, missing, computed):
+        faces = [r for r in computed if r is not None]
+        if stored is None and not faces:
+            return None
+        size = max(n, len(stored["digest"])) if stored is not None else n
+        if stored is not None:
+            arrays = {name: np.array(stored[name]) for name in stored}
+            if len(arrays["digest"]) < size:
+                for name in ("digest", "state", "lmks", "lmks3d", "trans_mat", "bs"):
+                    pad = np.zeros((size - len(arrays[name]),) + arrays[name].shape[1:], dtype=arrays[name].dtype)
+                    arrays[name] = np.concatenate([arrays[name], pad])
+        else:
+            face = faces[0]
+            arrays = {
+                "digest": np.zeros(size, dtype=np.uint64),
+                "state": np.zeros(size, dtype=np.uint8),
+                "lmks": np.zeros((size,) + face["lmks"].shape, dtype=np.float32),
+                "lmks3d": np.zeros((size,) + face["lmks3d"].shape, dtype=np.float32),
+                "trans_mat": np.zeros((size, 4, 4), dtype=np.float64),
+                "bs": np.zeros((size, len(face["bs"])), dtype=np.float32),
+                "faces": np.asarray(face["faces"], dtype=np.int32),
+            }
+        arrays["digest"][:n] = digests
+        for idx, result in zip(missing, computed):
+            if result is None:
+                arrays["state"][idx] = self.NO_FACE
+                continue
+            arrays["state"][idx] = self.FACE
+            arrays["lmks"][idx] = result["lmks"]
+            arrays["lmks3d"][idx] = result["lmks3d"]
+            arrays["trans_mat"][idx] = result["trans_mat"]
+            arrays["bs"][idx] = result["bs"]
+        return arrays
@@ -0,0 +1,44 @@
+"""
+Worker side of LMKExtractorPool. The pool starts its processes with "spawn", which imports the pool's functions by
+module name in every worker, and hides the parent's __main__ while it does, so ComfyUI's main.py is not run again.
+This module is imported top level from its own directory, so a worker does not import the node package (and ComfyUI
+with it), only the utils modules, as a package of their own.
+"""
+import importlib
+import sys
+import types
+from multiprocessing import shared_memory
+
+import numpy as np
+
+_mp_utils = None
+_extractor_kwargs = None
+_extractors = {}
+_buffers = {}
+
+
+def init(utils_dir, extractor_kwargs):
+    global _mp_utils, _extractor_kwargs
+    if "aniportrait_utils" not in sys.modules:
+        package = types.ModuleType("aniportrait_utils")
+        package.__path__ = [utils_dir]
+        sys.modules["aniportrait_utils"] = package
+    _mp_utils = importlib.import_module("aniportrait_utils.mp_utils")
+    _extractor_kwargs = extractor_kwargs
+    _extractors[extractor_kwargs.get("mode", "image")] = _mp_utils.LMKExtractor(**extractor_kwargs)
+
+
+def extract(task):
+    shm_name, shape, start, end, mode, reset = task
+    if shm_name not in _buffers:
+        # one buffer per call of the pool, drop the ones of earlier calls
+        for shm in _buffers.values():
+            shm.close()
+        _buffers.clear()
+        _buffers[shm_name] = shared_memory.SharedMemory(name=shm_name)
+    if reset or mode not in _extractors:
+        # a fresh landmarker, it must not track on from the face of another span
+        _extractors[mode] = _mp_utils.LMKExtractor(**dict(_extractor_kwargs, mode=mode))
+    extractor = _extractors[mode]
+    frames = np.ndarray(shape, dtype=np.uint8, buffer=_buffers[shm_name].buf)
+    return [extractor(frames[i], timestamp_ms=extractor.frame_timestamp(i)) for i in range(start, end)]
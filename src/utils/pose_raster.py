@@ -0,0 +1,98 @@
+import torch
+
+from .draw_util import FaceMeshVisualizer
+
+
+class FaceMeshRasterizer:
+    r"""
+    Renders face mesh pose conditions with torch, on `device`, straight from projected landmarks. Uses the edge and
+    colour tables of a `FaceMeshVisualizer` and draws every edge as an anti-aliased segment with round caps, as wide
+    as the visualizer's lines after resizing from its canvas. Landmarks are snapped to the centre of the canvas pixel
+    the visualizer draws them at (`floor(x * canvas)`), edges are composited in the visualizer's drawing order and
+    edges with a landmark outside the image are skipped, so images match `draw_landmarks` up to the anti-aliasing
+    along the line borders (BGR, 0..255 pixel scale).
+    Every edge is only evaluated in a square window around it, as large as the longest edge of its colour, and all
+    edges of a colour are drawn at once.
+    """
+
+    def __init__(self, visualizer=None, device="cpu"):
+        visualizer = visualizer or FaceMeshVisualizer(forehead_edge=False)
+        self.device = torch.device(device)
+        self.thickness = visualizer.thickness
+        self.canvas_size = visualizer.canvas_size
+        self.runs = [
+            (
+                torch.tensor(color, dtype=torch.float32, device=self.device),
+                torch.as_tensor(edges, dtype=torch.long, device=self.device),
+            )
+            for color, edges in visualizer.edge_runs
+        ]
+
+    def render(self, keypoints, size, image_size=None, normed=False):
+        r"""
+        (t, 3, height, width) float images in 0..255 of the (t, 478, 2 or 3) `keypoints`, drawn at the (width, height)
+        `size`. Keypoints are pixels in `image_size` (default `size`) unless `normed`.
+        """
+        width, height = size
+        canvas_size = self.canvas_size or size
+        # float32 normalised landmarks, as the visualizer rounds them
+        points = torch.as_tensor(keypoints, device=self.device)[..., :2].double()
+        if not normed:
+            points = points / torch.tensor(image_size or size, dtype=torch.float64, device=self.device)
+        points = points.float().double()
+        valid = ((points >= 0) & (points <= 1)).all(-1)
+        # centre of the canvas pixel of every landmark, in the pixels of `size`
+        canvas = torch.tensor(canvas_size, dtype=torch.float64, device=self.device)
+        pixels = torch.minimum((points * canvas).nan_to_num().floor().clamp_min(0), canvas - 1)
+        points = ((pixels + 0.5) * torch.tensor(size, dtype=torch.float64, device=self.device) / canvas).float()
+
+        # line radius of the visualizer's lines once resized to `size`, cv2 fills thickness + 1 pixels across a line of
+        # even thickness (3 rows for the thickness 2 of the visualizer)
+        scale = (width / canvas_size[0] + height / canvas_size[1]) / 2
+        radius = (self.thickness + 1) / 2 * scale
+        reach = radius + 0.5
+
+        images = torch.zeros((len(points), 3, height * width), device=self.device)
+        coverage = torch.zeros((len(points), height * width), device=self.device)
+        for color, run_edges in self.runs:
+            a, b = points[:, run_edges[:, 0]], points[:, run_edges[:, 1]]  # (t, e, 2)
+            # window side covering the longest edge of the colour with its line width
+            window = int((a - b).abs().amax().item() + 2 * reach) + 2
+            steps = torch.arange(window, device=self.device)
+            origin = (torch.minimum(a, b) - reach).floor().long()
+            px = origin[..., 0, None] + steps  # (t, e, window)
+            py = origin[..., 1, None] + steps
+            # distance from every pixel centre of the window to the segment, (t, e, window y, window x)
+            xs, ys = (px + 0.5).unsqueeze(-2), (py + 0.5).unsqueeze(-1)
+            ab = b - a
+            ax, ay = a[..., 0, None, None], a[..., 1, None, None]
+            abx, aby = ab[..., 0, None, None], ab[..., 1, None, None]
+            length2 = (abx * abx + aby * aby).clamp_min(1e-12)
+            t = (((xs - ax) * abx + (ys - ay) * aby) / length2).clamp(0, 1)
+            distance = torch.hypot(xs - ax - t * abx, ys - ay - t * aby)
+            inside = ((px >= 0) & (px < width)).unsqueeze(-2) & ((py >= 0) & (py < height)).unsqueeze(-1)
+            edge_valid = (valid[:, run_edges[:, 0]] & valid[:, run_edges[:, 1]])[..., None, None]
+            edge_coverage = (reach - distance).clamp(0, 1) * (inside & edge_valid)
+            # the strongest edge per pixel, composited over the earlier colours on the window pixels only
+            index = (py.clamp(0, height - 1).unsqueeze(-1) * width + px.clamp(0, width - 1).unsqueeze(-2)).flatten(1)
+            coverage.scatter_reduce_(1, index, edge_coverage.flatten(1), reduce="amax")
+            alpha = coverage.gather(1, index).unsqueeze(1)
+            index = index.unsqueeze(1).expand(-1, 3, -1)
+            blended = images.gather(2, index) * (1 - alpha) + color.view(1, 3, 1) * alpha
+            # pixels in several windows get the same value from each
+            images.scatter_(2, index, blended)
+            coverage.zero_()
+        return images.view(-1, 3, height, width)
+
+    def __call__(self, keypoints, size, image_size=None, normed=False, dtype=torch.float32, batch_size=16):
+        r"""
+        The (1, 3, t, height, width) pose condition of the (t, 478, 2 or 3) `keypoints`, normalised like
+        `Pose2VideoPipeline.prepare_pose_condition` does the uint8 pose images (2 * pixel - 1), in `dtype` on the
+        rasterizer's device. Frames are drawn `batch_size` at a time.
+        """
+        frames = [
+            self.render(keypoints[start : start + batch_size], size, image_size=image_size, normed=normed)
+            for start in range(0, len(keypoints), batch_size)
+        ]
+        pose_cond_tensor = 2.0 * torch.cat(frames) - 1.0
+        return pose_cond_tensor.transpose(0, 1).unsqueeze(0).to(dtype)
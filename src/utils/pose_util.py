@@ -2,6 +2,7 @@ import math
 
 import numpy as np
 from scipy.spatial.transform import Rotation as R
+from scipy.spatial.transform import Slerp
 
 
 def create_perspective_matrix(aspect_ratio):
@@ -87,3 +88,23 @@ def smooth_pose_seq(pose_seq, window_size=5):
         smoothed_pose_seq[i] = np.mean(pose_seq[start:end], axis=0)
 
     return smoothed_pose_seq
+
+
+def interpolate_trans_mats(key_times, key_mats, times):
+    """
+    Transformation matrices at `times` between the (k, 4, 4) `key_mats` at increasing `key_times`: slerp of the
+    rotation, linear translation and scale.
+    """
+    key_times = np.asarray(key_times, dtype=np.float64)
+    key_mats = np.asarray(key_mats, dtype=np.float64)
+    times = np.asarray(times, dtype=np.float64)
+    linear = key_mats[:, :3, :3]
+    scales = np.cbrt(np.linalg.det(linear))
+    rotations = R.from_matrix(linear / scales[:, None, None])
+
+    mats = np.tile(np.eye(4), (len(times), 1, 1))
+    scale = np.interp(times, key_times, scales)
+    mats[:, :3, :3] = Slerp(key_times, rotations)(times).as_matrix() * scale[:, None, None]
+    for c in range(3):
+        mats[:, c, 3] = np.interp(times, key_times, key_mats[:, c, 3])
+    return mats
@@ -5,9 +5,12 @@ import shutil
 import sys
 from pathlib import Path
 import hashlib
+import json
+import threading
 
 from typing import Iterable
 import subprocess
+import tempfile
 import re
 
 from .logger import logger
@@ -109,6 +112,44 @@ def save_videos_grid(videos: torch.Tensor, path: str, rescale=False, n_rows=6, f
     save_videos_from_pil(outputs, path, fps)
 
 
+def videos_to_images(videos: torch.Tensor, uint8=False):
+    """
+    Converts (b c t h w) videos in 0..1 to a ComfyUI IMAGE batch (t, b*h, w, c) in one go, batch entries stacked
+    vertically like make_grid(nrow=1) without the padding. Returns float32, or uint8 0..255 frames when `uint8` is set.
+    """
+    images = rearrange(videos, "b c t h w -> t (b h) w c")
+    if uint8:
+        out = torch.empty(images.shape, dtype=torch.uint8, device=images.device)
+        # a few frames at a time so the float temporaries stay in cache, copy_ truncates so +0.5 rounds
+        for start in range(0, len(images), 32):
+            out[start:start + 32].copy_(images[start:start + 32].mul(255).add_(0.5).clamp_(0, 255))
+        return out
+    # one copy into a contiguous float32 buffer does the relayout and the cast, clamping it is in place
+    out = torch.empty(images.shape, dtype=torch.float32, device=images.device)
+    return out.copy_(images).clamp_(0, 1)
+
+
+def pose_frames_from_images(images, height, width, device=None, batch_size=32):
+    """
+    ComfyUI IMAGE batch (t, h, w, c) in 0..1 to the uint8 BGR (t, height, width, c) pose frames the pipeline takes, in
+    batched passes on `device` instead of a cv2 round trip per frame. Frames are quantised before the bilinear resize,
+    like the cv2 path did, which lets the cpu resize run on uint8.
+    """
+    out = torch.empty((len(images), height, width, images.shape[-1]), dtype=torch.uint8, device=device)
+    for start in range(0, len(images), batch_size):
+        frames = images[start:start + batch_size].to(device).mul(255).add_(0.5).clamp_(0, 255).to(torch.uint8).flip(-1)
+        if frames.shape[1:3] != (height, width):
+            frames = frames.permute(0, 3, 1, 2)
+            if frames.device.type == "cpu":
+                frames = torch.nn.functional.interpolate(frames, size=(height, width), mode="bilinear", align_corners=False)
+            else:
+                frames = torch.nn.functional.interpolate(frames.float(), size=(height, width), mode="bilinear", align_corners=False)
+                frames = frames.round_().clamp_(0, 255).to(torch.uint8)
+            frames = frames.permute(0, 2, 3, 1)
+        out[start:start + batch_size] = frames
+    return out
+
+
 def read_frames(video_path):
     container = av.open(video_path)
 
@@ -126,6 +167,94 @@ def read_frames(video_path):
     return frames
 
 
+def iter_video_frames(video_path, start=0, end=None, stride=1, size=None, batch_size=16, thread_type="AUTO"):
+    """
+    Streams frames [start:end:stride] of `video_path` as (n, h, w, 3) uint8 RGB numpy batches of up to `batch_size`
+    frames. `size` (width, height) rescales inside PyAV while converting, skipped frames are decoded but never
+    converted. The codec decodes with `thread_type` threading and seeks to the keyframe before `start`.
+    """
+    container = av.open(video_path)
+    try:
+        stream = container.streams.video[0]
+        stream.thread_type = thread_type
+        reformat = {"format": "rgb24"}
+        if size is not None:
+            reformat.update(width=size[0], height=size[1])
+
+        rate, time_base = stream.average_rate, stream.time_base
+        start_time = stream.start_time or 0
+        seekable = start > 0 and rate and time_base
+        if seekable:
+            container.seek(int(start / rate / time_base) + start_time, stream=stream, backward=True)
+
+        batch = []
+        index = -1
+        for frame in container.decode(stream):
+            if seekable and frame.pts is not None:
+                index = int(round((frame.pts - start_time) * time_base * rate))
+            else:
+                index += 1
+            if end is not None and index >= end:
+                break
+            if index < start or (index - start) % stride:
+                continue
+            batch.append(frame.to_ndarray(**reformat))
+            if len(batch) == batch_size:
+                yield np.stack(batch)
+                batch = []
+        if batch:
+            yield np.stack(batch)
+    finally:
+        container.close()
+
+
+def count_video_frames(video_path, start=0, end=None, stride=1):
+    # number of frames iter_video_frames selects. Containers without a frame count in the header have their video
+    # packets counted, a demux pass that decodes nothing
+    container = av.open(video_path)
+    try:
+        stream = container.streams.video[0]
+        total = stream.frames or sum(1 for packet in container.demux(stream) if packet.size)
+    finally:
+        container.close()
+    end = total if end is None else min(end, total)
+    return max(0, (end - start + stride - 1) // stride)
+
+
+def read_video_frames(video_path, start=0, end=None, stride=1, size=None, out=None, dtype=np.uint8, batch_size=16):
+    """
+    Decodes frames [start:end:stride] of `video_path` into the (n, h, w, 3) buffer `out`. Unless given, the buffer is
+    preallocated from `count_video_frames` and grown in place when the container holds more frames than it reports,
+    so the frames are never held twice: the peak is the buffer plus one uint8 batch of `batch_size` frames. A given
+    `out` is filled up to its length. A float buffer or `dtype` gets frames in 0..1, uint8 keeps 0..255. Returns the
+    filled part of the buffer.
+    """
+    batches = iter_video_frames(video_path, start, end, stride, size, batch_size)
+    grow = out is None
+    count = count_video_frames(video_path, start, end, stride) if grow else len(out)
+    filled = 0
+    for batch in batches:
+        if out is None:
+            out = np.empty((max(count, len(batch)),) + batch.shape[1:], dtype=dtype)
+        if grow and filled + len(batch) > len(out):
+            # the frame count in the container header is only an estimate. resize reallocates the buffer, large
+            # buffers are remapped rather than copied, and nothing else views it yet
+            out.resize((max(len(out) + len(out) // 4, filled + len(batch)),) + out.shape[1:], refcheck=False)
+        n = min(len(batch), len(out) - filled)
+        if out.dtype == np.uint8:
+            out[filled:filled + n] = batch[:n]
+        else:
+            np.multiply(batch[:n], 1 / 255, out=out[filled:filled + n], casting="unsafe")
+        filled += n
+        if not grow and filled == len(out):
+            break
+    if out is None:
+        return np.empty((0, 0, 0, 3), dtype=dtype)
+    if grow and filled < len(out):
+        out.resize((filled,) + out.shape[1:], refcheck=False)
+    return out[:filled]
+
+
 def get_fps(video_path):
     container = av.open(video_path)
     video_stream = next(s for s in container.streams if s.type == "video")
@@ -180,6 +309,110 @@ else:
             ffmpeg_path = max(ffmpeg_paths, key=ffmpeg_suitability)
 
 
+class VideoWriter:
+    """
+    Incremental mp4 writer. Frames come in (n, h, w, 3) uint8 RGB batches through `write` and are piped raw to
+    `ffmpeg_path`, or encoded with a threaded PyAV codec when no ffmpeg was found, so the video is never held in memory
+    as a whole. The audio of `audio_path` (an audio or video file) is muxed in by the same ffmpeg process, and cut to
+    the video length.
+    """
+
+    def __init__(self, path, fps, audio_path=None, codec="libx264", pix_fmt="yuv420p", crf=19, use_ffmpeg=True):
+        self.path = path
+        self.fps = fps
+        self.audio_path = audio_path
+        self.codec = codec
+        self.pix_fmt = pix_fmt
+        self.crf = crf
+        self.use_ffmpeg = use_ffmpeg and ffmpeg_path is not None
+        self.process = None
+        self.stderr = None
+        self.container = None
+        self.stream = None
+        self.audio_stream = None
+        self.frame_count = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def _open(self, width, height):
+        if self.use_ffmpeg:
+            args = [ffmpeg_path, "-v", "error", "-y",
+                    "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{width}x{height}", "-r", str(self.fps), "-i", "-"]
+            if self.audio_path is not None:
+                args += ["-i", self.audio_path, "-map", "0:v", "-map", "1:a?", "-c:a", "aac", "-shortest"]
+            args += ["-c:v", self.codec, "-pix_fmt", self.pix_fmt, "-crf", str(self.crf), self.path]
+            # stderr goes to a file: a pipe read only at close fills up on a long encode and blocks ffmpeg, which then
+            # stops reading the frames
+            self.stderr = tempfile.TemporaryFile()
+            self.process = subprocess.Popen(args, stdin=subprocess.PIPE, stderr=self.stderr)
+        else:
+            self.container = av.open(self.path, "w")
+            self.stream = self.container.add_stream(self.codec, rate=self.fps)
+            self.stream.width = width
+            self.stream.height = height
+            self.stream.pix_fmt = self.pix_fmt
+            self.stream.options = {"crf": str(self.crf)}
+            self.stream.thread_type = "AUTO"
+            if self.audio_path is not None:
+                # streams have to exist before the first packet is muxed
+                with av.open(self.audio_path) as source:
+                    if source.streams.audio:
+                        self.audio_stream = self.container.add_stream("aac", rate=source.streams.audio[0].rate)
+
+    def write(self, frames):
+        if torch.is_tensor(frames):
+            frames = frames.cpu().numpy()
+        frames = np.ascontiguousarray(frames, dtype=np.uint8)
+        if self.process is None and self.container is None:
+            self._open(frames.shape[2], frames.shape[1])
+        if self.process is not None:
+            try:
+                self.process.stdin.write(frames.tobytes())
+            except BrokenPipeError:
+                # ffmpeg exited, close raises with its error output
+                self.close()
+                raise
+        else:
+            for frame in frames:
+                self.container.mux(self.stream.encode(av.VideoFrame.from_ndarray(frame, format="rgb24")))
+        self.frame_count += len(frames)
+
+    def _mux_audio_av(self):
+        duration = self.frame_count / self.fps
+        with av.open(self.audio_path) as source:
+            for frame in source.decode(source.streams.audio[0]):
+                if frame.time is not None and frame.time >= duration:
+                    break
+                frame.pts = None
+                self.container.mux(self.audio_stream.encode(frame))
+            self.container.mux(self.audio_stream.encode())
+
+    def close(self):
+        if self.process is not None:
+            process, self.process = self.process, None
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+            returncode = process.wait()
+            self.stderr.seek(0)
+            stderr = self.stderr.read()
+            self.stderr.close()
+            if returncode != 0:
+                raise RuntimeError(f"ffmpeg failed writing {self.path}: {stderr.decode('utf-8', 'replace')}")
+        elif self.container is not None:
+            self.container.mux(self.stream.encode())
+            if self.audio_stream is not None:
+                self._mux_audio_av()
+            self.container.close()
+            self.container = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 def get_sorted_dir_files_from_directory(directory: str, skip_first_images: int=0, select_every_nth: int=1, extensions: Iterable=None):
     directory = directory.strip()
     dir_files = os.listdir(directory)
@@ -216,6 +449,68 @@ def calculate_file_hash(filename: str, hash_every_n: int = 1):
     return h.hexdigest()
 
 
+class FingerprintIndex:
+    """
+    Content hashes keyed by the stat fingerprint (path, size, mtime, inode) of a file, persisted as json in
+    `store_path`. A file is only read again when its fingerprint changed, files larger than `sample_above` bytes then
+    get the sampled `calculate_file_hash(hash_every_n)` instead of a full pass. Keeps the `max_entries` most recent.
+    """
+
+    def __init__(self, store_path, sample_above=256 * 1024 * 1024, hash_every_n=10, max_entries=4096):
+        self.store_path = store_path
+        self.sample_above = sample_above
+        self.hash_every_n = hash_every_n
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = {}
+        try:
+            with open(store_path, "r") as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    @staticmethod
+    def fingerprint(path):
+        st = os.stat(path)
+        return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+    def get(self, path):
+        path = os.path.abspath(path)
+        fingerprint = self.fingerprint(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[:3] == fingerprint:
+                return entry[3]
+
+        hash_every_n = self.hash_every_n if fingerprint[0] > self.sample_above else 1
+        digest = calculate_file_hash(path, hash_every_n)
+        with self.lock:
+            self.entries.pop(path, None)
+            self.entries[path] = fingerprint + [digest]
+            while len(self.entries) > self.max_entries:
+                del self.entries[next(iter(self.entries))]
+            self.save()
+        return digest
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.store_path)), exist_ok=True)
+            tmp_path = f"{self.store_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_path, self.store_path)
+        except OSError as e:
+            logger.warning(f"Failed to save the fingerprint index {self.store_path}: {e}")
+
+
+fingerprint_index = FingerprintIndex(
+    os.environ.get(
+        "ANIPORTRAIT_FINGERPRINT_INDEX",
+        os.path.join(os.path.expanduser("~"), ".cache", "aniportrait", "fingerprints.json"),
+    )
+)
+
+
 def get_audio(file, start_time=0, duration=0):
     args = [ffmpeg_path, "-v", "error", "-i", file]
     if start_time > 0:
@@ -266,7 +561,7 @@ def hash_path(path):
         return "input"
     if is_url(path):
         return "url"
-    return calculate_file_hash(path.strip("\""))
+    return fingerprint_index.get(path.strip("\""))
 
 
 def validate_path(path, allow_none=False, allow_url=True):
@@ -0,0 +1,22 @@
+import os
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+# the checkout is the ComfyUI node package, whose __init__ needs a running ComfyUI, the tests import `src` directly
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope="session")
+def landmarks():
+    from src.utils.mp_utils import LMKExtractor
+
+    face = LMKExtractor()(cv2.imread(os.path.join(ROOT, "assets/woman.jpg")))["lmks"].astype(np.float32)
+    # the face moved by a few sub-pixel steps, so the landmarks land on different parts of their canvas pixels
+    shifts = np.random.default_rng(0).uniform(-0.01, 0.01, (4, 1, 3)).astype(np.float32)
+    shifts[..., 2] = 0
+    return face[None] + shifts
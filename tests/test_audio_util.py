@@ -0,0 +1,48 @@
+"""
+The driving audio decode shared by the wav2vec input (`load_audio`) and the VHS_AUDIO wav bytes (`audio_wav_bytes`).
+"""
+import io
+import os
+import wave
+
+import numpy as np
+import pytest
+
+librosa = pytest.importorskip("librosa")
+
+from src.utils import audio_util
+
+AUDIO = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "assets/lyl.wav")
+
+
+@pytest.fixture
+def decodes(monkeypatch):
+    audio_util._audio_cache.clear()
+    calls = []
+    load = librosa.load
+
+    def counting_load(*args, **kwargs):
+        calls.append(args)
+        return load(*args, **kwargs)
+
+    monkeypatch.setattr(audio_util.librosa, "load", counting_load)
+    yield calls
+    audio_util._audio_cache.clear()
+
+
+def test_one_decode_for_both_consumers(decodes):
+    speech_array = audio_util.load_audio(AUDIO, 16000)
+    wav_bytes = audio_util.audio_wav_bytes(AUDIO)
+    assert len(decodes) == 1
+    expected, _ = librosa.load(AUDIO, sr=16000)
+    np.testing.assert_allclose(speech_array, expected, atol=1e-6)
+    with wave.open(io.BytesIO(wav_bytes)) as f, wave.open(AUDIO) as source:
+        assert (f.getnchannels(), f.getframerate(), f.getnframes()) == (
+            source.getnchannels(), source.getframerate(), source.getnframes())
+
+
+def test_wav_bytes_from_start_time(decodes):
+    with wave.open(io.BytesIO(audio_util.audio_wav_bytes(AUDIO, start_time=1.5))) as f, wave.open(AUDIO) as source:
+        assert f.getnframes() == source.getnframes() - int(1.5 * source.getframerate())
+        skipped = np.frombuffer(source.readframes(source.getnframes()), dtype="<i2")[int(1.5 * source.getframerate()) * 2:]
+        assert np.abs(np.frombuffer(f.readframes(f.getnframes()), dtype="<i2").astype(np.int32) - skipped).max() <= 1
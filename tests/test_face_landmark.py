@@ -0,0 +1,72 @@
+"""
+The serialized landmarker output reader of face_landmark against the protos of the same packets, on the landmarker
+output of assets/woman.jpg, and its fallback to the protos when it does not match them.
+"""
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+from src.utils import face_landmark
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="module")
+def output_packets():
+    from src.utils.mp_utils import LMKExtractor
+
+    packets = []
+    build_arrays = face_landmark._build_landmarker_arrays
+
+    def keep_packets(output_packets):
+        packets.append(output_packets)
+        return build_arrays(output_packets)
+
+    face_landmark._build_landmarker_arrays = keep_packets
+    try:
+        LMKExtractor()(cv2.imread(os.path.join(ROOT, "assets/woman.jpg")))
+    finally:
+        face_landmark._build_landmarker_arrays = build_arrays
+    return packets[0]
+
+
+@pytest.fixture
+def unchecked(monkeypatch):
+    monkeypatch.setattr(face_landmark, "_serialized_reader_ok", None)
+
+
+def test_serialized_reader_matches_landmarker_result(output_packets):
+    result, mesh = face_landmark._build_landmarker_result2(output_packets)
+    arrays = face_landmark._serialized_landmarker_arrays(output_packets)
+    lmks = np.array([(lmk.x, lmk.y, lmk.z) for lmk in result.face_landmarks[0]])
+    assert lmks.shape == (478, 3)
+    np.testing.assert_array_equal(arrays["lmks"], lmks)
+    np.testing.assert_array_equal(arrays["blendshapes"], [c.score for c in result.face_blendshapes[0]])
+    np.testing.assert_array_equal(arrays["trans_mat"], result.facial_transformation_matrixes[0])
+    np.testing.assert_array_equal(arrays["vertex_buffer"], np.array(mesh.vertex_buffer))
+    np.testing.assert_array_equal(arrays["index_buffer"], np.array(mesh.index_buffer))
+
+
+def test_serialized_reader_checked_once(output_packets, unchecked):
+    expected = face_landmark._proto_landmarker_arrays(output_packets)
+    arrays = face_landmark._build_landmarker_arrays(output_packets)
+    assert face_landmark._serialized_reader_ok is True
+    for name, value in expected.items():
+        np.testing.assert_array_equal(arrays[name], value)
+
+
+def test_falls_back_to_protos_on_mismatch(output_packets, unchecked, monkeypatch):
+    landmark_array = face_landmark._landmark_array
+    monkeypatch.setattr(face_landmark, "_landmark_array", lambda data: landmark_array(data) + 1e-3)
+    arrays = face_landmark._build_landmarker_arrays(output_packets)
+    assert face_landmark._serialized_reader_ok is False
+    np.testing.assert_array_equal(arrays["lmks"], face_landmark._proto_landmarker_arrays(output_packets)["lmks"])
+
+
+def test_falls_back_without_private_getter(output_packets, unchecked, monkeypatch):
+    monkeypatch.setattr(face_landmark, "_get_serialized_proto_list", None)
+    arrays = face_landmark._build_landmarker_arrays(output_packets)
+    assert face_landmark._serialized_reader_ok is False
+    np.testing.assert_array_equal(arrays["lmks"], face_landmark._proto_landmarker_arrays(output_packets)["lmks"])
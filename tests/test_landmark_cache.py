@@ -0,0 +1,73 @@
+"""
+LandmarkCache partial hits: frames changed in the middle of a cached sequence are extracted again, through a stand-in
+batch extractor whose landmarks are the frame's pixel value, so interpolated frames show which frames they came from.
+"""
+import numpy as np
+import pytest
+
+from src.utils.mp_utils import LandmarkCache, SparseLMKExtractor
+
+
+class RampExtractor:
+    # a face on every frame, all landmarks at the frame's pixel value
+    def __init__(self, sequential):
+        self.sequential = sequential
+        self.calls = []
+
+    def __call__(self, frames):
+        self.calls.append([int(frame[0, 0, 0]) for frame in frames])
+        return [
+            {
+                "lmks": np.full((478, 3), frame[0, 0, 0], dtype=np.float64),
+                "lmks3d": np.full((478, 3), frame[0, 0, 0], dtype=np.float64),
+                "trans_mat": np.eye(4),
+                "faces": np.zeros((1, 3), dtype=np.int32),
+                "bs": np.zeros(52),
+            }
+            for frame in frames
+        ]
+
+
+def ramp(values):
+    frames = np.zeros((len(values), 8, 8, 3), dtype=np.uint8)
+    frames[:] = np.asarray(values, dtype=np.uint8)[:, None, None, None]
+    return frames
+
+
+def values(results):
+    return [float(result["lmks"][0, 0]) for result in results]
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.delenv("ANIPORTRAIT_LANDMARK_CACHE", raising=False)
+    return LandmarkCache(str(tmp_path))
+
+
+def test_sparse_gaps_extracted_as_runs(cache):
+    # the first frame keys the video, the changed frames 3 and 7..9 continue the ramp in steps of 10
+    frames = ramp(range(0, 120, 10))
+    cache.extract(frames, SparseLMKExtractor(RampExtractor(sequential=False), every=2))
+    frames[[3, 7, 8, 9]] += 5
+
+    inner = RampExtractor(sequential=False)
+    results = cache.extract(frames, SparseLMKExtractor(inner, every=2))
+    # 85 lies between the keyframes 75 and 95 of its run
+    assert inner.calls == [[35], [75, 95]]
+    assert values(results) == [0, 10, 20, 35, 40, 50, 60, 75, 85, 95, 100, 110]
+
+    # all stored now, the refilled frames included
+    inner = RampExtractor(sequential=False)
+    assert values(cache.extract(frames, SparseLMKExtractor(inner, every=2))) == values(results)
+    assert inner.calls == []
+
+
+def test_per_frame_extractor_gets_all_missing_frames(cache):
+    frames = ramp(range(0, 120, 10))
+    cache.extract(frames, RampExtractor(sequential=False))
+    frames[[3, 7, 8, 9]] += 5
+
+    extractor = RampExtractor(sequential=False)
+    results = cache.extract(frames, extractor)
+    assert extractor.calls == [[35, 75, 85, 95]]
+    assert values(results) == [0, 10, 20, 35, 40, 50, 60, 75, 85, 95, 100, 110]
@@ -0,0 +1,30 @@
+"""
+LandmarkSequence keeps the frame size and rate of its source through the memory-mapped copy VideoGenPose hands on.
+"""
+import os
+
+import numpy as np
+
+from src.utils.landmark_sequence import LandmarkSequence
+
+
+def sequence(landmarks, **kwargs):
+    results = [{"lmks": lmks, "lmks3d": lmks, "trans_mat": np.eye(4), "bs": np.zeros(51), "faces": None}
+               for lmks in landmarks]
+    return LandmarkSequence.from_results(results[:2] + [None] + results[2:], **kwargs)
+
+
+def test_memory_mapped_keeps_frame_size(landmarks, tmp_path):
+    mapped = sequence(landmarks, fps=24, frame_size=(640, 360)).memory_mapped(str(tmp_path / "landmarks"))
+    assert mapped.frame_size == (640, 360)
+    assert mapped.fps == 24
+    assert isinstance(mapped.lmks, np.memmap)
+    np.testing.assert_array_equal(mapped.valid, [True, True, False, True, True])
+    np.testing.assert_array_equal(mapped.lmks[3], landmarks[2].astype(np.float16))
+
+
+def test_unknown_frame_size(landmarks, tmp_path):
+    path = str(tmp_path / "landmarks")
+    sequence(landmarks).save(path)
+    assert not os.path.exists(os.path.join(path, "frame_size.npy"))
+    assert LandmarkSequence.load(path).frame_size is None
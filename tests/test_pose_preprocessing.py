@@ -0,0 +1,71 @@
+"""
+PoseGenVideo's batched pose preprocessing (`pose_frames_from_images` + `Pose2VideoPipeline.prepare_pose_condition`)
+against the original per-frame path (a cv2 colour conversion and resize per frame, then one
+`cond_image_processor.preprocess` call per pose image), on the pose_images VideoGenPose emits.
+"""
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+import pytest
+import torch
+from diffusers.image_processor import VaeImageProcessor
+
+from src.pipelines.pipeline_pose2vid_long import Pose2VideoPipeline
+from src.utils.draw_util import FaceMeshVisualizer
+from src.utils.landmark_sequence import LandmarkSequence
+from src.utils.util import pose_frames_from_images
+
+# one level of the 0..255 pixel scale on the 2 * pixel - 1 scale of the condition: the bilinear resizes of cv2 and
+# torch round differently
+RESIZE_TOLERANCE = 2
+
+
+@pytest.fixture(scope="module")
+def pose_images(landmarks):
+    # VideoGenPose's pose_images output of a 512x512 source
+    sequence = LandmarkSequence(
+        lmks=landmarks.astype(np.float16),
+        lmks3d=landmarks.astype(np.float16),
+        bs=np.zeros((len(landmarks), 51), dtype=np.float16),
+        trans_mat=np.repeat(np.eye(4, dtype=np.float32)[None], len(landmarks), 0),
+        valid=np.ones(len(landmarks), dtype=bool),
+    )
+    return torch.from_numpy(sequence.render_images(FaceMeshVisualizer(forehead_edge=False), (512, 512)))
+
+
+def per_frame_condition(pose_images, height, width, processor):
+    # the original node and pipeline code
+    pose_list = []
+    for pose_image_pil in pose_images:
+        pose_image = (pose_image_pil.numpy() * 255).astype(np.uint8)
+        pose_image_np = cv2.cvtColor(np.array(pose_image), cv2.COLOR_RGB2BGR)
+        pose_list.append(cv2.resize(pose_image_np, (width, height)))
+    conditions = [processor.preprocess(pose_image, height=height, width=width).unsqueeze(2) for pose_image in pose_list]
+    return torch.cat(conditions, dim=2)
+
+
+def batched_condition(pose_images, height, width, processor):
+    pipe = SimpleNamespace(cond_image_processor=processor)
+    pose_list = pose_frames_from_images(pose_images, height, width)
+    return Pose2VideoPipeline.prepare_pose_condition(pipe, pose_list, height, width, "cpu", torch.float32)
+
+
+def test_pose_images_in_unit_range(pose_images):
+    assert pose_images.dtype == torch.float32
+    assert pose_images.min() >= 0 and pose_images.max() <= 1
+    assert pose_images.max() > 0.5
+
+
+@pytest.mark.parametrize("size", [(512, 512), (384, 256), (256, 384)])
+def test_matches_per_frame_path(pose_images, size):
+    height, width = size
+    processor = VaeImageProcessor(vae_scale_factor=8, do_convert_rgb=True, do_normalize=True)
+    expected = per_frame_condition(pose_images, height, width, processor)
+    condition = batched_condition(pose_images, height, width, processor)
+    assert condition.shape == expected.shape
+    difference = (condition - expected).abs()
+    if size == (512, 512):
+        assert difference.max() == 0
+    else:
+        assert difference.max() <= RESIZE_TOLERANCE
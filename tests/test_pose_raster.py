@@ -0,0 +1,55 @@
+"""
+FaceMeshRasterizer against the cv2 drawing of FaceMeshVisualizer, on CPU. The rasterizer anti-aliases the line borders
+where cv2 draws hard lines, so whole faces are compared by their mean difference and the share of pixels far off, and
+the placement of the lines by the intensity centroid of single edges, across the line.
+"""
+import numpy as np
+import pytest
+
+from src.utils.draw_util import FaceMeshVisualizer
+from src.utils.pose_raster import FaceMeshRasterizer
+
+# 0..255 BGR pixel scale
+MEAN_TOLERANCE = 0.3
+FAR_OFF = 64
+FAR_OFF_SHARE = 0.005
+# pixels of the output image, across the line
+CENTROID_TOLERANCE = 0.1
+
+SIZES = [(512, 512), (256, 256), (384, 256)]
+
+
+def rasterize(keypoints, size, visualizer):
+    images = FaceMeshRasterizer(visualizer).render(keypoints, size, normed=True)
+    return images.permute(0, 2, 3, 1).numpy()
+
+
+def centroid(image):
+    weights = image.sum(-1)
+    ys, xs = np.mgrid[: weights.shape[0], : weights.shape[1]]
+    return np.array([(weights * xs).sum(), (weights * ys).sum()]) / weights.sum()
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_matches_draw_landmarks(landmarks, size):
+    visualizer = FaceMeshVisualizer(forehead_edge=False)
+    expected = visualizer.draw_landmarks_batch(landmarks, size, normed=True).astype(np.float32)
+    difference = np.abs(rasterize(landmarks, size, visualizer) - expected)
+    assert difference.mean() <= MEAN_TOLERANCE
+    assert (difference.max(-1) > FAR_OFF).mean() <= FAR_OFF_SHARE
+
+
+@pytest.mark.parametrize("size", SIZES)
+@pytest.mark.parametrize("segment", [[(100, 300), (400, 310)], [(250, 100), (240, 420)], [(300, 100), (100, 400)]])
+def test_lines_through_canvas_pixel_centres(size, segment):
+    # cv2 draws a landmark at x on canvas pixel floor(x * 512) and through its centre, half a pixel off x when x sits
+    # just above the pixel border. Compared across the line: along it cv2's stair steps move the centroid as well
+    visualizer = FaceMeshVisualizer(forehead_edge=False)
+    start, end = visualizer.edge_runs[0][1][0]
+    keypoints = np.full((1, 478, 3), -1, dtype=np.float32)
+    keypoints[0, [start, end], :2] = (np.array(segment, dtype=np.float32) + 0.02) / 512
+    expected = visualizer.draw_landmarks_batch(keypoints, size, normed=True).astype(np.float32)[0]
+    image = rasterize(keypoints, size, visualizer)[0]
+    direction = (np.subtract(segment[1], segment[0]) * np.array(size) / 512).astype(np.float64)
+    normal = np.array([-direction[1], direction[0]]) / np.linalg.norm(direction)
+    assert abs((centroid(image) - centroid(expected)) @ normal) <= CENTROID_TOLERANCE
@@ -0,0 +1,51 @@
+"""
+SparseLMKExtractor hands its keyframes to the extractor as one sequence, and the middle frames of its refinement
+passes, which come from different gaps, in "image" mode when the extractor tracks.
+"""
+import numpy as np
+
+from src.utils.mp_utils import SparseLMKExtractor
+
+
+class RecordingExtractor:
+    # a face on frames below 100, all landmarks at the frame's pixel value
+    def __init__(self, sequential):
+        self.sequential = sequential
+        self.calls = []
+
+    def __call__(self, frames, mode=None):
+        self.calls.append(([int(frame[0, 0, 0]) for frame in frames], mode))
+        return [
+            {
+                "lmks": np.full((478, 3), frame[0, 0, 0] / 255, dtype=np.float64),
+                "lmks3d": np.zeros((478, 3)),
+                "trans_mat": np.eye(4),
+                "faces": None,
+                "bs": np.zeros(51),
+            }
+            if frame[0, 0, 0] < 100 else None
+            for frame in frames
+        ]
+
+
+def frames(values):
+    out = np.zeros((len(values), 4, 4, 3), dtype=np.uint8)
+    out[:] = np.asarray(values, dtype=np.uint8)[:, None, None, None]
+    return out
+
+
+# no face on frames 10-13: the gaps 8-12 and 12-16 are bisected together, down to frames 10 and 13
+VALUES = list(range(10)) + [200] * 4 + [14, 15, 16]
+
+
+def test_tracker_refines_in_image_mode():
+    extractor = RecordingExtractor(sequential=True)
+    results = SparseLMKExtractor(extractor, every=4)(frames(VALUES))
+    assert extractor.calls == [([0, 4, 8, 200, 16], None), ([200, 14], "image"), ([9, 200], "image")]
+    assert [result is None for result in results] == [False] * 10 + [True] * 4 + [False] * 3
+
+
+def test_per_frame_extractor_refines_as_is():
+    extractor = RecordingExtractor(sequential=False)
+    SparseLMKExtractor(extractor, every=4)(frames(VALUES))
+    assert [mode for _, mode in extractor.calls] == [None, None, None]
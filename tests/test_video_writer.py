@@ -0,0 +1,57 @@
+"""
+VideoWriter's ffmpeg pipe, against a stand-in ffmpeg that takes the raw frames on stdin and writes a progress line to
+stderr for every chunk it reads, far more than a pipe buffer holds.
+"""
+import stat
+import sys
+import threading
+
+import numpy as np
+import pytest
+
+from src.utils import util
+
+FAKE_FFMPEG = """#!{python}
+import sys
+read = 0
+while True:
+    chunk = sys.stdin.buffer.read(65536)
+    if not chunk:
+        break
+    read += len(chunk)
+    sys.stderr.write("frame progress " * 256 + "\\n")
+    sys.stderr.flush()
+with open(sys.argv[-1], "w") as f:
+    f.write(str(read))
+sys.exit({returncode})
+"""
+
+
+def fake_ffmpeg(tmp_path, returncode=0):
+    path = tmp_path / "ffmpeg"
+    path.write_text(FAKE_FFMPEG.format(python=sys.executable, returncode=returncode))
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    return str(path)
+
+
+def write_video(path, frames):
+    with util.VideoWriter(str(path), 25) as writer:
+        for start in range(0, len(frames), 8):
+            writer.write(frames[start:start + 8])
+
+
+def test_long_stderr_does_not_block(tmp_path, monkeypatch):
+    monkeypatch.setattr(util, "ffmpeg_path", fake_ffmpeg(tmp_path))
+    frames = np.zeros((400, 128, 128, 3), dtype=np.uint8)
+    output = tmp_path / "out.mp4"
+    thread = threading.Thread(target=write_video, args=(output, frames), daemon=True)
+    thread.start()
+    thread.join(timeout=60)
+    assert not thread.is_alive()
+    assert output.read_text() == str(frames.nbytes)
+
+
+def test_ffmpeg_error_is_raised(tmp_path, monkeypatch):
+    monkeypatch.setattr(util, "ffmpeg_path", fake_ffmpeg(tmp_path, returncode=1))
+    with pytest.raises(RuntimeError, match="frame progress"):
+        write_video(tmp_path / "out.mp4", np.zeros((16, 64, 64, 3), dtype=np.uint8))